@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+
+# Investment Portfolio Optimizer
+# Copyright (C) 2024  Vladimir Looze
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from functools import cache
+import numpy
+
+_CONFIG_KEYS = ('min', 'max', 'max_assets', 'groups')
+
+
+class AllocationConstraints:
+    '''
+    Constraints on allocations: min and max weight of every asset in percent,
+    maximum number of assets held and maximum total weight of groups of assets.
+    Allocations satisfying them are enumerated by descending asset by asset like
+    data_source.all_possible_allocations, pruning weights that leave no way to satisfy constraints
+    and skipping whole subtrees by their counts, so ranges of allocations can be enumerated independently.
+    '''
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-positional-arguments
+    def __init__(
+            self, assets_n: int, min_weights: list[int] = None, max_weights: list[int] = None,
+            max_assets_n: int = None, groups: list[tuple[list[int], int]] = ()):
+        self.assets_n = assets_n
+        self.min_weights = tuple(min_weights or [0] * assets_n)
+        self.max_weights = tuple(max_weights or [100] * assets_n)
+        self.max_assets_n = max_assets_n
+        self.groups = tuple((tuple(asset_idxs), cap) for asset_idxs, cap in groups)
+
+    @staticmethod
+    def from_config(config: dict, assets: list[str]):
+        '''
+        Constraints from "constraints" section of portfolios config, e.g.
+        {"min": {"Stocks": 30}, "max": {"Gold": 20}, "max_assets": 4,
+        "groups": [{"assets": ["Gold", "Silver"], "max": 25}]}
+        '''
+        def _asset_idx(asset: str):
+            if asset not in assets:
+                raise ValueError(f'constraints refer to asset "{asset}" that is not in market data')
+            return assets.index(asset)
+
+        unknown_keys = set(config) - set(_CONFIG_KEYS)
+        if unknown_keys:
+            raise ValueError(
+                f'unknown constraints {", ".join(sorted(unknown_keys))}, expected {", ".join(_CONFIG_KEYS)}')
+        min_weights = [0] * len(assets)
+        for asset, weight in config.get('min', {}).items():
+            min_weights[_asset_idx(asset)] = weight
+        max_weights = [100] * len(assets)
+        for asset, weight in config.get('max', {}).items():
+            max_weights[_asset_idx(asset)] = weight
+        groups = [
+            ([_asset_idx(asset) for asset in group['assets']], group['max'])
+            for group in config.get('groups', [])]
+        return AllocationConstraints(len(assets), min_weights, max_weights, config.get('max_assets'), groups)
+
+    def __eq__(self, other):
+        return isinstance(other, AllocationConstraints) and self.config() == other.config()
+
+    def __hash__(self):
+        return hash(repr(self.config()))
+
+    def config(self):
+        '''
+        JSON-serializable description, asset indices instead of names
+        '''
+        return {
+            'min': list(self.min_weights),
+            'max': list(self.max_weights),
+            'max_assets': self.max_assets_n,
+            'groups': [[list(asset_idxs), cap] for asset_idxs, cap in self.groups],
+        }
+
+    def with_max_assets_n(self, max_assets_n: int):
+        '''
+        Same constraints holding at most max_assets_n assets too
+        '''
+        if self.max_assets_n is not None:
+            max_assets_n = min(max_assets_n, self.max_assets_n)
+        return AllocationConstraints(
+            self.assets_n, self.min_weights, self.max_weights, max_assets_n,
+            [(list(asset_idxs), cap) for asset_idxs, cap in self.groups])
+
+    def satisfied(self, weights: numpy.ndarray):
+        '''
+        Mask of rows of (allocations x assets) weights matrix that satisfy constraints
+        '''
+        passed = ((weights >= self.min_weights) & (weights <= self.max_weights)).all(axis=1)
+        if self.max_assets_n is not None:
+            passed &= numpy.count_nonzero(weights, axis=1) <= self.max_assets_n
+        for asset_idxs, cap in self.groups:
+            passed &= weights[:, list(asset_idxs)].sum(axis=1) <= cap
+        return passed
+
+    def _tree(self, step: int):
+        '''
+        Bounds of every asset in steps and group caps in steps, arguments of enumeration tree functions
+        '''
+        if 100 % step != 0:
+            raise ValueError(f'cannot use step={step}, must be a divisor of 100')
+        bounds = tuple(
+            (-(-min_weight // step), max_weight // step)
+            for min_weight, max_weight in zip(self.min_weights, self.max_weights))
+        groups = tuple((asset_idxs, cap // step) for asset_idxs, cap in self.groups)
+        return bounds, self.max_assets_n, groups
+
+    def allocations_count(self, step: int):
+        '''
+        Number of allocations of given step satisfying constraints, without generating them
+        '''
+        return _subtree_count(*self._tree(step), *self.tree_root(step))
+
+    def tree_root(self, step: int):
+        '''
+        State of empty allocation in enumeration tree, see tree_children
+        '''
+        return (0, 100 // step, 0, (0,) * len(self.groups))
+
+    def tree_children(self, step: int, state: tuple):
+        '''
+        (weight in percent, state) of every weight of next asset after allocation state
+        that leaves some allocation satisfying constraints. State is hashable (asset index, steps remaining,
+        assets held, group weights used), asset index equals number of assets for complete allocations.
+        '''
+        tree = self._tree(step)
+        asset_idx, remaining, held_n, used = state
+        children = []
+        for weight in _asset_weights(*tree, *state):
+            child_state = (
+                asset_idx + 1, remaining - weight, _held_after(tree[1], held_n, weight),
+                _used_after(tree[2], used, asset_idx, weight))
+            if asset_idx + 1 == self.assets_n or _subtree_count(*tree, *child_state) > 0:
+                children.append((weight * step, child_state))
+        return children
+
+    def tree_count(self, step: int, state: tuple):
+        '''
+        Number of allocations satisfying constraints below allocation state
+        '''
+        if state[0] == self.assets_n:
+            return 1
+        return _subtree_count(*self._tree(step), *state)
+
+    def allocation_blocks(self, step: int, start: int, stop: int, block_size: int):
+        '''
+        Weights matrices of allocations number start..stop-1 among allocations satisfying constraints,
+        in blocks of up to block_size allocations
+        '''
+        def _rows(prefixes: list[tuple], tails: list[numpy.ndarray]):
+            tails_n = [len(tail) for tail in tails]
+            heads = numpy.repeat(numpy.array(prefixes, dtype=numpy.int32).reshape(len(prefixes), -1), tails_n, axis=0)
+            return numpy.hstack((heads, numpy.concatenate(tails))) * step
+
+        position = start
+        prefixes, tails, buffered_n = [], [], 0
+        for prefix, tail in _subtree_allocations(*self._tree(step), *self.tree_root(step), (), start):
+            tail = tail[:stop - position]
+            prefixes.append(prefix)
+            tails.append(tail)
+            buffered_n += len(tail)
+            position += len(tail)
+            if buffered_n >= block_size or position >= stop:
+                rows = _rows(prefixes, tails)
+                for offset in range(0, len(rows), block_size):
+                    yield rows[offset:offset + block_size]
+                prefixes, tails, buffered_n = [], [], 0
+            if position >= stop:
+                return
+        if buffered_n > 0:
+            yield _rows(prefixes, tails)
+
+
+def _group_room(groups: tuple, used: tuple, asset_idx: int):
+    return min((cap - group_used for (asset_idxs, cap), group_used in zip(groups, used) if asset_idx in asset_idxs),
+               default=100)
+
+
+def _held_after(max_assets_n: int, held_n: int, weight: int):
+    # assets held matter only with max_assets_n, keeping them 0 otherwise shares memoized subtrees
+    return held_n + (weight > 0) if max_assets_n is not None else 0
+
+
+def _used_after(groups: tuple, used: tuple, asset_idx: int, weight: int):
+    return tuple(
+        group_used + weight if asset_idx in asset_idxs else group_used
+        for (asset_idxs, _), group_used in zip(groups, used))
+
+
+@cache
+def _rest_bounds(bounds: tuple, asset_idx: int):
+    '''
+    Smallest and largest total weight in steps of assets after asset_idx and number of them that must be held
+    '''
+    rest = bounds[asset_idx + 1:]
+    return (
+        sum(rest_bounds[0] for rest_bounds in rest),
+        sum(rest_bounds[1] for rest_bounds in rest),
+        sum(1 for rest_bounds in rest if rest_bounds[0] > 0))
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-positional-arguments
+@cache
+def _asset_weights(
+        bounds: tuple, max_assets_n: int, groups: tuple,
+        asset_idx: int, remaining: int, held_n: int, used: tuple):
+    '''
+    Weights of asset in steps that leave remaining steps to assets after it within their bounds,
+    and leave room for assets after it that must be held
+    '''
+    low, high = bounds[asset_idx]
+    high = min(high, remaining, _group_room(groups, used, asset_idx))
+    rest_low, rest_high, rest_held_n = _rest_bounds(bounds, asset_idx)
+    weights = []
+    for weight in range(low, high + 1):
+        if not rest_low <= remaining - weight <= rest_high:
+            continue
+        if max_assets_n is not None:
+            held_after_n = held_n + (weight > 0)
+            if held_after_n + rest_held_n > max_assets_n or held_after_n == max_assets_n and remaining > weight:
+                continue
+        weights.append(weight)
+    return tuple(weights)
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-positional-arguments
+@cache
+def _subtree_count(
+        bounds: tuple, max_assets_n: int, groups: tuple,
+        asset_idx: int, remaining: int, held_n: int, used: tuple):
+    '''
+    Number of allocations of remaining steps over assets from asset_idx on that satisfy constraints,
+    given number of assets held and group weights used before them
+    '''
+    if asset_idx == len(bounds) - 1:
+        return int(remaining in _asset_weights(bounds, max_assets_n, groups, asset_idx, remaining, held_n, used))
+    return sum(
+        _subtree_count(
+            bounds, max_assets_n, groups, asset_idx + 1, remaining - weight,
+            _held_after(max_assets_n, held_n, weight), _used_after(groups, used, asset_idx, weight))
+        for weight in _asset_weights(bounds, max_assets_n, groups, asset_idx, remaining, held_n, used))
+
+
+# subtrees of this many last assets are enumerated once per state as matrices and then reused
+_TAIL_ASSETS_N = 3
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-positional-arguments
+@cache
+def _tail_allocations(
+        bounds: tuple, max_assets_n: int, groups: tuple,
+        asset_idx: int, remaining: int, held_n: int, used: tuple):
+    '''
+    Matrix of weights in steps of assets from asset_idx on, one row per allocation counted by _subtree_count
+    '''
+    if asset_idx == len(bounds) - 1:
+        count = _subtree_count(bounds, max_assets_n, groups, asset_idx, remaining, held_n, used)
+        return numpy.full((count, 1), remaining, dtype=numpy.int32)
+    tails = []
+    for weight in _asset_weights(bounds, max_assets_n, groups, asset_idx, remaining, held_n, used):
+        tail = _tail_allocations(
+            bounds, max_assets_n, groups, asset_idx + 1, remaining - weight,
+            _held_after(max_assets_n, held_n, weight), _used_after(groups, used, asset_idx, weight))
+        tails.append(numpy.hstack((numpy.full((len(tail), 1), weight, dtype=numpy.int32), tail)))
+    if len(tails) == 0:
+        return numpy.empty((0, len(bounds) - asset_idx), dtype=numpy.int32)
+    return numpy.concatenate(tails)
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-positional-arguments
+def _subtree_allocations(
+        bounds: tuple, max_assets_n: int, groups: tuple,
+        asset_idx: int, remaining: int, held_n: int, used: tuple,
+        prefix: tuple, start: int):
+    '''
+    Yield (prefix, tail) pairs of allocations in steps: weights of assets before some asset
+    and matrix of weights of that asset and assets after it, together making every allocation
+    counted by _subtree_count after given prefix, skipping first start of them and whole subtrees before it
+    '''
+    if asset_idx >= len(bounds) - _TAIL_ASSETS_N:
+        tail = _tail_allocations(bounds, max_assets_n, groups, asset_idx, remaining, held_n, used)[start:]
+        if len(tail) > 0:
+            yield prefix, tail
+        return
+    for weight in _asset_weights(bounds, max_assets_n, groups, asset_idx, remaining, held_n, used):
+        child_args = (
+            asset_idx + 1, remaining - weight, _held_after(max_assets_n, held_n, weight),
+            _used_after(groups, used, asset_idx, weight))
+        child_count = _subtree_count(bounds, max_assets_n, groups, *child_args)
+        if start >= child_count:
+            start -= child_count
+            continue
+        yield from _subtree_allocations(bounds, max_assets_n, groups, *child_args, prefix + (weight,), start)
+        start = 0
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# Investment Portfolio Optimizer
+# Copyright (C) 2024  Vladimir Looze
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy
+import pytest
+from modules import data_source
+from modules import data_filter
+from modules.batch_simulation import YearRangePlan
+from modules.allocation_constraints import AllocationConstraints
+
+ASSETS = ['A', 'B', 'C', 'D', 'E']
+
+
+@pytest.mark.parametrize('config', [
+    {},
+    {'min': {'A': 30}},
+    {'max': {'B': 20, 'C': 15}},
+    {'max_assets': 2},
+    {'groups': [{'assets': ['A', 'B'], 'max': 40}]},
+    {'min': {'A': 30, 'E': 5}, 'max': {'B': 20}, 'max_assets': 3,
+     'groups': [{'assets': ['C', 'D'], 'max': 25}, {'assets': ['D', 'E'], 'max': 30}]},
+    {'min': {'A': 60, 'B': 60}},
+    {'min': {'A': 10, 'B': 10, 'C': 10}, 'max_assets': 2},
+])
+@pytest.mark.parametrize('step', [5, 10, 25])
+def test_allocation_blocks(config: dict, step: int):
+    constraints = AllocationConstraints.from_config(config, ASSETS)
+    all_allocations = numpy.array(list(data_source.all_possible_allocations(len(ASSETS), step)))
+    expected = sorted(map(tuple, all_allocations[constraints.satisfied(all_allocations)].tolist()))
+    assert constraints.allocations_count(step) == len(expected)
+    allocations = [
+        tuple(allocation)
+        for weights in constraints.allocation_blocks(step, 0, len(expected), 7)
+        for allocation in weights.tolist()]
+    assert sorted(allocations) == expected
+    for start, stop, block_size in [(0, 1, 1), (1, len(expected) - 1, 3), (len(expected) // 2, len(expected) + 5, 4)]:
+        blocks = list(constraints.allocation_blocks(step, start, stop, block_size))
+        assert all(0 < len(weights) <= block_size for weights in blocks)
+        assert [tuple(allocation) for weights in blocks for allocation in weights.tolist()] == allocations[start:stop]
+
+
+def test_allocation_blocks_single_asset():
+    assert [weights.tolist() for weights in AllocationConstraints(1).allocation_blocks(10, 0, 5, 2)] == [[[100]]]
+    assert AllocationConstraints(1, max_weights=[50]).allocations_count(10) == 0
+
+
+def test_allocations_count_fine_step():
+    # pruned enumeration keeps 1% precision feasible when constraints leave few allocations
+    constraints = AllocationConstraints.from_config(
+        {'min': {'A': 30}, 'max': {'B': 20, 'C': 20, 'D': 20, 'E': 20}, 'max_assets': 3}, ASSETS)
+    count = constraints.allocations_count(1)
+    assert count < data_source.allocations_count(len(ASSETS), 1) // 10
+    blocks = list(constraints.allocation_blocks(1, 0, count, 2**16))
+    weights = numpy.concatenate(blocks)
+    assert len(weights) == count
+    assert constraints.satisfied(weights).all()
+    assert (weights.sum(axis=1) == 100).all()
+
+
+def test_with_max_assets_n():
+    constraints = AllocationConstraints.from_config({'max_assets': 3}, ASSETS)
+    assert constraints.with_max_assets_n(2).max_assets_n == 2
+    assert constraints.with_max_assets_n(4).max_assets_n == 3
+    assert AllocationConstraints(5).with_max_assets_n(2).allocations_count(10) == \
+        data_source.sparse_allocations_count(5, 10, 2)
+
+
+@pytest.mark.parametrize('config', [
+    {'min': {'F': 10}},
+    {'groups': [{'assets': ['A', 'F'], 'max': 10}]},
+    {'maximum': {'A': 10}},
+])
+def test_from_config_invalid(config: dict):
+    with pytest.raises(ValueError):
+        AllocationConstraints.from_config(config, ASSETS)
+
+
+def test_simulated_allocation_blocks():
+    rng = numpy.random.default_rng(seed=5)
+    plan = YearRangePlan(
+        data_filter.years_all_to_all,
+        {str(year): list(rng.uniform(0.8, 1.25, size=len(ASSETS))) for year in range(2000, 2008)})
+    constraints = AllocationConstraints.from_config({'min': {'A': 20}, 'max_assets': 3}, ASSETS)
+    count = constraints.allocations_count(10)
+    blocks = list(data_source.simulated_allocation_blocks(
+        plan, 0, count, len(ASSETS), 10, 16, constraints=constraints))
+    weights = numpy.concatenate([block[0] for block in blocks])
+    assert len(weights) == count
+    assert numpy.allclose(numpy.concatenate([block[1] for block in blocks]), plan.simulate_weights(weights))
+    assert numpy.array_equal(
+        numpy.concatenate([block[2] for block in blocks]), data_source.allocation_walk_rank_batch(weights, 10))
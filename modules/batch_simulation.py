@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+
+# Investment Portfolio Optimizer
+# Copyright (C) 2024  Vladimir Looze
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import copy
+from collections.abc import Callable
+import numpy
+
+# columns of simulated stats matrix, same order as in Portfolio.serialize
+STAT_COLUMN_GAIN = 0
+STAT_COLUMN_POP_PERCENT = 1
+STAT_COLUMN_DIP_PERCENT = 2
+STAT_COLUMN_CAGR_PERCENT = 3
+STAT_COLUMN_VARIANCE = 4
+STAT_COLUMN_STDDEV = 5
+STAT_COLUMN_SHARPE = 6
+STAT_COLUMNS = 7
+
+# aggregates of one year range, enough to extend it by more years without previous years
+AGGREGATE_LOG_GAIN = 0
+AGGREGATE_DELTA = 1
+AGGREGATE_DELTA_SQ = 2
+AGGREGATE_MIN = 3
+AGGREGATE_MAX = 4
+AGGREGATE_COLUMNS = 5
+
+
+def returns_matrix(asset_gain_per_year: dict[str, list[float]]):
+    '''
+    Dense (years x assets) matrix of yearly gains, rows in data order
+    '''
+    years = list(asset_gain_per_year.keys())
+    return years, numpy.array([asset_gain_per_year[year] for year in years], dtype=numpy.float64)
+
+
+def year_range_indices(year_range_selector_func: Callable, years: list):
+    '''
+    Start and end (inclusive) row indices of year ranges produced by selector
+    '''
+    year_ranges = list(year_range_selector_func(sorted(years)))
+    starts = numpy.array([years.index(year_start) for year_start, _ in year_ranges], dtype=numpy.intp)
+    ends = numpy.array([years.index(year_end) for _, year_end in year_ranges], dtype=numpy.intp)
+    return starts, ends
+
+
+# ranges of annual gains spread not wider than this have no variance, see _range_values
+_CONSTANT_GAINS_SPREAD = 1e-9
+# number of elements in temporary (portfolios x ranges) or (portfolios x years x levels) arrays
+# processed at once, keeps memory bounded for all-to-all selectors over long (e.g. monthly) data
+_BLOCK_ELEMENTS = 2**22
+
+
+def simulate_annual_gains(
+        annual_gains: numpy.ndarray, starts: numpy.ndarray, ends: numpy.ndarray,
+        open_ranges: numpy.ndarray = None):
+    '''
+    Stats matrix (portfolios x STAT_COLUMNS) from (portfolios x years) matrix of annual gains,
+    averaged over year ranges given by starts and ends.
+    With open_ranges mask also returns partials matrix, see _partials
+    '''
+    years_n = annual_gains.shape[1]
+    levels_n = years_n.bit_length()
+    rows_per_block = max(1, _BLOCK_ELEMENTS // max(len(starts) * AGGREGATE_COLUMNS, years_n * levels_n))
+    stats = numpy.empty((annual_gains.shape[0], STAT_COLUMNS))
+    partials = None
+    if open_ranges is not None:
+        partials = numpy.empty((annual_gains.shape[0], partials_columns(open_ranges)))
+    for row in range(0, annual_gains.shape[0], rows_per_block):
+        block_rows = slice(row, row + rows_per_block)
+        aggregates = _range_aggregates(annual_gains[block_rows] - 1, starts, ends)
+        values = _range_values(aggregates, ends - starts + 1)
+        stats[block_rows] = _stats_from_sums(*(numpy.sum(value, axis=1) for value in values), len(starts))
+        if partials is not None:
+            partials[block_rows] = _partials(values, aggregates, open_ranges)
+    if partials is None:
+        return stats
+    return stats, partials
+
+
+def _scanned_range_extremes(values: numpy.ndarray, starts: numpy.ndarray, ends: numpy.ndarray):
+    '''
+    Minimum and maximum of every range of values along axis 1, scanning every range
+    '''
+    range_min = numpy.empty((values.shape[0], len(starts)))
+    range_max = numpy.empty((values.shape[0], len(starts)))
+    for range_idx, (range_start, range_end) in enumerate(zip(starts, ends)):
+        range_min[:, range_idx] = numpy.min(values[:, range_start:range_end + 1], axis=1)
+        range_max[:, range_idx] = numpy.max(values[:, range_start:range_end + 1], axis=1)
+    return range_min, range_max
+
+
+def _range_extremes(values: numpy.ndarray, starts: numpy.ndarray, ends: numpy.ndarray):
+    '''
+    Minimum and maximum of every range of values along axis 1, using sparse tables:
+    level k holds extremes of 2**k consecutive values, any range is covered
+    by two (overlapping) intervals of the largest level that fits into it
+    '''
+    if numpy.sum(ends - starts + 1) <= values.shape[1] * values.shape[1].bit_length():
+        # few short ranges, e.g. single first-to-last range: tables would cost more than direct scan
+        return _scanned_range_extremes(values, starts, ends)
+    range_min = numpy.empty((values.shape[0], len(starts)))
+    range_max = numpy.empty((values.shape[0], len(starts)))
+    table_min = [values]
+    table_max = [values]
+    for level in range(1, values.shape[1].bit_length()):
+        half = 1 << (level - 1)
+        table_min.append(numpy.minimum(table_min[-1][:, :-half], table_min[-1][:, half:]))
+        table_max.append(numpy.maximum(table_max[-1][:, :-half], table_max[-1][:, half:]))
+    range_levels = numpy.frexp(ends - starts + 1)[1] - 1
+    for level in numpy.unique(range_levels):
+        ranges = numpy.flatnonzero(range_levels == level)
+        left = starts[ranges]
+        right = ends[ranges] - (1 << level) + 1
+        range_min[:, ranges] = numpy.minimum(table_min[level][:, left], table_min[level][:, right])
+        range_max[:, ranges] = numpy.maximum(table_max[level][:, left], table_max[level][:, right])
+    return range_min, range_max
+
+
+def _range_aggregates(deltas: numpy.ndarray, starts: numpy.ndarray, ends: numpy.ndarray):
+    '''
+    Every year range is answered in O(1) from prefix sums of log-gains, gains and squared gains
+    and from sparse tables of minimums and maximums. Sliding windows need no special handling:
+    each window is a difference of two prefix sums, i.e. new year added and old year dropped.
+    Gains are shifted by -1 (deltas) to keep variance sums small and precise.
+    Returns (portfolios x ranges) matrix for every AGGREGATE_ column.
+    '''
+    with numpy.errstate(divide='ignore'):
+        prefix_log = numpy.zeros((deltas.shape[0], deltas.shape[1] + 1))
+        numpy.cumsum(numpy.log1p(deltas), axis=1, out=prefix_log[:, 1:])
+    prefix_delta = numpy.zeros_like(prefix_log)
+    numpy.cumsum(deltas, axis=1, out=prefix_delta[:, 1:])
+    prefix_delta_sq = numpy.zeros_like(prefix_log)
+    numpy.cumsum(deltas ** 2, axis=1, out=prefix_delta_sq[:, 1:])
+    range_min, range_max = _range_extremes(deltas, starts, ends)
+    return (
+        prefix_log[:, ends + 1] - prefix_log[:, starts],
+        prefix_delta[:, ends + 1] - prefix_delta[:, starts],
+        prefix_delta_sq[:, ends + 1] - prefix_delta_sq[:, starts],
+        range_min,
+        range_max,
+    )
+
+
+def _range_values(aggregates: tuple, ranges_len: numpy.ndarray):
+    '''
+    Gain, pop, dip, CAGR and variance of every year range from its aggregates.
+    Variance from sums does not cancel out exactly: it may come out slightly negative,
+    or tiny instead of zero for constant gains, so it is clamped at zero and zeroed for ranges
+    of (nearly) constant gains, as variance of every gain around their CAGR is.
+    '''
+    log_gain, sum_delta, sum_delta_sq, range_min, range_max = aggregates
+    cagr = numpy.expm1(log_gain / ranges_len)
+    var = (sum_delta_sq - 2 * cagr * sum_delta + ranges_len * cagr ** 2) / (ranges_len - 1)
+    var = numpy.where(range_max - range_min > _CONSTANT_GAINS_SPREAD, numpy.maximum(var, 0), 0)
+    return numpy.exp(log_gain), numpy.maximum(range_max, 0), numpy.minimum(range_min, 0), cagr, var
+
+
+def partials_columns(open_ranges: numpy.ndarray):
+    return AGGREGATE_COLUMNS + AGGREGATE_COLUMNS * int(numpy.count_nonzero(open_ranges))
+
+
+def _partials(values: tuple, aggregates: tuple, open_ranges: numpy.ndarray):
+    '''
+    Partials of every portfolio: sums of range values (gain, pop, dip, CAGR, variance)
+    over closed ranges, i.e. not ending at last year, then aggregates of every open range.
+    Closed ranges never change when year is appended, open ones are extended by it.
+    '''
+    closed_sums = numpy.stack([numpy.sum(value[:, ~open_ranges], axis=1) for value in values], axis=1)
+    open_aggregates = numpy.stack([aggregate[:, open_ranges] for aggregate in aggregates], axis=2)
+    return numpy.concatenate([closed_sums, open_aggregates.reshape(len(closed_sums), -1)], axis=1)
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-positional-arguments
+def _stats_from_sums(sum_gain, sum_pop, sum_dip, sum_cagr, sum_var, ranges_n):
+    stats = numpy.empty((sum_gain.shape[0], STAT_COLUMNS))
+    stats[:, STAT_COLUMN_GAIN] = sum_gain / ranges_n
+    stats[:, STAT_COLUMN_POP_PERCENT] = sum_pop / ranges_n * 100
+    stats[:, STAT_COLUMN_DIP_PERCENT] = sum_dip / ranges_n * 100
+    stats[:, STAT_COLUMN_CAGR_PERCENT] = sum_cagr / ranges_n * 100
+    stats[:, STAT_COLUMN_VARIANCE] = sum_var / ranges_n
+    stats[:, STAT_COLUMN_STDDEV] = numpy.sqrt(stats[:, STAT_COLUMN_VARIANCE])
+    stddev = stats[:, STAT_COLUMN_STDDEV]
+    stats[:, STAT_COLUMN_SHARPE] = numpy.divide(
+        sum_cagr / ranges_n, stddev, out=numpy.zeros_like(stddev), where=stddev != 0)
+    return stats
+
+
+def _year_sums(values: numpy.ndarray, year_idxs: numpy.ndarray, years_n: int):
+    '''
+    (portfolios x years_n) sums of (portfolios x ranges) values of ranges grouped by year_idxs
+    '''
+    order = numpy.argsort(year_idxs, kind='stable')
+    group_years, group_offsets = numpy.unique(year_idxs[order], return_index=True)
+    sums = numpy.zeros((values.shape[0], years_n))
+    sums[:, group_years] = numpy.add.reduceat(values[:, order], group_offsets, axis=1)
+    return sums
+
+
+def range_year_sums(values: numpy.ndarray, starts: numpy.ndarray, ends: numpy.ndarray, years_n: int):
+    '''
+    (portfolios x years_n) sums of (portfolios x ranges) values of all ranges holding every year:
+    values are added at range starts and subtracted after range ends, so running sum over years
+    holds values of ranges open at every year, no (portfolios x ranges x years) arrays needed
+    '''
+    return numpy.cumsum(
+        _year_sums(values, starts, years_n + 1) - _year_sums(values, ends + 1, years_n + 1), axis=1)[:, :-1]
+
+
+def _aggregates_extended(aggregates: numpy.ndarray, delta: numpy.ndarray):
+    '''
+    Aggregates (portfolios x AGGREGATE_COLUMNS) of ranges extended by one year with given deltas
+    '''
+    extended = numpy.empty_like(aggregates)
+    extended[:, AGGREGATE_LOG_GAIN] = aggregates[:, AGGREGATE_LOG_GAIN] + numpy.log1p(delta)
+    extended[:, AGGREGATE_DELTA] = aggregates[:, AGGREGATE_DELTA] + delta
+    extended[:, AGGREGATE_DELTA_SQ] = aggregates[:, AGGREGATE_DELTA_SQ] + delta ** 2
+    extended[:, AGGREGATE_MIN] = numpy.minimum(aggregates[:, AGGREGATE_MIN], delta)
+    extended[:, AGGREGATE_MAX] = numpy.maximum(aggregates[:, AGGREGATE_MAX], delta)
+    return extended
+
+
+def simulate_weights(
+        weights: numpy.ndarray, returns: numpy.ndarray,
+        starts: numpy.ndarray, ends: numpy.ndarray,
+        open_ranges: numpy.ndarray = None):
+    '''
+    Stats matrix (portfolios x STAT_COLUMNS) for (portfolios x assets) matrix of weights in percent,
+    see simulate_annual_gains
+    '''
+    annual_gains = weights @ returns.T / 100
+    return simulate_annual_gains(annual_gains, starts, ends, open_ranges)
+
+
+class YearRangePlan:
+    '''
+    Market data and year ranges compiled once from year range selector,
+    shared by every simulation of every portfolio
+    '''
+    def __init__(self, year_range_selector_func: Callable, asset_gain_per_year: dict[str, list[float]]):
+        self.years, self.returns = returns_matrix(asset_gain_per_year)
+        self.starts, self.ends = year_range_indices(year_range_selector_func, self.years)
+        # ranges ending at last year, these change when year is appended
+        self.open_ranges = self.ends == len(self.years) - 1
+
+    @property
+    def partials_columns(self):
+        return partials_columns(self.open_ranges)
+
+    def range_years(self):
+        return [[self.years[start], self.years[end]] for start, end in zip(self.starts.tolist(), self.ends.tolist())]
+
+    def partials_layout(self):
+        '''
+        JSON-friendly description of partials, see appends_year_to
+        '''
+        range_years = self.range_years()
+        return {
+            'years': list(self.years),
+            'returns': self.returns.tolist(),
+            'open_ranges': [range_years[idx] for idx in numpy.flatnonzero(self.open_ranges)],
+            'closed_ranges': [range_years[idx] for idx in numpy.flatnonzero(~self.open_ranges)],
+        }
+
+    def appends_year_to(self, layout: dict):
+        '''
+        True if this plan is plan of partials layout with one more year of data appended,
+        so that partials of that plan can be extended by simulate_appended_year
+        '''
+        if list(self.years[:-1]) != layout['years'] or len(self.years) < 2:
+            return False
+        if self.returns[:-1].tolist() != layout['returns']:
+            return False
+        range_years = self.range_years()
+        previous_ranges = layout['open_ranges'] + layout['closed_ranges']
+        # closed sums are reused as a whole: all closed ranges must remain, nothing else may appear before last year
+        return all(range_years_pair in range_years for range_years_pair in layout['closed_ranges']) and all(
+            range_years_pair in previous_ranges
+            for range_years_pair in range_years if range_years_pair[1] != self.years[-1])
+
+    def adds_asset_to(self, layout: dict, asset_idx: int):
+        '''
+        True if this plan is plan of partials layout with asset number asset_idx added,
+        so that results of that plan are results of this one for allocations not holding it
+        '''
+        own_layout = self.partials_layout()
+        return all(own_layout[field] == layout[field] for field in ('years', 'open_ranges', 'closed_ranges')) \
+            and numpy.delete(self.returns, asset_idx, axis=1).tolist() == layout['returns']
+
+    def assets_reordered(self, order: list[int]):
+        '''
+        Same plan with assets (returns columns) in given order
+        '''
+        plan = copy.copy(self)
+        plan.returns = self.returns[:, order]
+        return plan
+
+    def simulate_appended_year(self, weights: numpy.ndarray, partials: numpy.ndarray, layout: dict):
+        '''
+        Stats and partials of portfolios from their partials in previous plan (see appends_year_to).
+        Open ranges of previous plan are extended by appended year or closed,
+        only ranges that could not be extended (e.g. sliding windows) are simulated from scratch.
+        '''
+        previous_open = [tuple(range_years_pair) for range_years_pair in layout['open_ranges']]
+        previous_aggregates = partials[:, AGGREGATE_COLUMNS:].reshape(
+            len(weights), len(previous_open), AGGREGATE_COLUMNS)
+        closed_sums = self._closed_sums(partials[:, :AGGREGATE_COLUMNS], previous_aggregates, previous_open)
+        open_idxs = numpy.flatnonzero(self.open_ranges)
+        open_aggregates = self._open_aggregates(weights, open_idxs, previous_aggregates, previous_open)
+        values = _range_values(
+            tuple(open_aggregates[:, :, column] for column in range(AGGREGATE_COLUMNS)),
+            self.ends[open_idxs] - self.starts[open_idxs] + 1)
+        stats = _stats_from_sums(
+            *(closed_sums[:, column] + numpy.sum(value, axis=1) for column, value in enumerate(values)),
+            len(self.starts))
+        return stats, numpy.concatenate([closed_sums, open_aggregates.reshape(len(weights), -1)], axis=1)
+
+    def _closed_sums(self, closed_sums: numpy.ndarray, previous_aggregates: numpy.ndarray, previous_open: list):
+        '''
+        Closed range sums of previous plan with its open ranges that this plan closes added up
+        '''
+        range_years = self.range_years()
+        closing = [idx for idx, range_years_pair in enumerate(previous_open) if list(range_years_pair) in range_years]
+        if not closing:
+            return closed_sums.copy()
+        values = _range_values(
+            tuple(previous_aggregates[:, closing, column] for column in range(AGGREGATE_COLUMNS)),
+            numpy.array([self._range_len(*previous_open[idx]) for idx in closing]))
+        return closed_sums + numpy.stack([numpy.sum(value, axis=1) for value in values], axis=1)
+
+    def _open_aggregates(
+            self, weights: numpy.ndarray, open_idxs: numpy.ndarray,
+            previous_aggregates: numpy.ndarray, previous_open: list):
+        '''
+        Aggregates of open ranges of this plan: open ranges of previous plan extended by appended year,
+        others simulated from scratch
+        '''
+        open_aggregates = numpy.empty((len(weights), len(open_idxs), AGGREGATE_COLUMNS))
+        delta = weights @ self.returns[-1] / 100 - 1
+        previous_last_year = self.years[-2]
+        for column, range_idx in enumerate(open_idxs):
+            extended = (self.years[self.starts[range_idx]], previous_last_year)
+            if extended in previous_open:
+                open_aggregates[:, column] = _aggregates_extended(
+                    previous_aggregates[:, previous_open.index(extended)], delta)
+            else:
+                annual_gains = weights @ self.returns[self.starts[range_idx]:].T / 100
+                aggregates = _range_aggregates(
+                    annual_gains - 1, numpy.array([0]), numpy.array([annual_gains.shape[1] - 1]))
+                open_aggregates[:, column] = numpy.concatenate(aggregates, axis=1)
+        return open_aggregates
+
+    def _range_len(self, year_start, year_end):
+        return self.years.index(year_end) - self.years.index(year_start) + 1
+
+    def range_year_sums(self, values: numpy.ndarray):
+        return range_year_sums(values, self.starts, self.ends, len(self.years))
+
+    def simulate_weights(self, weights: numpy.ndarray, partials: bool = False):
+        return simulate_weights(
+            weights, self.returns, self.starts, self.ends, self.open_ranges if partials else None)
+
+    def simulate_annual_gains(self, annual_gains: numpy.ndarray, partials: bool = False):
+        return simulate_annual_gains(
+            annual_gains, self.starts, self.ends, self.open_ranges if partials else None)
+
+    def simulate_walk(self, allocation: numpy.ndarray, moves: numpy.ndarray, step: int, partials: bool = False):
+        '''
+        Weights and stats (and partials if asked) of allocations reached from allocation
+        by (from, to) moves of one step, see data_source.allocation_walk. Annual gains are carried along the walk:
+        each move updates them by precomputed O(years) delta instead of O(years x assets) product.
+        '''
+        step_deltas = self.returns.T * step / 100
+        annual_gains = step_deltas[moves[:, 1]] - step_deltas[moves[:, 0]]
+        annual_gains[0] += allocation @ self.returns.T / 100
+        numpy.cumsum(annual_gains, axis=0, out=annual_gains)
+        weights = numpy.zeros((len(moves), len(allocation)), dtype=numpy.int32)
+        rows = numpy.arange(len(moves))
+        numpy.subtract.at(weights, (rows, moves[:, 0]), step)
+        numpy.add.at(weights, (rows, moves[:, 1]), step)
+        weights[0] += allocation
+        numpy.cumsum(weights, axis=0, out=weights)
+        if partials:
+            return (weights, *self.simulate_annual_gains(annual_gains, partials=True))
+        return weights, self.simulate_annual_gains(annual_gains)
+
+    def simulate_allocation_func(self, allocation_func: Callable):
+        '''
+        Stats of theoretical portfolio that gains allocation_func(gains of all assets) every year
+        '''
+        annual_gains = numpy.array([[allocation_func(year_gains) for year_gains in self.returns.tolist()]])
+        return self.simulate_annual_gains(annual_gains)
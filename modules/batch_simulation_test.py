@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+# Investment Portfolio Optimizer
+# Copyright (C) 2024  Vladimir Looze
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import math
+import functools
+import itertools
+import numpy
+import pytest
+from modules.portfolio import Portfolio
+from modules import batch_simulation
+from modules import data_filter
+from modules import data_source
+
+ASSET_GAIN_PER_YEAR = {
+    2000: [1.03, 1.04, 1.05, 1.06],
+    2001: [1.01, 1.01, 1.09, 1.10],
+    2002: [0.99, 1.09, 0.91, 1.01],
+    2003: [1.02, 1.02, 1.08, 1.12],
+    2004: [0.98, 1.08, 0.92, 1.03],
+    2005: [1.03, 1.03, 1.07, 1.14],
+    2006: [0.97, 1.07, 0.93, 1.05],
+    2007: [1.04, 1.04, 1.06, 1.16],
+    2008: [0.98, 1.06, 0.94, 1.07],
+    2009: [1.05, 1.05, 1.05, 1.18],
+    2010: [0.99, 1.04, 0.95, 1.09],
+    2011: [1.06, 1.06, 1.04, 1.20],
+    2012: [1.00, 1.03, 0.96, 1.09],
+    2013: [1.07, 1.07, 1.03, 1.21],
+    2014: [1.01, 1.02, 0.97, 1.09],
+    2015: [1.08, 1.08, 1.02, 1.22],
+}
+
+
+def reference_stats(year_selector_func, asset_gain_per_year, annual_gain_func):
+    '''
+    straightforward per-range simulation, one portfolio at a time
+    '''
+    years = list(asset_gain_per_year.keys())
+    stats_per_range = []
+    for year_start, year_end in year_selector_func(sorted(years)):
+        annual_gains = [
+            annual_gain_func(asset_gain_per_year[year])
+            for year in years[years.index(year_start):years.index(year_end) + 1]
+        ]
+        gain = math.prod(annual_gains)
+        cagr = gain ** (1 / len(annual_gains)) - 1
+        stats_per_range.append((
+            gain,
+            max(max(annual_gains) - 1, 0),
+            min(min(annual_gains) - 1, 0),
+            cagr,
+            sum((ag - cagr - 1) ** 2 for ag in annual_gains) / (len(annual_gains) - 1),
+        ))
+    gain, pop, dip, cagr, var = (sum(values) / len(stats_per_range) for values in zip(*stats_per_range))
+    return [gain, pop * 100, dip * 100, cagr * 100, var, var ** 0.5, cagr / var ** 0.5 if var else 0]
+
+
+def assert_reference_stats(year_selector_func, asset_gain_per_year, allocations, stats, epsilon=1e-9):
+    '''
+    Every row of stats matches reference_stats of allocation in percent at same row
+    '''
+    for allocation, allocation_stats in zip(allocations, stats):
+        expected_stats = reference_stats(
+            year_selector_func, asset_gain_per_year,
+            functools.partial(lambda gains, allocation: math.sumprod(gains, allocation) / 100, allocation=allocation))
+        for expected, value in zip(expected_stats, allocation_stats):
+            assert abs(expected - value) < epsilon
+
+
+@pytest.mark.parametrize('year_selector_func', [
+    data_filter.years_first_to_last,
+    data_filter.years_first_to_all,
+    functools.partial(data_filter.years_sliding_window, window_size=1),
+    functools.partial(data_filter.years_sliding_window, window_size=3),
+    functools.partial(data_filter.years_sliding_window, window_size=10),
+    data_filter.years_all_to_last,
+    data_filter.years_all_to_all,
+])
+def test_simulate_weights(year_selector_func):
+    assets = ['AAPL', 'MSFT', 'GOOG', 'AMZN']
+    allocations = list(data_source.all_possible_allocations(len(assets), 10))
+    years, returns = batch_simulation.returns_matrix(ASSET_GAIN_PER_YEAR)
+    starts, ends = batch_simulation.year_range_indices(year_selector_func, years)
+    stats = batch_simulation.simulate_weights(numpy.array(allocations), returns, starts, ends)
+    assert_reference_stats(year_selector_func, ASSET_GAIN_PER_YEAR, allocations, stats)
+
+
+def test_serialize_batch_matches_serialize():
+    assets = ['AAPL', 'MSFT', 'GOOG']
+    weights = numpy.array(list(itertools.islice(data_source.all_possible_allocations(len(assets), 5), 50)))
+    stats = numpy.arange(len(weights) * batch_simulation.STAT_COLUMNS, dtype=numpy.float64) \
+        .reshape(len(weights), batch_simulation.STAT_COLUMNS) / 7
+    portfolios = []
+    for allocation, allocation_stats in zip(weights, stats):
+        portfolio = Portfolio(assets=assets, weights=allocation.tolist())
+        portfolio.stat = dict(zip(Portfolio.STATS, allocation_stats.tolist()))
+        portfolios.append(portfolio)
+    serialized_batch = Portfolio.serialize_batch(stats, weights)
+    assert len(serialized_batch) == sum(len(p.serialize()) for p in portfolios)
+    batch_stats, batch_weights, _ = Portfolio.batch_columns(serialized_batch, len(assets))
+    assert batch_stats.shape == (len(Portfolio.STATS), len(weights))
+    assert (batch_weights.T == weights).all()
+    assert [p.serialize() for p in Portfolio.deserialize_iter(serialized_batch, assets)] == \
+        [p.serialize() for p in portfolios]
+
+
+@pytest.mark.parametrize('year_selector_func', [
+    functools.partial(data_filter.years_sliding_window, window_size=12),
+    data_filter.years_all_to_all,
+])
+def test_simulate_weights_long_history(year_selector_func):
+    assets = ['AAPL', 'MSFT', 'GOOG']
+    rng = numpy.random.default_rng(seed=42)
+    asset_gain_per_year = {
+        str(month): list(rng.uniform(0.8, 1.25, size=len(assets))) for month in range(100, 220)
+    }
+    allocations = list(data_source.all_possible_allocations(len(assets), 25))
+    years, returns = batch_simulation.returns_matrix(asset_gain_per_year)
+    starts, ends = batch_simulation.year_range_indices(year_selector_func, years)
+    stats = batch_simulation.simulate_weights(numpy.array(allocations), returns, starts, ends)
+    assert_reference_stats(year_selector_func, asset_gain_per_year, allocations, stats)
+
+
+@pytest.mark.parametrize('allocation_func', [min, max])
+@pytest.mark.parametrize('year_selector_func', [
+    data_filter.years_first_to_last,
+    data_filter.years_all_to_all,
+])
+def test_plan_simulate_allocation_func(year_selector_func, allocation_func):
+    epsilon = 1e-9
+    plan = batch_simulation.YearRangePlan(year_selector_func, ASSET_GAIN_PER_YEAR)
+    stats = plan.simulate_allocation_func(allocation_func)
+    expected_stats = reference_stats(year_selector_func, ASSET_GAIN_PER_YEAR, allocation_func)
+    for expected, value in zip(expected_stats, stats[0]):
+        assert abs(expected - value) < epsilon
+
+
+@pytest.mark.parametrize('year_selector_func', [
+    data_filter.years_first_to_last,
+    data_filter.years_all_to_all,
+])
+def test_plan_simulate_walk(year_selector_func):
+    epsilon = 1e-9
+    assets_n, step = 4, 5
+    plan = batch_simulation.YearRangePlan(year_selector_func, ASSET_GAIN_PER_YEAR)
+    for allocation, moves in data_source.allocation_walk_blocks(assets_n, step, 100, 1000, 64):
+        weights, stats = plan.simulate_walk(allocation, moves, step)
+        expected_weights = []
+        for move_from, move_to in moves:
+            allocation = allocation.copy()
+            allocation[move_from] -= step
+            allocation[move_to] += step
+            expected_weights.append(allocation.tolist())
+        assert weights.tolist() == expected_weights
+        assert numpy.all(numpy.abs(stats - plan.simulate_weights(weights)) < epsilon)
+
+
+@pytest.mark.parametrize('year_selector_func', [
+    data_filter.years_first_to_last,
+    data_filter.years_first_to_all,
+    functools.partial(data_filter.years_sliding_window, window_size=3),
+    data_filter.years_all_to_last,
+    data_filter.years_all_to_all,
+])
+def test_plan_simulate_appended_year(year_selector_func):
+    epsilon = 1e-9
+    weights = numpy.array(list(data_source.all_possible_allocations(4, 10)))
+    years = list(ASSET_GAIN_PER_YEAR.keys())
+    plans = [
+        batch_simulation.YearRangePlan(
+            year_selector_func, {year: ASSET_GAIN_PER_YEAR[year] for year in years[:years_n]})
+        for years_n in (len(years) - 2, len(years) - 1, len(years))]
+    _, partials = plans[0].simulate_weights(weights, partials=True)
+    assert partials.shape == (len(weights), plans[0].partials_columns)
+    assert not plans[0].appends_year_to(plans[0].partials_layout())
+    assert not plans[2].appends_year_to(plans[0].partials_layout())
+    for previous_plan, plan in zip(plans, plans[1:]):
+        assert plan.appends_year_to(previous_plan.partials_layout())
+        stats, partials = plan.simulate_appended_year(weights, partials, previous_plan.partials_layout())
+        expected_stats, expected_partials = plan.simulate_weights(weights, partials=True)
+        assert numpy.all(numpy.abs(stats - expected_stats) < epsilon)
+        assert numpy.all(numpy.abs(partials - expected_partials) < epsilon)
+
+
+@pytest.mark.parametrize('year_selector_func', [
+    data_filter.years_first_to_last,
+    functools.partial(data_filter.years_sliding_window, window_size=3),
+    data_filter.years_all_to_all,
+])
+def test_plan_range_year_sums(year_selector_func):
+    plan = batch_simulation.YearRangePlan(year_selector_func, ASSET_GAIN_PER_YEAR)
+    values = numpy.random.default_rng(seed=3).uniform(size=(3, len(plan.starts)))
+    holding = (plan.starts[:, numpy.newaxis] <= numpy.arange(len(plan.years))) & \
+        (numpy.arange(len(plan.years)) <= plan.ends[:, numpy.newaxis])
+    assert numpy.allclose(plan.range_year_sums(values), values @ holding)
+
+
+@pytest.mark.parametrize('constant_gain', [1.0123, 1.03])
+@pytest.mark.parametrize('year_selector_func', [
+    data_filter.years_first_to_last,
+    data_filter.years_all_to_all,
+])
+def test_constant_gain_stats(constant_gain, year_selector_func):
+    # variance from range sums must not leave rounding errors behind for constant gains:
+    # they turned Stddev and Sharpe into NaN or huge values
+    gain_per_year = {year: [constant_gain, *gains[1:]] for year, gains in ASSET_GAIN_PER_YEAR.items()}
+    plan = batch_simulation.YearRangePlan(year_selector_func, gain_per_year)
+    weights = numpy.array(list(data_source.all_possible_allocations(4, 10)))
+    stats = plan.simulate_weights(weights)
+    for allocation, allocation_stats in zip(weights.tolist(), stats):
+        expected_stats = reference_stats(
+            year_selector_func, gain_per_year,
+            functools.partial(lambda gains, allocation: math.sumprod(gains, allocation) / 100, allocation=allocation))
+        assert numpy.allclose(allocation_stats, expected_stats, rtol=1e-6, atol=1e-9)
+    constant_stats = stats[weights[:, 0] == 100][0]
+    assert constant_stats[Portfolio.STATS.index(Portfolio.STAT_VARIANCE)] == 0
+    assert constant_stats[Portfolio.STATS.index(Portfolio.STAT_SHARPE)] == 0
+    for allocation, moves in data_source.allocation_walk_blocks(4, 5, 0, 1771, 64):
+        _, walk_stats = plan.simulate_walk(allocation, moves, 5)
+        assert not numpy.isnan(walk_stats).any()
+        assert (walk_stats[:, Portfolio.STATS.index(Portfolio.STAT_VARIANCE)] >= 0).all()
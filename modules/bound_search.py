@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+
+# Investment Portfolio Optimizer
+# Copyright (C) 2024  Vladimir Looze
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import operator
+import numpy
+from modules.portfolio import Portfolio
+from modules.data_filter import TopFilter
+from modules.batch_simulation import YearRangePlan
+from modules.allocation_constraints import AllocationConstraints
+
+# stats that never decrease when gain of any year increases, all of them are maximized
+BOUNDED_STATS = (
+    Portfolio.STAT_GAIN,
+    Portfolio.STAT_POP_PERCENT,
+    Portfolio.STAT_DIP_PERCENT,
+    Portfolio.STAT_CAGR_PERCENT,
+)
+
+
+# stats concave in weights: CAGR of every range is geometric mean of annual gains, Dip is their minimum
+CONCAVE_STATS = (
+    Portfolio.STAT_DIP_PERCENT,
+    Portfolio.STAT_CAGR_PERCENT,
+)
+# Frank-Wolfe iterations of concave stats bounds, see _Bounds.concave
+_CONCAVE_BOUND_ITERATIONS = 12
+# growth of Lagrange multiplier of floor per percent of floor violation, see _Bounds.concave
+_MULTIPLIER_STEP = 0.05
+
+
+class _Bounds:
+    '''
+    Stats bounds of allocations below tree nodes. Annual gains are linear in weights:
+    below allocation of first assets, every year gains at most (least) what these assets gain
+    plus remaining weight times best (worst) return of remaining assets. Bounded stats never decrease
+    with gain of any year, so stats of such extreme years bound stats of every allocation below.
+    '''
+    def __init__(self, plan: YearRangePlan):
+        self._plan = plan
+        self._ranges_len = (plan.ends - plan.starts + 1).astype(numpy.float64)
+        # ranges covered by two intervals of sparse table level, see _range_argmins
+        range_levels = numpy.frexp(plan.ends - plan.starts + 1)[1] - 1
+        self._range_levels = []
+        for level in numpy.unique(range_levels):
+            ranges = numpy.flatnonzero(range_levels == level)
+            self._range_levels.append((level, ranges, plan.starts[ranges], plan.ends[ranges] - (1 << level) + 1))
+        # best and worst return of assets from every index on, (assets + 1 x years), last row for no assets
+        returns = plan.returns.T
+        self.best = numpy.vstack((numpy.maximum.accumulate(returns[::-1])[::-1], numpy.zeros(returns.shape[1])))
+        self.worst = numpy.vstack((numpy.minimum.accumulate(returns[::-1])[::-1], numpy.zeros(returns.shape[1])))
+
+    def stats(self, gains: numpy.ndarray, remaining: numpy.ndarray, asset_idx: int, upper: bool):
+        '''
+        Upper (lower) bounds of stats for (nodes x years) annual gains of allocated weights in percent
+        and remaining weights in percent of every node, to allocate among assets from asset_idx on
+        '''
+        rest = self.best[asset_idx] if upper else self.worst[asset_idx]
+        return self._plan.simulate_annual_gains((gains + remaining[:, numpy.newaxis] * rest) / 100)
+
+    def _range_argmins(self, values: numpy.ndarray):
+        '''
+        (nodes x ranges) year indices of minimum of (nodes x years) values in every range,
+        from sparse table of such indices, see batch_simulation._range_extremes
+        '''
+        nodes = numpy.arange(values.shape[0])[:, numpy.newaxis]
+        table = [numpy.broadcast_to(numpy.arange(values.shape[1]), values.shape)]
+        for level in range(1, values.shape[1].bit_length()):
+            half = 1 << (level - 1)
+            left, right = table[-1][:, :-half], table[-1][:, half:]
+            table.append(numpy.where(values[nodes, right] < values[nodes, left], right, left))
+        argmins = numpy.empty((values.shape[0], len(self._ranges_len)), dtype=numpy.intp)
+        for level, ranges, left, right in self._range_levels:
+            left_idxs, right_idxs = table[level][:, left], table[level][:, right]
+            argmins[:, ranges] = numpy.where(
+                values[nodes, right_idxs] < values[nodes, left_idxs], right_idxs, left_idxs)
+        return argmins
+
+    def _cagr_gradient(self, annual_gains: numpy.ndarray, returns: numpy.ndarray):
+        '''
+        CAGR in percent and its gradient by weights in percent of assets with (years x assets) returns,
+        for (nodes x years) annual gains
+        '''
+        starts, ends = self._plan.starts, self._plan.ends
+        prefix_log = numpy.zeros((annual_gains.shape[0], annual_gains.shape[1] + 1))
+        numpy.cumsum(numpy.log(annual_gains), axis=1, out=prefix_log[:, 1:])
+        range_gains = numpy.exp((prefix_log[:, ends + 1] - prefix_log[:, starts]) / self._ranges_len)
+        # derivative of every range by its annual gains spreads evenly over its years
+        year_slopes = self._plan.range_year_sums(range_gains / self._ranges_len / len(starts))
+        gradient = (year_slopes / annual_gains) @ returns
+        return numpy.mean(range_gains - 1, axis=1) * 100, gradient
+
+    def _dip_gradient(self, annual_gains: numpy.ndarray, returns: numpy.ndarray):
+        '''
+        Dip in percent and its supergradient by weights in percent of assets with (years x assets) returns,
+        for (nodes x years) annual gains: every range with dip moves with its worst year
+        '''
+        deltas = annual_gains - 1
+        argmins = self._range_argmins(deltas)
+        range_dips = numpy.minimum(numpy.take_along_axis(deltas, argmins, axis=1), 0)
+        nodes_n, years_n = annual_gains.shape
+        year_slopes = numpy.bincount(
+            (numpy.arange(nodes_n)[:, numpy.newaxis] * years_n + argmins).ravel(),
+            weights=((range_dips < 0) / len(self._ranges_len)).ravel(), minlength=nodes_n * years_n)
+        return numpy.mean(range_dips, axis=1) * 100, year_slopes.reshape(nodes_n, years_n) @ returns
+
+    def _concave_gradient(self, stat: str, annual_gains: numpy.ndarray, returns: numpy.ndarray):
+        if stat == Portfolio.STAT_CAGR_PERCENT:
+            return self._cagr_gradient(annual_gains, returns)
+        return self._dip_gradient(annual_gains, returns)
+
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-positional-arguments
+    # pylint: disable=too-many-locals
+    def concave(
+            self, stat: str, floors: list[tuple[str, float]],
+            gains: numpy.ndarray, remaining: numpy.ndarray, asset_idx: int, threshold: float = None):
+        '''
+        Upper bounds of concave stat among allocations below nodes (see stats) that keep
+        (stat, floor) floors of concave stats, tighter than stats bounds. Concave function lies below
+        its tangent at any allocation, tangent is highest where all remaining weight goes to asset
+        of largest gradient: that is Frank-Wolfe duality gap, and its iterations move tangent point
+        towards best continuous allocation of remaining weight. Floors enter as Lagrangian:
+        stat plus multiplier times (floor stat - floor) is concave too and is not below stat where floor holds,
+        for any non-negative multiplier, so multipliers grow while floors are violated at tangent points.
+        Nodes stop iterating once their bound is not above threshold.
+        '''
+        returns = self._plan.returns[:, asset_idx:]
+        rest_weights = numpy.repeat(remaining[:, numpy.newaxis] / returns.shape[1], returns.shape[1], axis=1)
+        multipliers = numpy.zeros((len(remaining), len(floors)))
+        bounds = numpy.full(len(remaining), numpy.inf)
+        nodes = numpy.arange(len(remaining))
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            for iteration in range(_CONCAVE_BOUND_ITERATIONS):
+                annual_gains = (gains[nodes] + rest_weights[nodes] @ returns.T) / 100
+                lagrangian, gradient = self._concave_gradient(stat, annual_gains, returns)
+                for floor_idx, (floor_stat, floor) in enumerate(floors):
+                    floor_value, floor_gradient = self._concave_gradient(floor_stat, annual_gains, returns)
+                    node_multipliers = multipliers[nodes, floor_idx]
+                    lagrangian = lagrangian + node_multipliers * (floor_value - floor)
+                    gradient = gradient + node_multipliers[:, numpy.newaxis] * floor_gradient
+                    multipliers[nodes, floor_idx] = numpy.maximum(
+                        node_multipliers + _MULTIPLIER_STEP * (floor - floor_value), 0)
+                best_idxs = numpy.argmax(gradient, axis=1)
+                node_remaining = remaining[nodes]
+                gap = node_remaining * gradient[numpy.arange(len(nodes)), best_idxs] - \
+                    numpy.sum(gradient * rest_weights[nodes], axis=1)
+                # non-positive annual gains leave no tangent, such nodes keep infinite bound
+                bounds[nodes] = numpy.fmin(
+                    bounds[nodes], numpy.where(numpy.isfinite(gap), lagrangian + gap, numpy.inf))
+                rest_weights[nodes] *= 1 - 2 / (iteration + 2)
+                rest_weights[nodes, best_idxs] += node_remaining * 2 / (iteration + 2)
+                if threshold is not None:
+                    nodes = nodes[bounds[nodes] > threshold]
+                    if len(nodes) == 0:
+                        break
+        return bounds
+
+
+# nodes popped from search stack at once, their children are bounded together to amortize numpy calls
+_BATCH_NODES = 64
+# most allocations of coarser step simulated up front to find allocations to prune with, see _seed_step
+_SEED_ALLOCATIONS = 2**12
+
+
+def _seed_step(percentage_step: int, constraints: AllocationConstraints):
+    '''
+    Finest step that is multiple of percentage_step, so its allocations are among searched ones,
+    having up to _SEED_ALLOCATIONS allocations satisfying constraints, None if there is no such step
+    '''
+    for step in range(percentage_step, 101, percentage_step):
+        if 100 % step == 0 and constraints.allocations_count(step) <= _SEED_ALLOCATIONS:
+            return step
+    return None
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-positional-arguments
+# pylint: disable=too-many-locals
+# pylint: disable=too-many-branches
+# pylint: disable=too-many-statements
+def best_allocations(
+        plan: YearRangePlan, assets: list[str], percentage_step: int, stat: str, k: int = 1,
+        predicates: list[tuple] = (), constraints: AllocationConstraints = None):
+    '''
+    K best allocations by stat among ones matching predicates (see data_filter.TopFilter), exactly,
+    by depth-first branch and bound through allocation tree (see AllocationConstraints.tree_children):
+    subtrees whose stat bound (see _Bounds) cannot beat k-th best allocation found so far,
+    or whose bounds fail predicates on bounded stats, are pruned without simulating them.
+    Returns TopFilter result and counters of nodes expanded and pruned,
+    allocations in pruned subtrees and allocations simulated.
+    '''
+    if stat not in BOUNDED_STATS:
+        raise ValueError(f'cannot bound {stat}, expected one of: {", ".join(BOUNDED_STATS)}')
+    top_filter = TopFilter(stat, k, predicates, assets)
+    constraints = constraints or AllocationConstraints(len(assets))
+    bounds = _Bounds(plan)
+    stat_idx = Portfolio.STATS.index(stat)
+    # lower limits of concave stats bound concave target tighter, see _Bounds.concave
+    floors = [
+        (column, value) for column, predicate_func, value in predicates
+        if column in CONCAVE_STATS and predicate_func in (operator.gt, operator.ge)]
+    # lower (upper) limits of bounded stats can hold below node only if they hold for its upper (lower) bounds
+    upper_predicates = [
+        (Portfolio.STATS.index(column), predicate_func, value) for column, predicate_func, value in predicates
+        if column in BOUNDED_STATS and predicate_func in (operator.gt, operator.ge)]
+    lower_predicates = [
+        (Portfolio.STATS.index(column), predicate_func, value) for column, predicate_func, value in predicates
+        if column in BOUNDED_STATS and predicate_func in (operator.lt, operator.le)]
+    counters = {'expanded': 0, 'pruned': 0, 'pruned_allocations': 0, 'simulated': 0}
+
+    def _pruned(state: tuple):
+        counters['pruned'] += 1
+        counters['pruned_allocations'] += constraints.tree_count(percentage_step, state)
+
+    # allocations of coarser step give threshold before search reaches its first leaves
+    seed_step = _seed_step(percentage_step, constraints)
+    seeded = set()
+    if seed_step is not None:
+        seed_n = constraints.allocations_count(seed_step)
+        for weights in constraints.allocation_blocks(seed_step, 0, seed_n, seed_n):
+            top_filter.add(plan.simulate_weights(weights), weights)
+            seeded.update(map(tuple, weights.tolist()))
+        counters['simulated'] += seed_n
+
+    # stack of (stat bound, allocated weights, their annual gains in percent, tree state)
+    stack = [(numpy.inf, (), numpy.zeros(len(plan.years)), constraints.tree_root(percentage_step))]
+    while stack:
+        threshold = top_filter.threshold()
+        # dive into most promising nodes one by one until there is threshold to prune with
+        batch_nodes_n = _BATCH_NODES if threshold is not None else 1
+        batch = stack[-batch_nodes_n:]
+        del stack[-batch_nodes_n:]
+        leaves = []
+        # children of expanded nodes by index of their next asset
+        children = {}
+        for bound, prefix, gains, state in batch:
+            if threshold is not None and bound <= threshold:
+                _pruned(state)
+                continue
+            counters['expanded'] += 1
+            asset_idx = state[0]
+            for weight, child_state in constraints.tree_children(percentage_step, state):
+                if asset_idx >= len(assets) - 2:
+                    # child is single allocation: last asset, if any, takes remaining weight
+                    leaves.append(prefix + (weight,) + (
+                        (child_state[1] * percentage_step,) if asset_idx == len(assets) - 2 else ()))
+                else:
+                    children.setdefault(asset_idx + 1, []).append((
+                        prefix + (weight,), gains + weight * plan.returns[:, asset_idx], child_state))
+        leaves = [leaf for leaf in leaves if leaf not in seeded]
+        if leaves:
+            weights = numpy.array(leaves, dtype=numpy.int32)
+            top_filter.add(plan.simulate_weights(weights), weights)
+            counters['simulated'] += len(weights)
+            threshold = top_filter.threshold()
+        pushed = []
+        for child_asset_idx, asset_children in children.items():
+            child_gains = numpy.array([gains for _, gains, _ in asset_children])
+            child_remaining = numpy.array([state[1] * percentage_step for _, _, state in asset_children])
+            upper_stats = bounds.stats(child_gains, child_remaining, child_asset_idx, upper=True)
+            if stat in CONCAVE_STATS:
+                upper_stats[:, stat_idx] = numpy.fmin(
+                    upper_stats[:, stat_idx],
+                    bounds.concave(stat, floors, child_gains, child_remaining, child_asset_idx, threshold))
+            passed = numpy.ones(len(asset_children), dtype=bool)
+            if threshold is not None:
+                passed &= upper_stats[:, stat_idx] > threshold
+            for column_idx, predicate_func, value in upper_predicates:
+                passed &= predicate_func(upper_stats[:, column_idx], value)
+            if lower_predicates:
+                lower_stats = bounds.stats(child_gains, child_remaining, child_asset_idx, upper=False)
+                for column_idx, predicate_func, value in lower_predicates:
+                    passed &= predicate_func(lower_stats[:, column_idx], value)
+            for child_idx, (prefix, gains, state) in enumerate(asset_children):
+                if passed[child_idx]:
+                    pushed.append((upper_stats[child_idx, stat_idx], prefix, gains, state))
+                else:
+                    _pruned(state)
+        # most promising children are popped first
+        pushed.sort(key=lambda child: child[0])
+        stack.extend(pushed)
+    return top_filter.result(), counters
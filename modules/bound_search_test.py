@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# Investment Portfolio Optimizer
+# Copyright (C) 2024  Vladimir Looze
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import operator
+import numpy
+import pytest
+from modules import data_filter
+from modules import data_source
+from modules import bound_search
+from modules.portfolio import Portfolio
+from modules.batch_simulation import YearRangePlan
+from modules.allocation_constraints import AllocationConstraints
+
+ASSETS = ['A', 'B', 'C', 'D', 'E']
+
+
+def _plan(year_range_selector_func=data_filter.years_all_to_all):
+    rng = numpy.random.default_rng(seed=7)
+    return YearRangePlan(
+        year_range_selector_func,
+        {str(year): list(rng.uniform(0.75, 1.35, size=len(ASSETS))) for year in range(2000, 2012)})
+
+
+def _expected(plan: YearRangePlan, step: int, top_filter: data_filter.TopFilter, constraints=None):
+    portfolios_n = data_source.allocations_count(len(ASSETS), step)
+    [(weights, stats, _, _)] = data_source.simulated_allocation_blocks(
+        plan, 0, portfolios_n, len(ASSETS), step, portfolios_n)
+    if constraints is not None:
+        satisfied = constraints.satisfied(weights)
+        weights, stats = weights[satisfied], stats[satisfied]
+    top_filter.add(stats, weights)
+    return top_filter.result()
+
+
+@pytest.mark.parametrize('stat', bound_search.BOUNDED_STATS)
+@pytest.mark.parametrize('predicates', [
+    [],
+    [(Portfolio.STAT_DIP_PERCENT, operator.ge, -12.0)],
+    [(Portfolio.STAT_CAGR_PERCENT, operator.gt, 4.0), (Portfolio.STAT_POP_PERCENT, operator.le, 30.0)],
+    [(Portfolio.STAT_STDDEV, operator.lt, 0.1), ('A', operator.ge, 20)],
+])
+@pytest.mark.parametrize('step, k', [(10, 1), (5, 7)])
+def test_best_allocations(stat: str, predicates: list, step: int, k: int):
+    plan = _plan()
+    result, counters = bound_search.best_allocations(plan, ASSETS, step, stat, k, predicates)
+    expected = _expected(plan, step, data_filter.TopFilter(stat, k, predicates, ASSETS))
+    stat_idx = Portfolio.STATS.index(stat)
+    assert len(result[0]) == len(expected[0])
+    assert numpy.allclose(result[0][:, stat_idx], expected[0][:, stat_idx])
+    assert len(set(map(tuple, result[1].tolist()))) == len(result[1])
+    assert numpy.allclose(result[0], plan.simulate_weights(result[1]))
+    assert counters['pruned'] > 0
+    assert counters['simulated'] + counters['pruned_allocations'] >= data_source.allocations_count(len(ASSETS), step)
+
+
+def test_best_allocations_constraints():
+    plan = _plan(data_filter.years_first_to_all)
+    constraints = AllocationConstraints.from_config(
+        {'min': {'B': 10}, 'max': {'C': 30}, 'max_assets': 3, 'groups': [{'assets': ['D', 'E'], 'max': 40}]}, ASSETS)
+    predicates = [(Portfolio.STAT_DIP_PERCENT, operator.ge, -15.0)]
+    result, _ = bound_search.best_allocations(
+        plan, ASSETS, 5, Portfolio.STAT_CAGR_PERCENT, 5, predicates, constraints)
+    expected = _expected(
+        plan, 5, data_filter.TopFilter(Portfolio.STAT_CAGR_PERCENT, 5, predicates, ASSETS), constraints)
+    assert numpy.allclose(result[0], expected[0])
+    assert constraints.satisfied(result[1]).all()
+
+
+def test_best_allocations_fine_step():
+    plan = _plan()
+    predicates = [(Portfolio.STAT_DIP_PERCENT, operator.ge, -12.0)]
+    result, counters = bound_search.best_allocations(plan, ASSETS, 2, Portfolio.STAT_CAGR_PERCENT, 1, predicates)
+    expected = _expected(plan, 2, data_filter.TopFilter(Portfolio.STAT_CAGR_PERCENT, 1, predicates, ASSETS))
+    assert numpy.array_equal(result[1], expected[1])
+    # most leaves are never simulated
+    assert counters['simulated'] < data_source.allocations_count(len(ASSETS), 2) // 100
+
+
+def test_best_allocations_invalid():
+    with pytest.raises(ValueError):
+        bound_search.best_allocations(_plan(), ASSETS, 10, Portfolio.STAT_SHARPE)
+    with pytest.raises(ValueError):
+        bound_search.best_allocations(
+            _plan(), ASSETS, 10, Portfolio.STAT_CAGR_PERCENT, predicates=[('F', operator.gt, 0)])
+    result, _ = bound_search.best_allocations(
+        _plan(), ASSETS, 10, Portfolio.STAT_CAGR_PERCENT, predicates=[(Portfolio.STAT_DIP_PERCENT, operator.gt, 1.0)])
+    assert len(result[0]) == 0
@@ -16,19 +16,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from pickle import dumps
-from importlib import import_module
-from multiprocessing.connection import Connection
-from concurrent.futures import wait as futures_wait
-from concurrent.futures import ThreadPoolExecutor
-from functools import partial
+from collections.abc import Callable
+import numpy
 from modules.portfolio import Portfolio
-from modules.data_source import DataStreamFinished
 
 
 class PortfolioXYTuplePoint(tuple):
     def __new__(cls, portfolio: Portfolio, coord_pair: tuple[str, str]):
-        return super().__new__(cls, (portfolio.stat[coord_pair[0]], portfolio.stat[coord_pair[1]]))
+        return super().__new__(cls, (
+            portfolio.stats[Portfolio.STATS.index(coord_pair[0])],
+            portfolio.stats[Portfolio.STATS.index(coord_pair[1])]))
 
     def __init__(self, portfolio: Portfolio, coord_pair: tuple[str, str]):
         self._portfolio = portfolio
@@ -38,24 +35,78 @@ class PortfolioXYTuplePoint(tuple):
         return self._portfolio
 
 
+def _cross(origin: tuple[float, float], first: tuple[float, float], second: tuple[float, float]):
+    return (first[0] - origin[0]) * (second[1] - origin[1]) - (first[1] - origin[1]) * (second[0] - origin[0])
+
+
+def _monotone_chain(xs: list[float], ys: list[float]):
+    '''
+    Positions of convex hull vertices of points sorted by x then y, collinear points are not vertices
+    '''
+    points = list(zip(xs, ys))
+    hull_positions = []
+    for positions in (range(len(xs)), range(len(xs) - 1, -1, -1)):
+        chain = []
+        for position in positions:
+            while len(chain) >= 2 and _cross(points[chain[-2]], points[chain[-1]], points[position]) <= 0:
+                chain.pop()
+            chain.append(position)
+        hull_positions.extend(chain[:-1])
+    return list(dict.fromkeys(hull_positions))
+
+
+def _hull_candidates(xs: numpy.ndarray, ys: numpy.ndarray):
+    '''
+    Mask of points that are not strictly inside polygon of extreme points in 8 directions
+    (Akl-Toussaint heuristic): only these can be convex hull vertices
+    '''
+    directions = numpy.array([[-1, 0], [-1, -1], [0, -1], [1, -1], [1, 0], [1, 1], [0, 1], [-1, 1]])
+    extremes = numpy.argmax(directions @ numpy.vstack((xs, ys)), axis=1)
+    # support points of directions in angular order go counterclockwise, drop repeated ones
+    extremes = [extreme for extreme_idx, extreme in enumerate(extremes) if extreme != extremes[extreme_idx - 1]]
+    candidates = numpy.zeros(len(xs), dtype=bool)
+    if len(extremes) < 3:
+        candidates[:] = True
+        return candidates
+    for start, end in zip(extremes, extremes[1:] + extremes[:1]):
+        candidates |= (xs[end] - xs[start]) * (ys - ys[start]) - (ys[end] - ys[start]) * (xs - xs[start]) <= 0
+    return candidates
+
+
+def convex_hull_layers_indices(points, hull_layers: int):
+    '''
+    Indices of points on first hull_layers convex hull layers (onion peeling), outer layer first.
+    Points are sorted once, every layer is monotone chain over points that may be on it,
+    and its vertices are dropped from sorted arrays by mask.
+    '''
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+    remaining_idxs = numpy.lexsort((points[:, 1], points[:, 0]))
+    remaining_xs = points[remaining_idxs, 0]
+    remaining_ys = points[remaining_idxs, 1]
+    layers_idxs = []
+    for _ in range(hull_layers):
+        if len(remaining_idxs) <= 3:
+            layers_idxs.extend(remaining_idxs.tolist())
+            break
+        candidates = numpy.flatnonzero(_hull_candidates(remaining_xs, remaining_ys))
+        hull_positions = candidates[_monotone_chain(
+            remaining_xs[candidates].tolist(), remaining_ys[candidates].tolist())]
+        layers_idxs.extend(remaining_idxs[hull_positions].tolist())
+        remaining = numpy.ones(len(remaining_idxs), dtype=bool)
+        remaining[hull_positions] = False
+        remaining_idxs = remaining_idxs[remaining]
+        remaining_xs = remaining_xs[remaining]
+        remaining_ys = remaining_ys[remaining]
+    return layers_idxs
+
+
 def multilayer_convex_hull(point_batch: list[PortfolioXYTuplePoint] = None, hull_layers: int = 1, edge_layers: int = 0):
-    pyhull_convex_hull = import_module('pyhull.convex_hull').ConvexHull
-    hull_layers_points = []
     self_hull_points = list(point_batch)
     if hull_layers > 0:
-        for _ in range(hull_layers):
-            if len(self_hull_points) <= 3:
-                hull_layers_points.extend(self_hull_points)
-                break
-            hull = pyhull_convex_hull(self_hull_points)
-            hull_vertexes = set(vertex for hull_vertex in hull.vertices for vertex in hull_vertex)
-            hull_points = list(self_hull_points[vertex] for vertex in hull_vertexes)
-            if len(hull_points) > 0:
-                for hull_point in hull_points:
-                    self_hull_points.remove(hull_point)
-                    hull_layers_points.append(hull_point)
-            else:
-                hull_layers_points.extend(self_hull_points)
+        layers_idxs = convex_hull_layers_indices(self_hull_points, hull_layers)
+        hull_layers_points = [self_hull_points[point_idx] for point_idx in layers_idxs]
+        layers_idxs = set(layers_idxs)
+        self_hull_points = [point for point_idx, point in enumerate(self_hull_points) if point_idx not in layers_idxs]
     else:
         hull_layers_points = self_hull_points
     if edge_layers > 0:
@@ -65,23 +116,183 @@ def multilayer_convex_hull(point_batch: list[PortfolioXYTuplePoint] = None, hull
     return hull_layers_points + points_on_edge
 
 
-def queue_multiplexer(
-        source: Connection,
-        sinks: list[Connection]):
+def multilayer_convex_hull_indices(
+        points: numpy.ndarray, assets_n: numpy.ndarray,
+        hull_layers: int = 1, edge_layers: int = 0):
+    '''
+    Same filter as multilayer_convex_hull for (points x 2) matrix of coordinates
+    and number of allocated assets of every point, returns sorted indices of points that pass
+    '''
+    if hull_layers <= 0:
+        return numpy.arange(len(points))
+    passed = numpy.zeros(len(points), dtype=bool)
+    passed[convex_hull_layers_indices(points.tolist(), hull_layers)] = True
+    if edge_layers > 0:
+        passed |= assets_n <= edge_layers
+    return numpy.flatnonzero(passed)
+
+
+def pareto_layers_indices(points, directions: tuple[int, int], pareto_layers: int):
+    '''
+    Indices of points on first pareto_layers non-dominated layers, first layer first.
+    directions are +1 if larger coordinate is better and -1 if smaller one is.
+    Unique points are sorted once so that every point can only be dominated by points before it,
+    then every layer is a sweep keeping points above running maximum of the second coordinate.
+    '''
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2) * directions
+    unique_points, unique_inverse = numpy.unique(points, axis=0, return_inverse=True)
+    # best first coordinate first, for equal first coordinates best second coordinate first
+    remaining = numpy.lexsort((-unique_points[:, 1], -unique_points[:, 0]))
+    unique_layers = numpy.full(len(unique_points), pareto_layers)
+    for layer in range(pareto_layers):
+        if len(remaining) == 0:
+            break
+        second = unique_points[remaining, 1]
+        best_before = numpy.concatenate(([-numpy.inf], numpy.maximum.accumulate(second)[:-1]))
+        non_dominated = second > best_before
+        unique_layers[remaining[non_dominated]] = layer
+        remaining = remaining[~non_dominated]
+    points_layers = unique_layers[unique_inverse.reshape(-1)]
+    return numpy.flatnonzero(points_layers < pareto_layers)[numpy.argsort(
+        points_layers[points_layers < pareto_layers], kind='stable')].tolist()
+
+
+def multilayer_pareto_indices(
+        points: numpy.ndarray, assets_n: numpy.ndarray, directions: tuple[int, int],
+        pareto_layers: int = 1, edge_layers: int = 0):
+    '''
+    Sorted indices of points on first pareto_layers non-dominated layers or having up to edge_layers assets
+    '''
+    passed = numpy.zeros(len(points), dtype=bool)
+    passed[pareto_layers_indices(points, directions, pareto_layers)] = True
+    if edge_layers > 0:
+        passed |= assets_n <= edge_layers
+    return numpy.flatnonzero(passed)
+
+
+# Points filters: sorted indices of points that pass, for (points x 2) matrix of
+# (coord_pair[0], coord_pair[1]) coordinates and number of allocated assets of every point.
+# Filter passes every point of a subset that it passes in the whole set, so it can be applied
+# to chunks first, see StreamingFilter and plot_masks.
+
+def hull_points_filter(  # pylint: disable=unused-argument
+        points: numpy.ndarray, assets_n: numpy.ndarray, coord_pair: tuple[str, str],
+        hull_layers: int, edge_layers: int):
+    return multilayer_convex_hull_indices(points, assets_n, hull_layers, edge_layers)
+
+
+def pareto_points_filter(
+        points: numpy.ndarray, assets_n: numpy.ndarray, coord_pair: tuple[str, str],
+        pareto_layers: int, edge_layers: int):
+    directions = (Portfolio.STAT_OBJECTIVES[coord_pair[0]], Portfolio.STAT_OBJECTIVES[coord_pair[1]])
+    return multilayer_pareto_indices(points, assets_n, directions, pareto_layers, edge_layers)
+
+
+class StreamingFilter:
+    '''
+    Result of points filter over stream of point batches, available at any moment.
+    Every batch is merged with points kept so far and only points that pass the filter on merged set
+    are kept, so memory stays proportional to filter result (e.g. hull layers), not to stream length.
+    Without filter every point is kept.
+    '''
+    def __init__(self, points_filter: Callable = None):
+        self._points_filter = points_filter
+        self._points = numpy.empty((0, 2))
+        self._assets_n = numpy.empty(0, dtype=numpy.int64)
+        self._payloads = []
+
+    def add(self, points: numpy.ndarray, assets_n: numpy.ndarray, payloads: list):
+        '''
+        Merge (points x 2) matrix of coordinates, number of allocated assets and payload of every point
+        '''
+        self._payloads.extend(payloads)
+        if self._points_filter is None:
+            return
+        self._points = numpy.concatenate((self._points, numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)))
+        self._assets_n = numpy.concatenate((self._assets_n, assets_n))
+        points_idxs = self._points_filter(self._points, self._assets_n)
+        if len(points_idxs) < len(self._payloads):
+            self._points = self._points[points_idxs]
+            self._assets_n = self._assets_n[points_idxs]
+            self._payloads = [self._payloads[point_idx] for point_idx in points_idxs.tolist()]
+
+    def payloads(self):
+        return list(self._payloads)
+
+
+class TopFilter:
+    '''
+    K best portfolios by stat (see Portfolio.STAT_OBJECTIVES) over stream of batches,
+    among portfolios matching predicates (column, operator function, value) on stats or asset weights,
+    see result_store.parse_predicate. Every batch is merged with portfolios kept so far and only
+    the best k are kept, so memory stays O(k) regardless of stream length.
+    '''
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-positional-arguments
+    def __init__(self, stat: str, k: int, predicates: list[tuple] = (), assets: list[str] = ()):
+        self._stat_idx = Portfolio.STATS.index(stat)
+        self._objective = Portfolio.STAT_OBJECTIVES[stat]
+        self._k = k
+        for column, _, _ in predicates:
+            if column not in Portfolio.STATS and column not in assets:
+                raise ValueError(
+                    f'unknown column "{column}", expected one of: {", ".join(Portfolio.STATS + tuple(assets))}')
+        self._predicates = [
+            (Portfolio.STATS.index(column) if column in Portfolio.STATS else list(assets).index(column),
+             column in Portfolio.STATS, predicate_func, value)
+            for column, predicate_func, value in predicates]
+        self._columns = None
+
+    def add(self, stats: numpy.ndarray, weights: numpy.ndarray, *payloads: numpy.ndarray):
+        '''
+        Merge (portfolios x stats) and (portfolios x assets) matrices and any payload arrays
+        having row of every portfolio, e.g. allocation ranks
+        '''
+        passed = numpy.ones(len(stats), dtype=bool)
+        for column_idx, is_stat, predicate_func, value in self._predicates:
+            passed &= predicate_func((stats if is_stat else weights)[:, column_idx], value)
+        columns = [column[passed] for column in (stats, weights, *payloads)]
+        if self._columns is not None:
+            columns = [numpy.concatenate(pair) for pair in zip(self._columns, columns)]
+        if len(columns[0]) > self._k:
+            keys = -self._objective * columns[0][:, self._stat_idx]
+            kept = numpy.argpartition(keys, self._k - 1)[:self._k]
+            columns = [column[kept] for column in columns]
+        self._columns = columns
+
+    def threshold(self):
+        '''
+        Stat of k-th best portfolio kept, which others have to beat to be kept, None while fewer are kept
+        '''
+        if self._columns is None or len(self._columns[0]) < self._k:
+            return None
+        return self._objective * numpy.min(self._objective * self._columns[0][:, self._stat_idx])
+
+    def result(self):
+        '''
+        Stats, weights and payloads of kept portfolios, best first, None if nothing was added
+        '''
+        if self._columns is None:
+            return None
+        keys = -self._objective * self._columns[0][:, self._stat_idx]
+        order = numpy.argsort(keys, kind='stable')
+        return [column[order] for column in self._columns]
 
-    def send_task(sink, data, pool):
-        return pool.submit(sink.send_bytes, data)
 
-    data_stream_end_pickle = dumps(DataStreamFinished())
-    with ThreadPoolExecutor() as thread_pool:
-        while True:
-            bytes_from_pipe = source.recv_bytes()
-            if bytes_from_pipe == data_stream_end_pickle:
-                break  # make sure all threads are finished before sending the end signal
-            send_tasks = map(partial(send_task, pool=thread_pool, data=bytes_from_pipe), sinks)
-            futures_wait(send_tasks)
-    for sink in sinks:
-        sink.send_bytes(bytes_from_pipe)
+def plot_masks(
+        stats: numpy.ndarray, assets_n: numpy.ndarray,
+        coord_pairs: list[tuple[str, str]], points_filter: Callable):
+    '''
+    Bit i of portfolio mask is set if portfolio passes points filter on coordinates coord_pairs[i],
+    for (portfolios x stats) matrix
+    '''
+    if len(coord_pairs) > 64:
+        raise ValueError(f'plot masks support up to 64 plots, got {len(coord_pairs)}')
+    masks = numpy.zeros(len(stats), dtype=numpy.uint64)
+    for plot_idx, coord_pair in enumerate(coord_pairs):
+        points = stats[:, [Portfolio.STATS.index(coord_pair[0]), Portfolio.STATS.index(coord_pair[1])]]
+        masks[points_filter(points, assets_n, coord_pair)] |= numpy.uint64(1 << plot_idx)
+    return masks
 
 
 def years_first_to_last(years: list):
@@ -17,10 +17,13 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import random
+import operator
 import functools
 import itertools
+import numpy
 import pytest
 from modules import data_filter
+from modules.portfolio import Portfolio
 
 
 class PointMock(tuple):
@@ -201,6 +204,205 @@ def test_multilayer_hull(points, hull_layers, modifier):
     assert hull_points == expected_points
 
 
+class PortfolioPointMock(tuple):
+    def __new__(cls, x, y, assets_n):
+        return super().__new__(cls, (x, y))
+
+    # pylint: disable=unused-argument
+    def __init__(self, x, y, assets_n):
+        self.assets_n = assets_n
+
+    def portfolio(self):
+        return self
+
+    def number_of_assets(self):
+        return self.assets_n
+
+
+@pytest.mark.parametrize('hull_layers, edge_layers', list(itertools.product([0, 1, 3], [0, 1, 2])))
+def test_multilayer_hull_indices(hull_layers, edge_layers):
+    random.seed(hull_layers * 10 + edge_layers)
+    points = numpy.array([[random.gauss(0, 1), random.gauss(0, 1)] for _ in range(300)])
+    assets_n = numpy.array([random.randint(1, 4) for _ in range(len(points))])
+    point_objects = [PortfolioPointMock(x, y, n) for (x, y), n in zip(points.tolist(), assets_n.tolist())]
+    expected_points = set(data_filter.multilayer_convex_hull(point_objects, hull_layers, edge_layers))
+    points_idxs = data_filter.multilayer_convex_hull_indices(points, assets_n, hull_layers, edge_layers)
+    assert set(point_objects[point_idx] for point_idx in points_idxs) == expected_points
+
+
+def _reference_hull_layers(points: list, hull_layers: int):
+    '''
+    Brute force onion peeling of points with distinct coordinates: point is not a hull vertex
+    if it lies in closed triangle or on closed segment of other points
+    '''
+    def cross(o, a, b):
+        return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+    def on_segment(point, a, b):
+        return cross(a, b, point) == 0 and \
+            min(a[0], b[0]) <= point[0] <= max(a[0], b[0]) and min(a[1], b[1]) <= point[1] <= max(a[1], b[1])
+
+    def in_triangle(point, a, b, c):
+        signs = [cross(a, b, point), cross(b, c, point), cross(c, a, point)]
+        return cross(a, b, c) != 0 and not min(signs) < 0 < max(signs)
+
+    def is_vertex(point, others):
+        return not any(on_segment(point, a, b) for a, b in itertools.combinations(others, 2)) and \
+            not any(in_triangle(point, *triangle) for triangle in itertools.combinations(others, 3))
+
+    remaining = list(points)
+    layers_points = []
+    for _ in range(hull_layers):
+        if len(remaining) <= 3:
+            layers_points.extend(remaining)
+            break
+        layer = [point for point in remaining if is_vertex(point, [other for other in remaining if other != point])]
+        layers_points.extend(layer)
+        remaining = [point for point in remaining if point not in layer]
+    return layers_points
+
+
+@pytest.mark.parametrize('seed', range(8))
+@pytest.mark.parametrize('hull_layers', [1, 2, 4])
+def test_convex_hull_layers_grid(seed: int, hull_layers: int):
+    # small integer grid: many collinear points on hull edges and inside
+    random.seed(seed)
+    points = random.sample(list(itertools.product(range(6), range(5))), 16 + seed)
+    layers_idxs = data_filter.convex_hull_layers_indices(points, hull_layers)
+    assert len(layers_idxs) == len(set(layers_idxs))
+    assert sorted(points[point_idx] for point_idx in layers_idxs) == sorted(_reference_hull_layers(points, hull_layers))
+
+
+@pytest.mark.parametrize('points, hull_layers, expected_layers_n', [
+    [[(0, 0), (1, 1), (2, 2), (3, 3), (4, 4)], 1, 2],   # collinear: only ends are vertices
+    [[(0, 0), (1, 1), (2, 2), (3, 3), (4, 4)], 2, 5],   # last 3 points form a layer
+    [[(1, 1)] * 6, 1, 2],                                # identical points are peeled two at a time
+    [[(1, 1)] * 6, 3, 6],
+    [[(0, 0), (0, 0), (2, 0), (2, 0), (0, 2), (2, 2)], 1, 4],
+    [[], 1, 0],
+    [[(5, 5)], 2, 1],
+])
+def test_convex_hull_layers_degenerate(points, hull_layers, expected_layers_n):
+    layers_idxs = data_filter.convex_hull_layers_indices(points, hull_layers)
+    assert len(layers_idxs) == len(set(layers_idxs)) == expected_layers_n
+
+
+@pytest.mark.parametrize('hull_layers, edge_layers', [(1, 0), (3, 0), (2, 1), (0, 0)])
+@pytest.mark.parametrize('batch_size', [1, 7, 100, 1000])
+def test_streaming_filter_hull(hull_layers: int, edge_layers: int, batch_size: int):
+    random.seed(batch_size)
+    points = numpy.array([[random.gauss(0, 1), random.gauss(0, 1)] for _ in range(1000)])
+    assets_n = numpy.array([random.randint(1, 5) for _ in range(len(points))])
+    streaming_hull = data_filter.StreamingFilter(functools.partial(
+        data_filter.multilayer_convex_hull_indices, hull_layers=hull_layers, edge_layers=edge_layers))
+    kept_max = 0
+    for batch_start in range(0, len(points), batch_size):
+        batch = slice(batch_start, batch_start + batch_size)
+        streaming_hull.add(points[batch], assets_n[batch], list(range(len(points)))[batch])
+        kept_max = max(kept_max, len(streaming_hull.payloads()))
+    expected_idxs = data_filter.multilayer_convex_hull_indices(points, assets_n, hull_layers, edge_layers)
+    assert sorted(streaming_hull.payloads()) == expected_idxs.tolist()
+    if hull_layers > 0 and edge_layers == 0:
+        assert kept_max <= 4 * len(expected_idxs) + batch_size
+
+
+def test_plot_masks():
+    random.seed(1)
+    stats = numpy.array([[random.gauss(0, 1) for _ in Portfolio.STATS] for _ in range(500)])
+    assets_n = numpy.array([random.randint(1, 4) for _ in range(len(stats))])
+    coord_pairs = [
+        (Portfolio.STAT_CAGR_PERCENT, Portfolio.STAT_STDDEV),
+        (Portfolio.STAT_GAIN, Portfolio.STAT_SHARPE),
+        (Portfolio.STAT_SHARPE, Portfolio.STAT_DIP_PERCENT),
+    ]
+    points_filter = functools.partial(data_filter.hull_points_filter, hull_layers=2, edge_layers=1)
+    masks = data_filter.plot_masks(stats, assets_n, coord_pairs, points_filter)
+    for plot_idx, (stat_y, stat_x) in enumerate(coord_pairs):
+        points = stats[:, [Portfolio.STATS.index(stat_y), Portfolio.STATS.index(stat_x)]]
+        expected_idxs = data_filter.multilayer_convex_hull_indices(points, assets_n, 2, 1)
+        assert (numpy.flatnonzero(masks & numpy.uint64(1 << plot_idx)) == expected_idxs).all()
+    assert 0 < numpy.count_nonzero(masks) < len(stats)
+
+
+def _reference_pareto_layers(points: list, directions: tuple[int, int]):
+    '''
+    Brute force layer of every point: 0 if no point dominates it, else 1 + max layer of dominating points
+    '''
+    def dominates(a, b):
+        better_or_equal = all((a[i] - b[i]) * directions[i] >= 0 for i in range(2))
+        return better_or_equal and a != b
+
+    layers = {}
+    for point in sorted(set(points), key=lambda point: -sum(point[i] * directions[i] for i in range(2))):
+        layers[point] = 1 + max(
+            (other_layer for other, other_layer in layers.items() if dominates(other, point)), default=-1)
+    return [layers[point] for point in points]
+
+
+@pytest.mark.parametrize('directions', list(itertools.product([1, -1], repeat=2)))
+@pytest.mark.parametrize('pareto_layers', [1, 2, 5])
+@pytest.mark.parametrize('seed', range(5))
+def test_pareto_layers(directions: tuple[int, int], pareto_layers: int, seed: int):
+    # small integer grid: many ties in both coordinates and duplicate points
+    random.seed(seed)
+    points = [(random.randint(0, 6), random.randint(0, 6)) for _ in range(40)]
+    layers = _reference_pareto_layers(points, directions)
+    layers_idxs = data_filter.pareto_layers_indices(points, directions, pareto_layers)
+    assert sorted(layers_idxs) == [point_idx for point_idx, layer in enumerate(layers) if layer < pareto_layers]
+    assert [layers[point_idx] for point_idx in layers_idxs] == sorted(layers[point_idx] for point_idx in layers_idxs)
+
+
+def test_pareto_points_filter():
+    # CAGR is maximized and Stddev is minimized
+    points = numpy.array([[10, 5], [8, 5], [12, 9], [9, 3], [7, 4], [12, 10]])
+    coord_pair = (Portfolio.STAT_CAGR_PERCENT, Portfolio.STAT_STDDEV)
+    assets_n = numpy.array([3, 1, 3, 3, 3, 3])
+    assert data_filter.pareto_points_filter(points, assets_n, coord_pair, 1, 0).tolist() == [0, 2, 3]
+    assert data_filter.pareto_points_filter(points, assets_n, coord_pair, 2, 0).tolist() == [0, 1, 2, 3, 4, 5]
+    assert data_filter.pareto_points_filter(points, assets_n, coord_pair, 1, 1).tolist() == [0, 1, 2, 3]
+
+
+def test_streaming_filter_pareto():
+    random.seed(3)
+    points = numpy.array([[random.gauss(0, 1), random.gauss(0, 1)] for _ in range(2000)])
+    points_filter = functools.partial(data_filter.multilayer_pareto_indices, directions=(1, -1), pareto_layers=2)
+    streaming_filter = data_filter.StreamingFilter(points_filter)
+    for batch_start in range(0, len(points), 64):
+        batch = slice(batch_start, batch_start + 64)
+        streaming_filter.add(points[batch], numpy.zeros(64), list(range(len(points)))[batch])
+    assert sorted(streaming_filter.payloads()) == points_filter(points, numpy.zeros(len(points))).tolist()
+    unfiltered = data_filter.StreamingFilter()
+    unfiltered.add(points[:5], numpy.zeros(5), list(range(5)))
+    assert unfiltered.payloads() == list(range(5))
+
+
+@pytest.mark.parametrize('stat', [Portfolio.STAT_SHARPE, Portfolio.STAT_STDDEV])
+@pytest.mark.parametrize('k', [1, 10, 1000])
+@pytest.mark.parametrize('batch_size', [1, 64, 1000])
+def test_top_filter(stat: str, k: int, batch_size: int):
+    random.seed(k + batch_size)
+    stats = numpy.array([[random.gauss(0, 1) for _ in Portfolio.STATS] for _ in range(500)])
+    weights = numpy.array([[random.randint(0, 2) * 10 for _ in range(3)] for _ in range(len(stats))])
+    predicates = [(Portfolio.STAT_DIP_PERCENT, operator.gt, -0.5), ('B', operator.ne, 0)]
+    top_filter = data_filter.TopFilter(stat, k, predicates, assets=['A', 'B', 'C'])
+    assert top_filter.result() is None
+    assert top_filter.threshold() is None
+    for batch_start in range(0, len(stats), batch_size):
+        batch = slice(batch_start, batch_start + batch_size)
+        top_filter.add(stats[batch], weights[batch], numpy.arange(len(stats))[batch])
+    top_stats, top_weights, top_idxs = top_filter.result()
+    assert top_filter.threshold() == (top_stats[-1, Portfolio.STATS.index(stat)] if len(top_stats) == k else None)
+    passed = numpy.flatnonzero(
+        (stats[:, Portfolio.STATS.index(Portfolio.STAT_DIP_PERCENT)] > -0.5) & (weights[:, 1] != 0))
+    keys = -Portfolio.STAT_OBJECTIVES[stat] * stats[passed, Portfolio.STATS.index(stat)]
+    expected_idxs = passed[numpy.argsort(keys)][:k]
+    assert top_idxs.tolist() == expected_idxs.tolist()
+    assert numpy.array_equal(top_stats, stats[expected_idxs])
+    assert numpy.array_equal(top_weights, weights[expected_idxs])
+    with pytest.raises(ValueError):
+        data_filter.TopFilter(stat, k, [('D', operator.gt, 0)], assets=['A', 'B', 'C'])
+
+
 @pytest.mark.parametrize(
     "years, algorithm, expected_ranges",
     [
@@ -16,12 +16,23 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import os
 import csv
+import time
+from math import comb
+from bisect import bisect_right
+from functools import cache
 from concurrent.futures import ThreadPoolExecutor
-from functools import partial
-from itertools import islice
-from itertools import batched
+from itertools import chain
+from itertools import combinations
+from collections.abc import Callable
+import numpy
 from modules.portfolio import Portfolio
+from modules.batch_simulation import YearRangePlan
+from modules.ring_buffer import RingBuffer
+from modules.result_cache import CacheEntry
+from modules.result_store import ResultStore
+from modules.allocation_constraints import AllocationConstraints
 
 
 def all_possible_allocations(assets_n: int, step: int):
@@ -58,36 +69,615 @@ def all_possible_allocations(assets_n: int, step: int):
         allocation_sum=0)
 
 
+def allocations_count(assets_n: int, step: int):
+    """
+    Number of allocations yielded by all_possible_allocations, without generating them
+    """
+    if 100 % step != 0:
+        raise ValueError(f'cannot use step={step}, must be a divisor of 100')
+    return _compositions_count(100 // step, assets_n)
+
+
+def _compositions_count(steps_n: int, parts_n: int):
+    """
+    Number of ways to split N steps into given number of (possibly empty) parts
+    """
+    return comb(steps_n + parts_n - 1, parts_n - 1)
+
+
+# walks through allocations of this many assets are precomputed as arrays of moves
+_WALK_ARRAY_ASSETS_N = 3
+
+
 # pylint: disable=too-many-arguments
-# pylint: disable=too-many-locals
 # pylint: disable=too-many-positional-arguments
-def allocation_slice_simulate_and_feed_to_sink(
-        slice_idx, slice_size,
-        assets, percentage_step,
-        year_range_selector_func, asset_gain_per_year,
-        sink, chunk_size):
+def _walk_recursive(
+        steps_n: int, asset_idxs: list[int],
+        start: int = 0, array_assets_n: int = _WALK_ARRAY_ASSETS_N):
+    """
+    Compositions of N steps over assets are walked by giving steps to the first asset's tail
+    one by one: each time tail holds all its steps in single asset, walk of the tail continues
+    from there and recursively ends with all steps in single (possibly other) asset.
+    Yields arrays of (from, to) moves, returns index of asset holding all steps at the end.
+    Walk is started from given position, skipping whole sub-walks before it without generating them.
+    """
+    if steps_n == 0 or len(asset_idxs) == 1:
+        return asset_idxs[0]
+    if len(asset_idxs) <= array_assets_n:
+        moves, end_idx = _walk_array(steps_n, len(asset_idxs))
+        yield numpy.array(asset_idxs)[moves[start:]]
+        return asset_idxs[end_idx]
+    head_idx, tail_idxs = asset_idxs[0], asset_idxs[1:]
+    tail_full_idx = tail_idxs[0]
+    first_tail_steps_n = 1
+    if start > 0:
+        first_tail_steps_n = _walk_tail_steps(start, len(asset_idxs))
+        tail_full_idx = yield from _walk_recursive(
+            first_tail_steps_n, _walk_tail_order(tail_idxs, first_tail_steps_n),
+            start - _compositions_count(first_tail_steps_n - 1, len(asset_idxs)), array_assets_n)
+        first_tail_steps_n += 1
+    for tail_steps_n in range(first_tail_steps_n, steps_n + 1):
+        yield numpy.array([[head_idx, tail_full_idx]])
+        tail_full_idx = yield from _walk_recursive(
+            tail_steps_n, [tail_full_idx] + [idx for idx in tail_idxs if idx != tail_full_idx],
+            0, array_assets_n)
+    return tail_full_idx
+
+
+@cache
+def _walk_array(steps_n: int, assets_n: int):
+    walk = _walk_recursive(steps_n, list(range(assets_n)), array_assets_n=assets_n - 1)
+    moves = []
+    while True:
+        try:
+            moves.append(next(walk))
+        except StopIteration as walk_end:
+            moves_array = numpy.concatenate(moves)
+            moves_array.setflags(write=False)
+            return moves_array, walk_end.value
+
+
+@cache
+def _walk_end_idx(steps_n: int, assets_n: int):
+    """
+    Index of asset holding all steps at the end of walk through assets 0..assets_n-1
+    """
+    if steps_n == 0 or assets_n == 1:
+        return 0
+    tail_full_idx = 1
+    for tail_steps_n in range(1, steps_n + 1):
+        tail_full_idx = _walk_tail_order(list(range(1, assets_n)), tail_steps_n, tail_full_idx)[
+            _walk_end_idx(tail_steps_n, assets_n - 1)]
+    return tail_full_idx
+
+
+def _walk_tail_order(tail_idxs: list[int], tail_steps_n: int, tail_full_idx: int = None):
+    """
+    Order of tail assets in sub-walk where tail holds given number of steps:
+    asset holding all tail steps at the start of sub-walk goes first
+    """
+    if tail_full_idx is None:
+        tail_full_idx = tail_idxs[_walk_tail_start(len(tail_idxs), tail_steps_n)]
+    return [tail_full_idx] + [idx for idx in tail_idxs if idx != tail_full_idx]
+
+
+@cache
+def _walk_tail_start(tail_assets_n: int, tail_steps_n: int):
+    """
+    Position (in tail) of asset holding all tail steps at the start of sub-walk
+    where tail holds given number of steps, it is where sub-walk with one step less ended
+    """
+    if tail_steps_n <= 1:
+        return 0
+    previous_start = _walk_tail_start(tail_assets_n, tail_steps_n - 1)
+    previous_order = [previous_start] + [idx for idx in range(tail_assets_n) if idx != previous_start]
+    return previous_order[_walk_end_idx(tail_steps_n - 1, tail_assets_n)]
+
+
+def _walk_tail_steps(position: int, assets_n: int):
+    """
+    Number of steps held by tail of the first asset at given position of walk
+    """
+    return bisect_right(_compositions_counts(assets_n), position)
+
+
+@cache
+def _compositions_counts(assets_n: int):
+    """
+    Compositions counts of 0..100 steps (step of 1%) over assets
+    """
+    return tuple(_compositions_count(steps_n, assets_n) for steps_n in range(101))
+
+
+def allocation_walk(assets_n: int, step: int):
+    """
+    Walk through all possible allocations (same set as all_possible_allocations) such that
+    every next allocation differs from previous one by moving one step from one asset to another.
+    Walk starts with everything allocated to first asset, yields (from, to) asset indexes of moves.
+    """
+    if 100 % step != 0:
+        raise ValueError(f'cannot use step={step}, must be a divisor of 100')
+    for moves in _walk_recursive(100 // step, list(range(assets_n))):
+        yield from map(tuple, moves.tolist())
+
+
+def allocation_walk_unrank(rank: int, assets_n: int, step: int):
+    """
+    Allocation at given position of allocation_walk, without walking there
+    """
+    allocation = [0] * assets_n
+    steps_n = 100 // step
+    asset_idxs = list(range(assets_n))
+    while steps_n > 0 and len(asset_idxs) > 1:
+        tail_steps_n = _walk_tail_steps(rank, len(asset_idxs))
+        allocation[asset_idxs[0]] = (steps_n - tail_steps_n) * step
+        if tail_steps_n > 0:
+            rank -= _compositions_count(tail_steps_n - 1, len(asset_idxs))
+            asset_idxs = _walk_tail_order(asset_idxs[1:], tail_steps_n)
+        steps_n = tail_steps_n
+    allocation[asset_idxs[0]] += steps_n * step
+    return allocation
+
+
+def allocation_walk_rank(allocation: list[int], step: int):
+    """
+    Position of allocation in allocation_walk, inverse of allocation_walk_unrank
+    """
+    rank = 0
+    steps_n = 100 // step
+    asset_idxs = list(range(len(allocation)))
+    while steps_n > 0 and len(asset_idxs) > 1:
+        tail_steps_n = steps_n - allocation[asset_idxs[0]] // step
+        if tail_steps_n > 0:
+            rank += _compositions_count(tail_steps_n - 1, len(asset_idxs))
+            asset_idxs = _walk_tail_order(asset_idxs[1:], tail_steps_n)
+        steps_n = tail_steps_n
+    return rank
+
+
+def allocation_ranks_fit(assets_n: int, step: int):
+    """
+    True if positions in allocation_walk fit into uint64 ranks
+    """
+    return allocations_count(assets_n, step) <= numpy.iinfo(numpy.uint64).max
+
+
+@cache
+def _walk_rank_tables(assets_n: int, step: int):
+    """
+    For every number of assets left in walk and every number of steps held by tail of the first of them:
+    walk positions skipped before that tail and position (in tail) of asset holding all tail steps
+    at the start of its sub-walk, see allocation_walk_rank
+    """
+    steps_n = 100 // step
+    skipped = numpy.zeros((assets_n + 1, steps_n + 1), dtype=numpy.uint64)
+    tail_starts = numpy.zeros((assets_n + 1, steps_n + 1), dtype=numpy.intp)
+    for left_n in range(2, assets_n + 1):
+        for tail_steps_n in range(1, steps_n + 1):
+            skipped[left_n, tail_steps_n] = _compositions_count(tail_steps_n - 1, left_n)
+            tail_starts[left_n, tail_steps_n] = _walk_tail_start(left_n - 1, tail_steps_n)
+    return skipped, tail_starts
+
+
+def allocation_walk_rank_batch(allocations: numpy.ndarray, step: int):
+    """
+    Array of positions in allocation_walk of every row of allocations matrix,
+    allocation_walk_rank of all rows at once: asset order of every row is kept as matrix row,
+    at every level tail asset holding all tail steps at the start of sub-walk moves to its front
+    """
+    rows_n, assets_n = allocations.shape
+    if not allocation_ranks_fit(assets_n, step):
+        raise ValueError(
+            f'{allocations_count(assets_n, step)} allocations of {assets_n} assets at {step}% step '
+            'do not fit into 64-bit allocation ranks')
+    skipped, tail_starts = _walk_rank_tables(assets_n, step)
+    ranks = numpy.zeros(rows_n, dtype=numpy.uint64)
+    # rows still walking: their row numbers, steps held by asset order from level on and that order
+    rows = numpy.arange(rows_n)
+    steps_n = numpy.full(rows_n, 100 // step)
+    order = numpy.tile(numpy.arange(assets_n), (rows_n, 1))
+    for level in range(assets_n - 1):
+        left_n = assets_n - level
+        tail_steps_n = steps_n - allocations[rows, order[:, 0]] // step
+        walking = tail_steps_n > 0
+        rows, tail_steps_n, tail = rows[walking], tail_steps_n[walking], order[walking, 1:]
+        if len(rows) == 0:
+            break
+        ranks[rows] += skipped[left_n, tail_steps_n]
+        order = _walk_tail_order_batch(tail, tail_starts[left_n, tail_steps_n])
+        steps_n = tail_steps_n
+    return ranks
+
+
+def _walk_tail_order_batch(tails: numpy.ndarray, tail_starts: numpy.ndarray):
+    """
+    _walk_tail_order of every row of tails matrix: asset at tail_starts position of the row moves to its front
+    """
+    columns = numpy.arange(tails.shape[1])
+    starts = tail_starts[:, numpy.newaxis]
+    return numpy.take_along_axis(
+        tails, numpy.where(columns == 0, starts, numpy.where(columns <= starts, columns - 1, columns)), axis=1)
+
+
+def allocation_walk_unrank_batch(ranks: numpy.ndarray, assets_n: int, step: int):
+    """
+    Matrix (ranks x assets) of allocations at given positions of allocation_walk
+    """
+    allocations = [allocation_walk_unrank(rank, assets_n, step) for rank in ranks.tolist()]
+    return numpy.array(allocations, dtype=numpy.int32).reshape(len(allocations), assets_n)
+
+
+def _rows_regrouped(arrays_gen, rows_n: int):
+    """
+    Regroup arrays (e.g. of moves) into arrays of rows_n rows (last one may be shorter)
+    """
+    buffered, buffered_n = [], 0
+    for rows in arrays_gen:
+        buffered.append(rows)
+        buffered_n += len(rows)
+        if buffered_n >= rows_n:
+            rows = numpy.concatenate(buffered)
+            full_n = len(rows) - len(rows) % rows_n
+            yield from (rows[offset:offset + rows_n] for offset in range(0, full_n, rows_n))
+            buffered, buffered_n = [rows[full_n:]], len(rows) - full_n
+    if buffered_n > 0:
+        yield numpy.concatenate(buffered)
+
+
+def allocation_walk_blocks(assets_n: int, step: int, start: int, stop: int, block_size: int):
+    """
+    Allocations number start..stop-1 of allocation_walk in blocks of up to block_size allocations.
+    Yields allocation preceding the block and array of moves, each move leading to next allocation of block.
+    First allocation of range is preceded by no-op move. Walk starts right at the range,
+    so consecutive ranges can be simulated independently without generating allocations before them.
+    """
+    if 100 % step != 0:
+        raise ValueError(f'cannot use step={step}, must be a divisor of 100')
+    if start >= min(stop, allocations_count(assets_n, step)):
+        return
+    allocation = numpy.array(allocation_walk_unrank(start, assets_n, step), dtype=numpy.int32)
+    moves_gen = chain(
+        [numpy.zeros((1, 2), dtype=numpy.intp)],
+        _walk_recursive(100 // step, list(range(assets_n)), start))
+    position = start
+    for moves in _rows_regrouped(moves_gen, block_size):
+        moves = moves[:stop - position]
+        yield allocation, moves
+        allocation = _allocation_moved(allocation, moves, step)
+        position += len(moves)
+        if position >= stop:
+            break
+
+
+def sparse_allocations_count(assets_n: int, step: int, max_assets_n: int):
+    """
+    Number of allocations having from 1 to max_assets_n assets with non-zero weight
+    """
+    if 100 % step != 0:
+        raise ValueError(f'cannot use step={step}, must be a divisor of 100')
+    return sum(
+        comb(assets_n, support_n) * comb(100 // step - 1, support_n - 1)
+        for support_n in range(1, min(max_assets_n, assets_n) + 1))
+
+
+@cache
+def _positive_compositions(steps_n: int, parts_n: int):
+    """
+    Matrix of all ways to split N steps into given number of non-empty parts
+    """
+    cuts = list(combinations(range(1, steps_n), parts_n - 1))
+    cuts = numpy.array(cuts, dtype=numpy.int32).reshape(len(cuts), parts_n - 1)
+    compositions = numpy.diff(cuts, axis=1, prepend=0, append=steps_n)
+    compositions.flags.writeable = False
+    return compositions
+
+
+def sparse_allocation_blocks(
+        assets_n: int, step: int, max_assets_n: int,
+        start: int, stop: int, block_size: int):
+    """
+    Weights matrices of allocations number start..stop-1 among allocations having
+    up to max_assets_n non-zero weights, in blocks of up to block_size allocations.
+    Allocations are ordered by number of non-zero weights, then by set of these assets,
+    every set of assets is followed by all its compositions of positive weights.
+    """
+    def _subsets_allocations():
+        position = 0
+        for support_n in range(1, min(max_assets_n, assets_n) + 1):
+            compositions = _positive_compositions(100 // step, support_n)
+            for support in combinations(range(assets_n), support_n):
+                if position >= stop:
+                    return
+                subset_start, subset_stop = max(start - position, 0), min(stop - position, len(compositions))
+                position += len(compositions)
+                if subset_start >= subset_stop:
+                    continue
+                weights = numpy.zeros((subset_stop - subset_start, assets_n), dtype=numpy.int32)
+                weights[:, support] = compositions[subset_start:subset_stop] * step
+                yield weights
+
+    yield from _rows_regrouped(_subsets_allocations(), block_size)
+
+
+def _allocation_moved(allocation: numpy.ndarray, moves: numpy.ndarray, step: int):
+    return allocation + step * (
+        numpy.bincount(moves[:, 1], minlength=len(allocation)) -
+        numpy.bincount(moves[:, 0], minlength=len(allocation))).astype(allocation.dtype)
+
+
+class _SimulationWorker:
+    '''
+    State of simulation worker process, received once per process by init_simulation_worker
+    '''
+    def __init__(self):
+        self.plan: YearRangePlan = None
+        self.sink: RingBuffer = None
+        self.plot_masks_func: Callable = None
+        self.store: ResultStore = None
+        self.top_filter_func: Callable = None
+
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-positional-arguments
+    def setup(
+            self, plan: YearRangePlan, sink: RingBuffer, plot_masks_func: Callable, store: ResultStore,
+            top_filter_func: Callable):
+        '''
+        Keep inputs of init_simulation_worker
+        '''
+        self.plan = plan
+        self.sink = sink
+        self.plot_masks_func = plot_masks_func
+        self.store = store
+        self.top_filter_func = top_filter_func
+
+    def top_filter(self):
+        '''
+        Empty top filter of a task, None unless worker sends only best portfolios
+        '''
+        return self.top_filter_func() if self.top_filter_func is not None else None
+
+
+_WORKER = _SimulationWorker()
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-positional-arguments
+def init_simulation_worker(
+        plan: YearRangePlan, sink: RingBuffer, plot_masks_func: Callable = None, store: ResultStore = None,
+        top_filter_func: Callable = None):
+    '''
+    Process pool initializer: receive year range plan, data sink, optional prefilter,
+    optional result store and optional top filter once per worker process.
+    plot_masks_func(stats, assets_n) returns plot mask of every portfolio, see data_filter.plot_masks.
+    top_filter_func() returns empty data_filter.TopFilter, then every task sends only its best portfolios.
+    '''
+    _WORKER.setup(plan, sink, plot_masks_func, store, top_filter_func)
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-positional-arguments
+def simulated_allocation_blocks(
+        plan: YearRangePlan, start: int, stop: int,
+        assets_n: int, percentage_step: int,
+        chunk_size: int, max_assets_n: int = None,
+        partials: bool = False, constraints: AllocationConstraints = None, ranked: bool = True):
+    '''
+    Weights, stats, allocation_walk ranks and partials (None unless asked for, see YearRangePlan)
+    of allocations number start..stop-1, of all allocations, of allocations having
+    up to max_assets_n assets (see sparse_allocation_blocks) or of allocations satisfying constraints.
+    Ranks of sparse and constrained allocations are computed only if ranked, they are None otherwise.
+    '''
+    if constraints is not None:
+        weights_blocks = constraints.allocation_blocks(percentage_step, start, stop, chunk_size)
+    elif max_assets_n is not None:
+        weights_blocks = sparse_allocation_blocks(assets_n, percentage_step, max_assets_n, start, stop, chunk_size)
+    else:
+        yield from _simulated_walk_blocks(
+            plan, allocation_walk_blocks(assets_n, percentage_step, start, stop, chunk_size),
+            start, percentage_step, partials)
+        return
+    for weights in weights_blocks:
+        ranks = allocation_walk_rank_batch(weights, percentage_step) if ranked else None
+        if partials:
+            stats, block_partials = plan.simulate_weights(weights, partials=True)
+            yield weights, stats, ranks, block_partials
+        else:
+            yield weights, plan.simulate_weights(weights), ranks, None
+
+
+def _simulated_walk_blocks(plan: YearRangePlan, walk_blocks, start: int, percentage_step: int, partials: bool):
+    '''
+    Weights, stats, ranks and partials of allocation_walk blocks starting from allocation number start
+    '''
+    position = start
+    for allocation, moves in walk_blocks:
+        ranks = numpy.arange(position, position + len(moves), dtype=numpy.uint64)
+        if partials:
+            weights, stats, block_partials = plan.simulate_walk(allocation, moves, percentage_step, partials=True)
+            yield weights, stats, ranks, block_partials
+        else:
+            weights, stats = plan.simulate_walk(allocation, moves, percentage_step)
+            yield weights, stats, ranks, None
+        position += len(moves)
+
+
+def _blocks_feed_to_sink(blocks, weights_encoding: str, start: int):
+    '''
+    Send (weights, stats, ranks, partials) blocks of portfolios number start.. to worker sink,
+    returns number of portfolios seen and sent. Ranks may be None unless weights are sent as ranks.
+    With plot masks prefilter only portfolios that pass it on some plot are sent, tagged with their masks.
+    With top filter only best portfolios of all blocks are sent, as single batch at the end.
+    With result store every portfolio is written to it before filters.
+    '''
+    if _WORKER.store is not None:
+        blocks = _WORKER.store.recorded_blocks(blocks, start)
+    top_filter = _WORKER.top_filter()
+    portfolios_seen = 0
     portfolios_sent = 0
-    with ThreadPoolExecutor() as thread_executor:
-        possible_allocations_gen = all_possible_allocations(len(assets), percentage_step)
-        gen_slice_allocations = islice(possible_allocations_gen, slice_idx * slice_size, (slice_idx + 1) * slice_size)
-        gen_portfolios = map(
-            partial(Portfolio, assets=assets),
-            gen_slice_allocations)
-        gen_simulateds = map(
-            partial(Portfolio.simulated,
-                    year_range_selector_func=year_range_selector_func,
-                    asset_gain_per_year=asset_gain_per_year),
-            gen_portfolios)
-        gen_serializations = map(Portfolio.serialize, gen_simulateds)
+    with ThreadPoolExecutor(max_workers=1) as thread_executor:
         send_task = None
-        for batch in batched(gen_serializations, chunk_size):
+        for weights, stats, ranks, _ in blocks:
+            portfolios_seen += len(weights)
+            plot_masks = None
+            if top_filter is not None:
+                # filter on values as consumer will see them after serialization
+                top_filter.add(stats.astype(numpy.float32), weights, *([] if ranks is None else [ranks]))
+                continue
+            if _WORKER.plot_masks_func is not None:
+                # filter on values as plotters will see them after serialization
+                stats = stats.astype(numpy.float32)
+                plot_masks = _WORKER.plot_masks_func(stats, numpy.count_nonzero(weights, axis=1))
+                passed = numpy.flatnonzero(plot_masks)
+                if len(passed) == 0:
+                    continue
+                stats, weights, plot_masks = stats[passed], weights[passed], plot_masks[passed]
+                ranks = ranks[passed] if ranks is not None else None
+            serialization = Portfolio.serialize_batch(stats, weights, weights_encoding, ranks, plot_masks)
             if send_task is not None:
                 send_task.result()
-            send_task = thread_executor.submit(sink.send_bytes, b''.join(batch))
-            portfolios_sent += len(batch)
+            send_task = thread_executor.submit(_WORKER.sink.write, serialization)
+            portfolios_sent += len(weights)
         if send_task is not None:
             send_task.result()
-    return portfolios_sent
+    top_portfolios = top_filter.result() if top_filter is not None else None
+    if top_portfolios is not None and len(top_portfolios[0]) > 0:
+        stats, weights, *ranks = top_portfolios
+        _WORKER.sink.write(Portfolio.serialize_batch(stats, weights, weights_encoding, *ranks))
+        portfolios_sent = len(stats)
+    return portfolios_seen, portfolios_sent
+
+
+def held_asset_allocations_count(assets_n: int, step: int):
+    """
+    Number of allocations holding given asset, i.e. not holding it at 0%
+    """
+    return allocations_count(assets_n, step) - allocations_count(assets_n - 1, step)
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-positional-arguments
+def held_asset_allocation_blocks(
+        plan: YearRangePlan, asset_idx: int, start: int, stop: int,
+        assets_n: int, percentage_step: int, chunk_size: int, partials: bool = False):
+    '''
+    Same as simulated_allocation_blocks for allocations number start..stop-1 among allocations
+    holding asset number asset_idx. These are first allocations of walk through assets
+    reordered to start with that asset, as walk gives away steps of first asset one by one.
+    '''
+    order = [asset_idx] + [idx for idx in range(assets_n) if idx != asset_idx]
+    reordered_plan = plan.assets_reordered(order)
+    order_inverse = numpy.argsort(order)
+    stop = min(stop, held_asset_allocations_count(assets_n, percentage_step))
+    for weights, stats, _, block_partials in simulated_allocation_blocks(
+            reordered_plan, start, stop, assets_n, percentage_step, chunk_size, partials=partials):
+        weights = weights[:, order_inverse]
+        yield weights, stats, allocation_walk_rank_batch(weights, percentage_step), block_partials
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-positional-arguments
+def allocation_range_simulate_and_feed_to_sink(
+        start: int, stop: int,
+        assets: list[str], percentage_step: int,
+        chunk_size: int, weights_encoding: str = Portfolio.WEIGHTS_INT32,
+        max_assets_n: int = None, cache_entry: CacheEntry = None,
+        constraints: AllocationConstraints = None):
+    '''
+    Simulate allocations number start..stop-1 of allocation_walk (or of sparse allocations
+    if max_assets_n is given, or of allocations satisfying constraints if given)
+    and send them to worker sink, recording them to new cache entry if given.
+    Returns number of portfolios simulated and sent, time it took and worker process id.
+    '''
+    time_start = time.perf_counter()
+    # ranks are sent as weights, recorded to cache and to store, not needed otherwise
+    blocks = simulated_allocation_blocks(
+        _WORKER.plan, start, stop, len(assets), percentage_step, chunk_size, max_assets_n,
+        partials=cache_entry is not None, constraints=constraints,
+        ranked=weights_encoding == Portfolio.WEIGHTS_RANK or cache_entry is not None or _WORKER.store is not None)
+    if cache_entry is not None:
+        blocks = cache_entry.recorded_blocks(blocks, start)
+    portfolios_simulated, portfolios_sent = _blocks_feed_to_sink(blocks, weights_encoding, start)
+    return portfolios_simulated, portfolios_sent, time.perf_counter() - time_start, os.getpid()
+
+
+def cached_range_feed_to_sink(
+        start: int, stop: int, cache_entry: CacheEntry,
+        chunk_size: int, weights_encoding: str = Portfolio.WEIGHTS_INT32):
+    '''
+    Send records number start..stop-1 of cache entry to worker sink instead of simulating them.
+    Returns same as allocation_range_simulate_and_feed_to_sink.
+    '''
+    time_start = time.perf_counter()
+    portfolios_read, portfolios_sent = _blocks_feed_to_sink(
+        cache_entry.blocks(start, stop, chunk_size), weights_encoding, start)
+    return portfolios_read, portfolios_sent, time.perf_counter() - time_start, os.getpid()
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-positional-arguments
+def cached_range_extend_and_feed_to_sink(
+        start: int, stop: int, base_entry: CacheEntry, cache_entry: CacheEntry,
+        chunk_size: int, weights_encoding: str = Portfolio.WEIGHTS_INT32):
+    '''
+    Compute records number start..stop-1 from records of base entry simulated without last year,
+    extending their partials by it (see YearRangePlan.simulate_appended_year),
+    record them to new cache entry and send them to worker sink.
+    Returns same as allocation_range_simulate_and_feed_to_sink.
+    '''
+    def _extended_blocks():
+        layout = base_entry.meta['layout']
+        for weights, _, ranks, base_partials in base_entry.blocks(start, stop, chunk_size, partials=True):
+            stats, partials = _WORKER.plan.simulate_appended_year(weights, base_partials, layout)
+            yield weights, stats, ranks, partials
+
+    time_start = time.perf_counter()
+    portfolios_extended, portfolios_sent = _blocks_feed_to_sink(
+        cache_entry.recorded_blocks(_extended_blocks(), start), weights_encoding, start)
+    return portfolios_extended, portfolios_sent, time.perf_counter() - time_start, os.getpid()
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-positional-arguments
+def held_asset_range_simulate_and_feed_to_sink(
+        start: int, stop: int, asset_idx: int, assets_n: int, percentage_step: int,
+        chunk_size: int, weights_encoding: str = Portfolio.WEIGHTS_INT32, cache_entry: CacheEntry = None):
+    '''
+    Simulate allocations number start..stop-1 among allocations holding asset number asset_idx
+    (see held_asset_allocation_blocks) and send them to worker sink, recording them to new cache entry if given.
+    Returns same as allocation_range_simulate_and_feed_to_sink.
+    '''
+    time_start = time.perf_counter()
+    blocks = held_asset_allocation_blocks(
+        _WORKER.plan, asset_idx, start, stop, assets_n, percentage_step, chunk_size,
+        partials=cache_entry is not None)
+    if cache_entry is not None:
+        blocks = cache_entry.recorded_blocks(blocks, start)
+    portfolios_simulated, portfolios_sent = _blocks_feed_to_sink(blocks, weights_encoding, start)
+    return portfolios_simulated, portfolios_sent, time.perf_counter() - time_start, os.getpid()
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-positional-arguments
+def cached_range_add_asset_and_feed_to_sink(
+        start: int, stop: int, base_entry: CacheEntry, cache_entry: CacheEntry,
+        asset_idx: int, base_offset: int, percentage_step: int,
+        chunk_size: int, weights_encoding: str = Portfolio.WEIGHTS_INT32):
+    '''
+    Records number start..stop-1 of new cache entry are records of base entry simulated without
+    asset number asset_idx, starting from base_offset: stats and partials are the same,
+    weights get this asset at 0% and ranks are computed for new number of assets.
+    Records are sent to worker sink. Returns same as allocation_range_simulate_and_feed_to_sink.
+    '''
+    def _added_asset_blocks():
+        for weights, stats, _, partials in base_entry.blocks(
+                start - base_offset, stop - base_offset, chunk_size, partials=True):
+            weights = numpy.insert(weights, asset_idx, 0, axis=1)
+            yield weights, stats, allocation_walk_rank_batch(weights, percentage_step), partials
+
+    time_start = time.perf_counter()
+    portfolios_reused, portfolios_sent = _blocks_feed_to_sink(
+        cache_entry.recorded_blocks(_added_asset_blocks(), start), weights_encoding, start)
+    return portfolios_reused, portfolios_sent, time.perf_counter() - time_start, os.getpid()
 
 
 def read_capitalgain_csv_data(filename):
@@ -105,8 +695,3 @@ def read_capitalgain_csv_data(filename):
             yearly_gain[str(row[0])][i - 1] = \
                 float(row[i].replace('%', '')) / 100 + 1
     return assets, yearly_gain
-
-
-# pylint: disable=too-few-public-methods
-class DataStreamFinished:
-    pass
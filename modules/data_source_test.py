@@ -17,8 +17,11 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import itertools
+import numpy
 import pytest
 from modules import data_source
+from modules import data_filter
+from modules.batch_simulation import YearRangePlan
 
 
 @pytest.mark.parametrize('assets_n, step',
@@ -45,3 +48,156 @@ def test_all_possible_allocations(assets_n: int, step: int):
     test_allocations.sort()
     # must be strictly equivalent to filtered product
     assert test_allocations == expected_allocations
+
+
+@pytest.mark.parametrize('assets_n, step',
+    list(itertools.chain(
+        itertools.product([1, 2, 3], [1, 5, 10, 25, 100]),
+        itertools.product([4, 5],          [5, 10, 20, 50]),
+        itertools.product([7],                 [10, 20, 25]),
+    ))
+)
+def test_allocation_walk(assets_n: int, step: int):
+    allocation = [100] + [0] * (assets_n - 1)
+    walk_allocations = [tuple(allocation)]
+    for move_from, move_to in data_source.allocation_walk(assets_n, step):
+        assert move_from != move_to
+        allocation[move_from] -= step
+        allocation[move_to] += step
+        assert min(allocation) >= 0
+        walk_allocations.append(tuple(allocation))
+    expected_allocations = list(tuple(a) for a in data_source.all_possible_allocations(assets_n, step))
+    # every allocation is visited exactly once
+    assert len(walk_allocations) == len(expected_allocations)
+    assert sorted(walk_allocations) == sorted(expected_allocations)
+
+
+@pytest.mark.parametrize('start, stop, block_size', [
+    (0, 10**6, 7),
+    (0, 10**6, 1),
+    (0, 286, 286),
+    (13, 14, 5),
+    (13, 100, 10),
+    (280, 10**6, 3),
+    (286, 10**6, 3),
+    (500, 10**6, 3),
+    (1234, 2000, 100),
+    (2990, 3010, 7),
+])
+@pytest.mark.parametrize('assets_n, step', [(4, 10), (6, 10)])
+def test_allocation_walk_blocks(assets_n: int, step: int, start: int, stop: int, block_size: int):
+    allocation = [100] + [0] * (assets_n - 1)
+    walk_allocations = [tuple(allocation)]
+    for move_from, move_to in data_source.allocation_walk(assets_n, step):
+        allocation[move_from] -= step
+        allocation[move_to] += step
+        walk_allocations.append(tuple(allocation))
+    block_allocations = []
+    for block_allocation, moves in data_source.allocation_walk_blocks(assets_n, step, start, stop, block_size):
+        assert 0 < len(moves) <= block_size
+        allocation = list(block_allocation)
+        for move_from, move_to in moves:
+            allocation[move_from] -= step
+            allocation[move_to] += step
+            block_allocations.append(tuple(allocation))
+    assert block_allocations == walk_allocations[start:stop]
+
+
+@pytest.mark.parametrize('assets_n, step', [
+    (1, 10), (2, 10), (3, 5), (4, 10), (5, 10), (6, 20), (7, 25),
+])
+def test_allocation_walk_rank_unrank(assets_n: int, step: int):
+    allocation = [100] + [0] * (assets_n - 1)
+    walk_allocations = [list(allocation)]
+    for move_from, move_to in data_source.allocation_walk(assets_n, step):
+        allocation[move_from] -= step
+        allocation[move_to] += step
+        walk_allocations.append(list(allocation))
+    for rank, walk_allocation in enumerate(walk_allocations):
+        assert data_source.allocation_walk_unrank(rank, assets_n, step) == walk_allocation
+        assert data_source.allocation_walk_rank(walk_allocation, step) == rank
+
+
+@pytest.mark.parametrize('assets_n, step', [
+    (1, 10), (2, 1), (3, 5), (4, 10), (6, 10), (8, 20), (5, 4),
+])
+def test_allocation_walk_rank_batch(assets_n: int, step: int):
+    allocations = numpy.array(list(data_source.all_possible_allocations(assets_n, step)))
+    ranks = data_source.allocation_walk_rank_batch(allocations, step)
+    assert ranks.dtype == numpy.uint64
+    assert ranks.tolist() == [data_source.allocation_walk_rank(allocation, step) for allocation in allocations.tolist()]
+
+
+def test_allocation_walk_rank_batch_too_many_allocations():
+    assert data_source.allocation_ranks_fit(16, 1)
+    assert not data_source.allocation_ranks_fit(30, 1)
+    with pytest.raises(ValueError):
+        data_source.allocation_walk_rank_batch(numpy.array([[100] + [0] * 29]), 1)
+
+
+@pytest.mark.parametrize('assets_n, step', [
+    (1, 1), (1, 100), (2, 1), (3, 5), (4, 10), (8, 20), (10, 25),
+])
+def test_allocations_count(assets_n: int, step: int):
+    assert data_source.allocations_count(assets_n, step) == \
+        sum(1 for _ in data_source.all_possible_allocations(assets_n, step))
+
+
+@pytest.mark.parametrize('assets_n, step, max_assets_n', [
+    (1, 10, 1), (3, 10, 1), (3, 10, 2), (3, 10, 3), (5, 20, 2), (6, 10, 3), (4, 25, 7),
+])
+def test_sparse_allocation_blocks(assets_n: int, step: int, max_assets_n: int):
+    expected = sorted(
+        tuple(allocation) for allocation in data_source.all_possible_allocations(assets_n, step)
+        if sum(weight > 0 for weight in allocation) <= max_assets_n)
+    assert data_source.sparse_allocations_count(assets_n, step, max_assets_n) == len(expected)
+    allocations = [
+        tuple(allocation)
+        for weights in data_source.sparse_allocation_blocks(assets_n, step, max_assets_n, 0, len(expected), 7)
+        for allocation in weights.tolist()]
+    assert sorted(allocations) == expected
+    assert list(map(lambda allocation: sum(weight > 0 for weight in allocation), allocations)) == \
+        sorted(sum(weight > 0 for weight in allocation) for allocation in allocations)
+    for start, stop, block_size in [(0, 1, 1), (1, len(expected) - 1, 3), (len(expected) // 2, len(expected) + 5, 4)]:
+        blocks = list(data_source.sparse_allocation_blocks(assets_n, step, max_assets_n, start, stop, block_size))
+        assert all(0 < len(weights) <= block_size for weights in blocks)
+        assert [tuple(allocation) for weights in blocks for allocation in weights.tolist()] == allocations[start:stop]
+
+
+def test_simulated_allocation_blocks_unranked():
+    rng = numpy.random.default_rng(seed=1)
+    plan = YearRangePlan(
+        data_filter.years_all_to_all, {str(year): list(rng.uniform(0.8, 1.25, size=30)) for year in range(2000, 2008)})
+    # ranks of 30 assets at 1% do not fit into uint64, sparse allocations are simulated without them
+    blocks = list(data_source.simulated_allocation_blocks(plan, 0, 1000, 30, 1, 256, max_assets_n=2, ranked=False))
+    assert all(ranks is None for _, _, ranks, _ in blocks)
+    weights = numpy.concatenate([block[0] for block in blocks])
+    assert numpy.allclose(numpy.concatenate([block[1] for block in blocks]), plan.simulate_weights(weights))
+
+
+@pytest.mark.parametrize('assets_n, step, asset_idx', [
+    (2, 10, 0), (2, 10, 1), (4, 10, 0), (4, 10, 2), (4, 10, 3), (5, 20, 4),
+])
+def test_held_asset_allocation_blocks(assets_n: int, step: int, asset_idx: int):
+    rng = numpy.random.default_rng(seed=assets_n)
+    plan = YearRangePlan(
+        data_filter.years_all_to_all,
+        {str(year): list(rng.uniform(0.8, 1.25, size=assets_n)) for year in range(2000, 2008)})
+    held_n = data_source.held_asset_allocations_count(assets_n, step)
+    expected = sorted(
+        allocation for allocation in data_source.all_possible_allocations(assets_n, step) if allocation[asset_idx] > 0)
+    assert held_n == len(expected)
+    for start, stop, block_size in [(0, held_n, 7), (3, held_n - 2, 4), (held_n // 2, held_n + 5, 100)]:
+        blocks = list(data_source.held_asset_allocation_blocks(
+            plan, asset_idx, start, stop, assets_n, step, block_size, partials=True))
+        assert all(0 < len(block[0]) <= block_size for block in blocks)
+        weights = numpy.concatenate([block[0] for block in blocks])
+        if start == 0 and stop == held_n:
+            assert sorted(weights.tolist()) == expected
+        assert len(weights) == min(stop, held_n) - start
+        assert numpy.all(weights[:, asset_idx] > 0)
+        assert numpy.concatenate([block[2] for block in blocks]).tolist() == [
+            data_source.allocation_walk_rank(allocation, step) for allocation in weights.tolist()]
+        expected_stats, expected_partials = plan.simulate_weights(weights, partials=True)
+        assert numpy.allclose(numpy.concatenate([block[1] for block in blocks]), expected_stats)
+        assert numpy.allclose(numpy.concatenate([block[3] for block in blocks]), expected_partials)
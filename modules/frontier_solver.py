@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+# Investment Portfolio Optimizer
+# Copyright (C) 2024  Vladimir Looze
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from collections.abc import Callable
+import numpy
+from modules.portfolio import Portfolio
+from modules.batch_simulation import YearRangePlan
+
+_CAGR_IDX = Portfolio.STATS.index(Portfolio.STAT_CAGR_PERCENT)
+_VARIANCE_IDX = Portfolio.STATS.index(Portfolio.STAT_VARIANCE)
+_STDDEV_IDX = Portfolio.STATS.index(Portfolio.STAT_STDDEV)
+
+# first step of projected gradient ascent in percent of weight per unit of gradient, see _ascended
+_INITIAL_STEP = 10.0
+# ascent iterations of frontier ends and of every augmented Lagrangian round, see frontier_allocations
+_ENDS_ITERATIONS = 200
+_ROUND_ITERATIONS = 100
+_ROUNDS = 6
+# penalty of relative variance excess in CAGR percent, doubled every round
+_PENALTY = 10.0
+# solved weights are rounded to this fraction of percent
+_WEIGHT_UNITS = 10
+
+
+def simplex_projection(points: numpy.ndarray):
+    '''
+    Nearest allocations in percent (non-negative weights summing to 100) to rows of points:
+    points shifted down by common threshold and clipped at zero, threshold follows from
+    largest coordinates that stay positive
+    '''
+    descending = -numpy.sort(-points, axis=1)
+    excess = numpy.cumsum(descending, axis=1) - 100
+    counts = numpy.arange(1, points.shape[1] + 1)
+    positive_n = points.shape[1] - numpy.argmax((descending - excess / counts > 0)[:, ::-1], axis=1)
+    threshold = excess[numpy.arange(len(points)), positive_n - 1] / positive_n
+    return numpy.maximum(points - threshold[:, numpy.newaxis], 0)
+
+
+def _stats_gradients(plan: YearRangePlan, weights: numpy.ndarray):
+    '''
+    Stats (rows x stats) of (rows x assets) weights in percent and gradients of CAGR and Variance
+    by weights (rows x assets each). Range CAGR c is geometric mean of its n annual gains 1 + d,
+    its derivative by d of its year is (1 + c) / (n * (1 + d)). Range variance of annual gains around c
+    is (sum(d ** 2) - 2 * c * sum(d) + n * c ** 2) / (n - 1), its derivative by d of its year is
+    2 * (d - c + derivative of c * (n * c - sum(d))) / (n - 1). Derivatives of all ranges holding a year
+    add up to derivative of stats by that year, see YearRangePlan.range_year_sums.
+    '''
+    deltas = weights @ plan.returns.T / 100 - 1
+    ranges_len = (plan.ends - plan.starts + 1).astype(numpy.float64)
+    prefix_log = numpy.zeros((deltas.shape[0], deltas.shape[1] + 1))
+    numpy.cumsum(numpy.log1p(deltas), axis=1, out=prefix_log[:, 1:])
+    prefix_delta = numpy.zeros_like(prefix_log)
+    numpy.cumsum(deltas, axis=1, out=prefix_delta[:, 1:])
+    cagr = numpy.expm1((prefix_log[:, plan.ends + 1] - prefix_log[:, plan.starts]) / ranges_len)
+    sum_delta = prefix_delta[:, plan.ends + 1] - prefix_delta[:, plan.starts]
+    cagr_slopes = (1 + cagr) / ranges_len
+    variance_scale = numpy.broadcast_to(2 / (ranges_len - 1), cagr.shape)
+    year_sums = plan.range_year_sums(numpy.vstack((
+        cagr_slopes,
+        variance_scale,
+        variance_scale * cagr,
+        variance_scale * cagr_slopes * (ranges_len * cagr - sum_delta),
+    ))).reshape(4, *deltas.shape) / len(ranges_len)
+    cagr_years = year_sums[0] / (1 + deltas) * 100
+    variance_years = deltas * year_sums[1] - year_sums[2] + year_sums[3] / (1 + deltas)
+    return (
+        plan.simulate_annual_gains(deltas + 1),
+        cagr_years @ plan.returns / 100,
+        variance_years @ plan.returns / 100)
+
+
+def _ascended(plan: YearRangePlan, weights: numpy.ndarray, objective_func: Callable, iterations: int):
+    '''
+    Rows of weights moved by projected gradient ascent of objective_func(stats, cagr_gradients, variance_gradients),
+    which returns values and gradients by weights of rows. Step of every row doubles
+    while objective grows and halves when it does not, that step is not taken.
+    '''
+    weights = weights.copy()
+    steps = numpy.full(len(weights), _INITIAL_STEP)
+    values, gradients = objective_func(*_stats_gradients(plan, weights))
+    for _ in range(iterations):
+        trial = simplex_projection(weights + steps[:, numpy.newaxis] * gradients)
+        trial_values, trial_gradients = objective_func(*_stats_gradients(plan, trial))
+        ascended = trial_values > values
+        weights[ascended] = trial[ascended]
+        values[ascended] = trial_values[ascended]
+        gradients[ascended] = trial_gradients[ascended]
+        steps = numpy.where(ascended, steps * 2, steps / 2)
+    return weights
+
+
+def _rounded_allocations(weights: numpy.ndarray):
+    '''
+    Weights rounded to 1 / _WEIGHT_UNITS of percent, largest remainders rounded up to keep sum of 100
+    '''
+    units = weights * _WEIGHT_UNITS
+    rounded = numpy.floor(units)
+    shortfall = (100 * _WEIGHT_UNITS - numpy.sum(rounded, axis=1)).round().astype(int)
+    order = numpy.argsort(rounded - units, axis=1)
+    for row, row_shortfall in enumerate(shortfall.tolist()):
+        rounded[row, order[row, :row_shortfall]] += 1
+    return rounded / _WEIGHT_UNITS
+
+
+def _frontier_ends(plan: YearRangePlan):
+    '''
+    Weights of allocations of largest CAGR and of smallest Variance, ascended from uniform allocation.
+    Variance is scaled by Variance of uniform allocation to keep step sizes of both ends alike,
+    unless it is 0, e.g. when gains of assets offset each other every year.
+    '''
+    assets_n = plan.returns.shape[1]
+    uniform = numpy.full((2, assets_n), 100 / assets_n)
+    uniform_variance = plan.simulate_weights(uniform[:1])[0, _VARIANCE_IDX]
+    variance_scale = uniform_variance if uniform_variance > 0 else 1.0
+
+    def ends_objective(stats: numpy.ndarray, cagr_gradients: numpy.ndarray, variance_gradients: numpy.ndarray):
+        return (
+            numpy.array([stats[0, _CAGR_IDX], -stats[1, _VARIANCE_IDX] / variance_scale]),
+            numpy.vstack((cagr_gradients[0], -variance_gradients[1] / variance_scale)))
+    return _ascended(plan, uniform, ends_objective, _ENDS_ITERATIONS)
+
+
+def _targets_ascended(plan: YearRangePlan, weights: numpy.ndarray, targets: numpy.ndarray):
+    '''
+    Rows of weights moved to largest CAGR with Stddev not above target of every row:
+    augmented Lagrangian of Variance not above target squared is ascended in rounds,
+    multiplier of every target grows by penalty times its relative Variance excess after each round
+    '''
+    target_variances = targets ** 2
+    multipliers = numpy.zeros(len(targets))
+    penalty = _PENALTY
+
+    def targets_objective(stats: numpy.ndarray, cagr_gradients: numpy.ndarray, variance_gradients: numpy.ndarray):
+        excess = stats[:, _VARIANCE_IDX] / target_variances - 1
+        pressure = numpy.maximum(multipliers + penalty * excess, 0)
+        return (
+            stats[:, _CAGR_IDX] - (pressure ** 2 - multipliers ** 2) / (2 * penalty),
+            cagr_gradients - (pressure / target_variances)[:, numpy.newaxis] * variance_gradients)
+    for _ in range(_ROUNDS if len(targets) else 0):
+        weights = _ascended(plan, weights, targets_objective, _ROUND_ITERATIONS)
+        excess = plan.simulate_weights(weights)[:, _VARIANCE_IDX] / target_variances - 1
+        multipliers = numpy.maximum(multipliers + penalty * excess, 0)
+        penalty *= 2
+    return weights
+
+
+def frontier_allocations(plan: YearRangePlan, points_n: int):
+    '''
+    Weights in percent (at most points_n >= 2 rows x assets) and stats (points x stats) of continuous allocations
+    tracing CAGR vs Stddev (and so Variance) frontier, ordered by Stddev. Frontier ends are allocations
+    of largest CAGR and of smallest Variance, points between them have largest CAGR found for targets of Stddev
+    spread evenly between ends, see _targets_ascended. Targets of zero Stddev are left out.
+    Ascent is local, stats are not concave in weights, so these are best allocations near starting ones:
+    for targets these are ends mixed in proportion of target.
+    Duplicates of rounded allocations are dropped.
+    '''
+    ends = _frontier_ends(plan)
+    ends_stats = plan.simulate_weights(ends)
+    targets = numpy.linspace(ends_stats[1, _STDDEV_IDX], ends_stats[0, _STDDEV_IDX], points_n)[1:-1]
+    mix = numpy.linspace(0, 1, points_n)[1:-1][targets > 0]
+    weights = _targets_ascended(
+        plan, (1 - mix[:, numpy.newaxis]) * ends[1] + mix[:, numpy.newaxis] * ends[0], targets[targets > 0])
+    weights = _rounded_allocations(numpy.vstack((ends[1:], weights, ends[:1])))
+    _, first_idxs = numpy.unique(weights, axis=0, return_index=True)
+    weights = weights[numpy.sort(first_idxs)]
+    return weights, plan.simulate_weights(weights)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# Investment Portfolio Optimizer
+# Copyright (C) 2024  Vladimir Looze
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy
+import pytest
+from modules import data_filter
+from modules import data_source
+from modules import frontier_solver
+from modules.portfolio import Portfolio
+from modules.batch_simulation import YearRangePlan
+
+ASSETS_N = 5
+CAGR_IDX = Portfolio.STATS.index(Portfolio.STAT_CAGR_PERCENT)
+VARIANCE_IDX = Portfolio.STATS.index(Portfolio.STAT_VARIANCE)
+STDDEV_IDX = Portfolio.STATS.index(Portfolio.STAT_STDDEV)
+
+
+def _plan(year_range_selector_func):
+    rng = numpy.random.default_rng(seed=11)
+    return YearRangePlan(
+        year_range_selector_func,
+        {str(year): list(rng.uniform(0.75, 1.35, size=ASSETS_N)) for year in range(2000, 2015)})
+
+
+@pytest.mark.parametrize('points', [
+    [[20, 30, 50]],
+    [[120, -10, -10], [0, 0, 0], [50, 50, 50], [-5, 40, 90]],
+])
+def test_simplex_projection(points: list):
+    points = numpy.array(points, dtype=float)
+    projected = frontier_solver.simplex_projection(points)
+    assert numpy.allclose(projected.sum(axis=1), 100)
+    assert (projected >= 0).all()
+    # projection is closer than any allocation of 10% step
+    allocations = numpy.array(list(data_source.all_possible_allocations(points.shape[1], 10)))
+    for point, point_projected in zip(points, projected):
+        distance = numpy.sum((point - point_projected) ** 2)
+        assert distance <= numpy.min(numpy.sum((allocations - point) ** 2, axis=1)) + 1e-9
+
+
+@pytest.mark.parametrize('year_range_selector_func', [
+    data_filter.years_first_to_last,
+    data_filter.years_first_to_all,
+    data_filter.years_all_to_all,
+])
+def test_stats_gradients(year_range_selector_func):
+    plan = _plan(year_range_selector_func)
+    weights = numpy.random.default_rng(seed=2).dirichlet(numpy.ones(ASSETS_N), size=4) * 100
+    # pylint: disable=protected-access
+    stats, cagr_gradients, variance_gradients = frontier_solver._stats_gradients(plan, weights)
+    assert numpy.allclose(stats, plan.simulate_weights(weights))
+    shift = 1e-5
+    for asset_idx in range(ASSETS_N):
+        shifted = numpy.zeros(ASSETS_N)
+        shifted[asset_idx] = shift
+        slopes = (plan.simulate_weights(weights + shifted) - plan.simulate_weights(weights - shifted)) / (2 * shift)
+        assert numpy.allclose(cagr_gradients[:, asset_idx], slopes[:, CAGR_IDX], atol=1e-7)
+        assert numpy.allclose(variance_gradients[:, asset_idx], slopes[:, VARIANCE_IDX], atol=1e-9)
+
+
+@pytest.mark.parametrize('year_range_selector_func', [
+    data_filter.years_first_to_all,
+    data_filter.years_all_to_all,
+])
+def test_frontier_allocations(year_range_selector_func):
+    plan = _plan(year_range_selector_func)
+    weights, stats = frontier_solver.frontier_allocations(plan, 12)
+    assert 2 <= len(weights) <= 12
+    assert numpy.allclose(weights.sum(axis=1), 100)
+    assert (weights >= 0).all()
+    assert numpy.allclose(stats, plan.simulate_weights(weights))
+    assert len(set(map(tuple, weights.tolist()))) == len(weights)
+    # continuous allocations are at least as good as grid: no grid allocation has higher CAGR at lower Stddev
+    allocations_n = data_source.allocations_count(ASSETS_N, 5)
+    [(_, grid_stats, _, _)] = data_source.simulated_allocation_blocks(
+        plan, 0, allocations_n, ASSETS_N, 5, allocations_n)
+    for point_stats in stats:
+        dominating = (grid_stats[:, STDDEV_IDX] <= point_stats[STDDEV_IDX]) & \
+            (grid_stats[:, CAGR_IDX] > point_stats[CAGR_IDX] + 0.01)
+        assert not dominating.any()
+    # ends are largest CAGR and smallest Stddev
+    assert stats[-1, CAGR_IDX] >= numpy.max(grid_stats[:, CAGR_IDX]) - 0.01
+    assert stats[0, STDDEV_IDX] <= numpy.min(grid_stats[:, STDDEV_IDX]) + 1e-3
+
+
+@pytest.mark.parametrize('gains', [
+    # uniform allocation gains 1.02 every year, others do not
+    [[1.12, 0.92], [0.92, 1.12]],
+    # every allocation gains 1.02 every year
+    [[1.02, 1.02], [1.02, 1.02]],
+])
+def test_frontier_allocations_zero_variance(gains: list):
+    plan = YearRangePlan(data_filter.years_all_to_all, {str(year): gains[year % 2] for year in range(2000, 2010)})
+    with numpy.errstate(divide='raise', invalid='raise'):
+        weights, stats = frontier_solver.frontier_allocations(plan, 5)
+    assert numpy.allclose(weights.sum(axis=1), 100)
+    assert numpy.isfinite(stats).all()
+    assert stats[0, STDDEV_IDX] < 1e-6
@@ -16,14 +16,44 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import pickle
-import multiprocessing.connection
 import functools
+from collections.abc import Callable
+import numpy
 from modules import data_filter
 from modules import data_source
-from modules.data_filter import multilayer_convex_hull
 from modules.data_output import draw_circles_with_tooltips
 from modules.portfolio import Portfolio
+from modules.ring_buffer import RingBuffer
+
+
+def _batch_weights(
+        weights: numpy.ndarray, assets_n: int,
+        percentage_step: int, weights_encoding: str, portfolio_idxs=slice(None)):
+    '''
+    Weights matrix (assets x portfolios) for given columns of batch, rebuilt from ranks if needed
+    '''
+    if weights_encoding == Portfolio.WEIGHTS_RANK:
+        return data_source.allocation_walk_unrank_batch(weights[0, portfolio_idxs], assets_n, percentage_step).T
+    return weights[:, portfolio_idxs]
+
+
+def _batch_portfolios(
+        serialized_batch, assets: list[str],
+        percentage_step: int, weights_encoding: str, plot_idx: int = None):
+    '''
+    Portfolio objects of batch read in place. Batch prefiltered by simulator (plot_idx is given)
+    holds mask of plots every portfolio passes filter on, objects are created only for this plot.
+    Views of serialized batch do not outlive this call, so ring buffer slot can be released.
+    '''
+    stats, weights, plot_masks = Portfolio.batch_columns(
+        serialized_batch, len(assets), weights_encoding, plot_masks=plot_idx is not None)
+    portfolio_idxs = slice(None)
+    if plot_masks is not None:
+        portfolio_idxs = numpy.flatnonzero(plot_masks & numpy.uint64(1 << plot_idx))
+    return list(Portfolio.batch_portfolios(
+        stats[:, portfolio_idxs],
+        _batch_weights(weights, len(assets), percentage_step, weights_encoding, portfolio_idxs),
+        assets))
 
 
 # pylint: disable=too-many-arguments
@@ -31,27 +61,33 @@ from modules.portfolio import Portfolio
 # pylint: disable=too-many-locals
 def plotter_process_func(
         assets: list[str],
-        source: multiprocessing.connection.Connection = None,
+        source: RingBuffer = None,
+        consumer_idx: int = None,
+        percentage_step: int = None,
+        weights_encoding: str = Portfolio.WEIGHTS_INT32,
+        points_filter: Callable = None,
         coord_pair: tuple[str, str] = None,
-        hull_layers: int = None,
-        edge_layers: int = None,
         persistent_portfolios: list[Portfolio] = None,
         color_map: dict[str, tuple[int, int, int]] = None,
         plots_directory: str = None):
-    batches_hulls_points = []
-    data_stream_end_pickle = pickle.dumps(data_source.DataStreamFinished())
-    while True:
-        bytes_from_pipe = source.recv_bytes()
-        if bytes_from_pipe == data_stream_end_pickle:
-            break
-        deserialized_portfolios = Portfolio.deserialize_iter(bytes_from_pipe, assets=assets)
-        batch_xy_points = map(
-            functools.partial(data_filter.PortfolioXYTuplePoint, coord_pair=coord_pair), deserialized_portfolios)
-        batches_hulls_points.extend(
-            data_filter.multilayer_convex_hull(batch_xy_points, hull_layers, edge_layers))
-    convex_hull_points = multilayer_convex_hull(batches_hulls_points, hull_layers, edge_layers)
+    '''
+    points_filter (see data_filter.hull_points_filter) has already been applied to every chunk
+    by simulator, see data_filter.plot_masks. Here it is applied to all chunks merged.
+    '''
+    stat_y_idx = Portfolio.STATS.index(coord_pair[0])
+    stat_x_idx = Portfolio.STATS.index(coord_pair[1])
+    streaming_filter = data_filter.StreamingFilter(
+        functools.partial(points_filter, coord_pair=coord_pair) if points_filter is not None else None)
+    for block in source.consume(consumer_idx):
+        batch_portfolios = _batch_portfolios(
+            block, assets, percentage_step, weights_encoding,
+            consumer_idx if points_filter is not None else None)
+        streaming_filter.add(
+            [(portfolio.stats[stat_y_idx], portfolio.stats[stat_x_idx]) for portfolio in batch_portfolios],
+            [portfolio.number_of_assets() for portfolio in batch_portfolios],
+            batch_portfolios)
 
-    portfolios_for_plot = list(map(data_filter.PortfolioXYTuplePoint.portfolio, convex_hull_points))
+    portfolios_for_plot = streaming_filter.payloads()
     portfolios_for_plot.extend(persistent_portfolios)
     portfolios_for_plot.sort(key=lambda x: -x.number_of_assets())
     # plot_data = data_filter.compose_plot_data(portfolios_for_plot, field_x=coord_pair[1], field_y=coord_pair[0])
@@ -17,12 +17,11 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import struct
-from functools import partial
-from math import prod as math_prod
-from math import sumprod as math_sumprod
+from types import MappingProxyType
+import numpy
+from modules.batch_simulation import YearRangePlan
 
 
-# pylint: disable=too-many-instance-attributes
 class Portfolio:
     STAT_GAIN = 'Gain(x)'
     STAT_POP_PERCENT = 'Pop(%)'
@@ -31,35 +30,57 @@ class Portfolio:
     STAT_VARIANCE = 'Variance'
     STAT_STDDEV = 'Stddev'
     STAT_SHARPE = 'Sharpe'
+    # order of stats in serialized data and in simulated stats matrix
+    STATS = (
+        STAT_GAIN,
+        STAT_POP_PERCENT,
+        STAT_DIP_PERCENT,
+        STAT_CAGR_PERCENT,
+        STAT_VARIANCE,
+        STAT_STDDEV,
+        STAT_SHARPE,
+    )
+    # +1 if larger value of stat is better, -1 if smaller one is
+    STAT_OBJECTIVES = {
+        STAT_GAIN: 1,
+        STAT_POP_PERCENT: 1,
+        STAT_DIP_PERCENT: 1,
+        STAT_CAGR_PERCENT: 1,
+        STAT_VARIANCE: -1,
+        STAT_STDDEV: -1,
+        STAT_SHARPE: 1,
+    }
+    # encodings of weights in serialized batches, see serialize_batch
+    WEIGHTS_INT32 = 'int32'
+    WEIGHTS_UINT8 = 'uint8'
+    WEIGHTS_RANK = 'rank'
+    WEIGHTS_ENCODINGS = (WEIGHTS_INT32, WEIGHTS_UINT8, WEIGHTS_RANK)
 
-    @staticmethod
-    def static_portfolio(allocation: dict[str, int]):
-        assets = list(allocation.keys())
-        weights = list(allocation.values())
-        return Portfolio(assets=assets, weights=weights, plot_always=True, plot_marker='X')
+    # plotting defaults of simulated portfolios, StaticPortfolio keeps its own
+    plot_always = False
+    plot_marker = 'o'
+    _base_color = None
+    _label = ''
 
-    @staticmethod
-    def autoallocation_portfolio(plot_marker='s', allocation_func=None, color=None, label=''):
-        return Portfolio(
-            weights=[], assets=[],
-            plot_always=True, plot_marker=plot_marker, color=color, label=label,
-            allocation_func=allocation_func)
+    # plotters retain many simulated portfolios: no per-instance dict, stats are a tuple in STATS order
+    __slots__ = ('assets', 'weights', 'stats', '_number_of_assets')
 
-    # pylint: disable=too-many-arguments
-    # pylint: disable=too-many-positional-arguments
-    def __init__(self,
-                 weights: list[int], assets: list[str],
-                 plot_always=False, plot_marker='o', color=None, label='',
-                 allocation_func=None):
-        self.plot_marker = plot_marker
-        self.plot_always = plot_always
+    def __init__(self, weights: list[int], assets: list[str], stats: tuple[float, ...] = ()):
         self.assets = assets
         self.weights = weights
-        self.stat = {}
+        self.stats = stats
         self._number_of_assets = None
-        self._allocation_func = allocation_func
-        self._base_color = color
-        self._label = label
+
+    @property
+    def stat(self):
+        '''
+        Read-only stats by name, e.g. stat[Portfolio.STAT_CAGR_PERCENT], assign whole stat to change them
+        '''
+        return MappingProxyType(dict(zip(Portfolio.STATS, self.stats)))
+
+    @stat.setter
+    def stat(self, stat: dict[str, float]):
+        self.stats = tuple(stat[stat_name] for stat_name in Portfolio.STATS)
 
     def aligned_to_market(self, market_assets: list):
         assets = self.assets
@@ -70,45 +91,94 @@ class Portfolio:
             self.weights[market_assets.index(asset_name)] = weights[asset_idx]
         return self
 
-    @staticmethod
-    def deserialize_iter(serialized_data, assets: list[str]):
-        for portfolio_unpack in struct.iter_unpack(f'7f{len(assets)}i', serialized_data):
-            portfolio = Portfolio(assets=assets, weights=[])
-            portfolio.stat[Portfolio.STAT_GAIN], \
-                portfolio.stat[Portfolio.STAT_POP_PERCENT], \
-                portfolio.stat[Portfolio.STAT_DIP_PERCENT], \
-                portfolio.stat[Portfolio.STAT_CAGR_PERCENT], \
-                portfolio.stat[Portfolio.STAT_VARIANCE], \
-                portfolio.stat[Portfolio.STAT_STDDEV], \
-                portfolio.stat[Portfolio.STAT_SHARPE], \
-                *portfolio.weights = portfolio_unpack
-            yield portfolio
-
     @staticmethod
     def deserialize(serialized_data, assets: list[str]):
-        portfolio = Portfolio(assets=assets, weights=[])
-        portfolio.stat[Portfolio.STAT_GAIN], \
-            portfolio.stat[Portfolio.STAT_POP_PERCENT], \
-            portfolio.stat[Portfolio.STAT_DIP_PERCENT], \
-            portfolio.stat[Portfolio.STAT_CAGR_PERCENT], \
-            portfolio.stat[Portfolio.STAT_VARIANCE], \
-            portfolio.stat[Portfolio.STAT_STDDEV], \
-            portfolio.stat[Portfolio.STAT_SHARPE], \
-            *portfolio.weights = struct.unpack(f'7f{len(assets)}i', serialized_data)
-        return portfolio
+        record = struct.unpack(f'7f{len(assets)}i', serialized_data)
+        return Portfolio(assets=assets, weights=list(record[len(Portfolio.STATS):]),
+                         stats=record[:len(Portfolio.STATS)])
 
     def serialize(self):
-        return struct.pack(
-            f'7f{len(self.assets)}i',
-            self.stat[Portfolio.STAT_GAIN],
-            self.stat[Portfolio.STAT_POP_PERCENT],
-            self.stat[Portfolio.STAT_DIP_PERCENT],
-            self.stat[Portfolio.STAT_CAGR_PERCENT],
-            self.stat[Portfolio.STAT_VARIANCE],
-            self.stat[Portfolio.STAT_STDDEV],
-            self.stat[Portfolio.STAT_SHARPE],
-            *self.weights,
-        )
+        return struct.pack(f'7f{len(self.assets)}i', *self.stats, *self.weights)
+
+    @staticmethod
+    def serialized_size(assets_n: int, weights_encoding: str = WEIGHTS_INT32, plot_masks: bool = False):
+        '''
+        Size of one record, serialize() uses default encoding without plot masks
+        '''
+        size = struct.calcsize('7f')
+        if weights_encoding == Portfolio.WEIGHTS_RANK:
+            size += numpy.dtype(numpy.uint64).itemsize
+        else:
+            size += assets_n * numpy.dtype(weights_encoding).itemsize
+        if plot_masks:
+            size += numpy.dtype(numpy.uint64).itemsize
+        return size
+
+    @staticmethod
+    def serialize_batch(
+            stats: numpy.ndarray, weights: numpy.ndarray,
+            weights_encoding: str = WEIGHTS_INT32, ranks: numpy.ndarray = None,
+            plot_masks: numpy.ndarray = None):
+        '''
+        Columnar batch of records for matrices of stats and weights (portfolios x columns):
+        float32 column of every stat, then column of every asset weight in weights_encoding,
+        or single uint64 column of allocation ranks (see data_source.allocation_walk_rank),
+        then optional uint64 column of plot masks (see data_filter.plot_masks).
+        Number of records follows from buffer length.
+        '''
+        portfolios_n = len(stats)
+        record_size = Portfolio.serialized_size(weights.shape[1], weights_encoding, plot_masks is not None)
+        batch = numpy.empty(portfolios_n * record_size, dtype=numpy.uint8)
+        stats_end = portfolios_n * len(Portfolio.STATS) * 4
+        batch[:stats_end].view(numpy.float32).reshape(len(Portfolio.STATS), portfolios_n)[:] = stats.T
+        masks_start = len(batch) - (0 if plot_masks is None else portfolios_n * 8)
+        if weights_encoding == Portfolio.WEIGHTS_RANK:
+            batch[stats_end:masks_start].view(numpy.uint64)[:] = ranks
+        else:
+            batch[stats_end:masks_start].view(weights_encoding).reshape(weights.shape[1], portfolios_n)[:] = weights.T
+        if plot_masks is not None:
+            batch[masks_start:].view(numpy.uint64)[:] = plot_masks
+        return batch
+
+    @staticmethod
+    def batch_columns(
+            serialized_batch, assets_n: int,
+            weights_encoding: str = WEIGHTS_INT32, plot_masks: bool = False):
+        '''
+        Stats (stats x portfolios), weights (assets x portfolios) and plot masks (or None) of
+        serialize_batch() data, views into serialized_batch without copying.
+        Weights matrix of rank encoding is single row of ranks.
+        '''
+        portfolios_n = len(serialized_batch) // Portfolio.serialized_size(assets_n, weights_encoding, plot_masks)
+        stats = numpy.frombuffer(
+            serialized_batch, dtype=numpy.float32, count=len(Portfolio.STATS) * portfolios_n)
+        if weights_encoding == Portfolio.WEIGHTS_RANK:
+            weights = numpy.frombuffer(
+                serialized_batch, dtype=numpy.uint64, count=portfolios_n, offset=stats.nbytes)
+        else:
+            weights = numpy.frombuffer(
+                serialized_batch, dtype=weights_encoding, count=assets_n * portfolios_n, offset=stats.nbytes)
+        masks = None
+        if plot_masks:
+            masks = numpy.frombuffer(
+                serialized_batch, dtype=numpy.uint64, count=portfolios_n, offset=stats.nbytes + weights.nbytes)
+        return stats.reshape(len(Portfolio.STATS), portfolios_n), weights.reshape(-1, portfolios_n), masks
+
+    @staticmethod
+    def batch_portfolios(stats: numpy.ndarray, weights: numpy.ndarray, assets: list[str], portfolio_idxs=None):
+        '''
+        Portfolio objects for given columns (all by default) of stats and weights matrices
+        '''
+        if portfolio_idxs is None:
+            portfolio_idxs = slice(None)
+        for portfolio_stats, portfolio_weights in zip(
+                stats[:, portfolio_idxs].T.tolist(), weights[:, portfolio_idxs].T.tolist()):
+            yield Portfolio(assets=assets, weights=portfolio_weights, stats=tuple(portfolio_stats))
+
+    @staticmethod
+    def deserialize_iter(serialized_batch, assets: list[str]):
+        stats, weights, _ = Portfolio.batch_columns(serialized_batch, len(assets))
+        yield from Portfolio.batch_portfolios(stats, weights, assets)
 
     def number_of_assets(self):
         '''
@@ -128,70 +198,11 @@ class Portfolio:
                 f'add them to asset_colors.py: {set(self.assets) - set(color_map.keys())}'
         return ''
 
-    # pylint: disable=too-many-locals
-    @staticmethod
-    def _simulate_y2y(year_range, allocation, asset_gain_per_year):
-        year_start, year_end = year_range
-        years_list = list(asset_gain_per_year.keys())
-        years_range = years_list[years_list.index(year_start):years_list.index(year_end) + 1]
-        annual_gains = [
-            math_sumprod(asset_gain_per_year[year], allocation) / 100 for year in years_range
-        ]
-        stat_gain = math_prod(annual_gains)
-        stat_pop = max(annual_gains)
-        stat_pop = stat_pop - 1 if stat_pop > 1 else 0
-        stat_dip = min(annual_gains)
-        stat_dip = stat_dip - 1 if stat_dip < 1 else 0
-        stat_cagr = stat_gain ** (1 / len(annual_gains)) - 1
-        stat_var = sum(map(lambda ag: (ag - stat_cagr - 1) ** 2, annual_gains)) / (len(annual_gains) - 1)
-        return stat_gain, stat_pop, stat_dip, stat_cagr, stat_var
-
-    # pylint: disable=too-many-locals
-    @staticmethod
-    def _simulate_y2y_allocation_func(year_range, allocation_func, asset_gain_per_year):
-        year_start, year_end = year_range
-        years_list = list(asset_gain_per_year.keys())
-        years_range = years_list[years_list.index(year_start):years_list.index(year_end) + 1]
-        annual_gains = [
-            allocation_func(asset_gain_per_year[year]) for year in years_range
-        ]
-        stat_gain = math_prod(annual_gains)
-        stat_pop = max(annual_gains)
-        stat_pop = stat_pop - 1 if stat_pop > 1 else 0
-        stat_dip = min(annual_gains)
-        stat_dip = stat_dip - 1 if stat_dip < 1 else 0
-        stat_cagr = stat_gain ** (1 / len(annual_gains)) - 1
-        stat_var = sum(map(lambda ag: (ag - stat_cagr - 1) ** 2, annual_gains)) / (len(annual_gains) - 1)
-        return stat_gain, stat_pop, stat_dip, stat_cagr, stat_var
-
-    def simulate(self, year_range_selector_func, asset_gain_per_year):
-        if self._allocation_func:
-            stats_per_year_range = list(map(
-                partial(Portfolio._simulate_y2y_allocation_func,
-                    allocation_func=self._allocation_func,
-                    asset_gain_per_year=asset_gain_per_year),
-                year_range_selector_func(sorted(asset_gain_per_year.keys()))
-            ))
-        else:
-            stats_per_year_range = list(map(
-                partial(Portfolio._simulate_y2y,
-                    allocation=self.weights,
-                    asset_gain_per_year=asset_gain_per_year),
-                year_range_selector_func(sorted(asset_gain_per_year.keys()))
-            ))
-        stat_gain, stat_pop, stat_dip, stat_cagr, stat_var = \
-            (sum(stat_values) / len(stats_per_year_range) for stat_values in zip(*stats_per_year_range))
-        self.stat[Portfolio.STAT_GAIN] = stat_gain
-        self.stat[Portfolio.STAT_POP_PERCENT] = stat_pop * 100
-        self.stat[Portfolio.STAT_DIP_PERCENT] = stat_dip * 100
-        self.stat[Portfolio.STAT_VARIANCE] = stat_var
-        self.stat[Portfolio.STAT_STDDEV] = stat_var ** 0.5
-        self.stat[Portfolio.STAT_SHARPE] = \
-            stat_cagr / self.stat[Portfolio.STAT_STDDEV] if self.stat[Portfolio.STAT_STDDEV] else 0
-        self.stat[Portfolio.STAT_CAGR_PERCENT] = stat_cagr * 100
-
-    def simulated(self, year_range_selector_func, asset_gain_per_year):
-        self.simulate(year_range_selector_func=year_range_selector_func, asset_gain_per_year=asset_gain_per_year)
+    def simulate(self, plan: YearRangePlan):
+        self.stats = tuple(plan.simulate_weights(numpy.array([self.weights]))[0].tolist())
+
+    def simulated(self, plan: YearRangePlan):
+        self.simulate(plan)
         return self
 
     def __repr__(self):
@@ -252,3 +263,43 @@ class Portfolio:
             'size': 100 if self.plot_always else 50 / self.number_of_assets(),
             'linewidth': 0.5 if self.plot_always else 1 / self.number_of_assets(),
         }
+
+
+class StaticPortfolio(Portfolio):
+    '''
+    Portfolio from configuration or theoretical autoallocation portfolio,
+    always plotted with its own marker, color and label
+    '''
+    __slots__ = ('plot_always', 'plot_marker', '_base_color', '_label', '_allocation_func')
+
+    @staticmethod
+    def static_portfolio(allocation: dict[str, int]):
+        assets = list(allocation.keys())
+        weights = list(allocation.values())
+        return StaticPortfolio(assets=assets, weights=weights, plot_marker='X')
+
+    @staticmethod
+    def autoallocation_portfolio(plot_marker='s', allocation_func=None, color=None, label=''):
+        return StaticPortfolio(
+            weights=[], assets=[],
+            plot_marker=plot_marker, color=color, label=label,
+            allocation_func=allocation_func)
+
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-positional-arguments
+    def __init__(self,
+                 weights: list[int], assets: list[str],
+                 plot_marker='o', color=None, label='',
+                 allocation_func=None):
+        super().__init__(weights=weights, assets=assets)
+        self.plot_always = True
+        self.plot_marker = plot_marker
+        self._base_color = color
+        self._label = label
+        self._allocation_func = allocation_func
+
+    def simulate(self, plan: YearRangePlan):
+        if self._allocation_func:
+            self.stats = tuple(plan.simulate_allocation_func(self._allocation_func)[0].tolist())
+        else:
+            super().simulate(plan)
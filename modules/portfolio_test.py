@@ -17,9 +17,14 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import functools
+import tracemalloc
+import numpy
 import pytest
 from modules.portfolio import Portfolio
+from modules.portfolio import StaticPortfolio
 from modules import data_filter
+from modules import data_source
+from modules.batch_simulation import YearRangePlan
 
 
 def test_portfolio_serialize():
@@ -28,13 +33,15 @@ def test_portfolio_serialize():
         assets=['AAPL', 'MSFT', 'GOOG'],
         weights=[10, 40, 50],
     )
-    portfolio.stat[Portfolio.STAT_GAIN] = 0.12345
-    portfolio.stat[Portfolio.STAT_POP_PERCENT] = 0.54321
-    portfolio.stat[Portfolio.STAT_DIP_PERCENT] = 0.67890
-    portfolio.stat[Portfolio.STAT_STDDEV] = 0.23456
-    portfolio.stat[Portfolio.STAT_CAGR_PERCENT] = 0.34567
-    portfolio.stat[Portfolio.STAT_VARIANCE] = 0.45678
-    portfolio.stat[Portfolio.STAT_SHARPE] = 0.56789
+    portfolio.stat = {
+        Portfolio.STAT_GAIN: 0.12345,
+        Portfolio.STAT_POP_PERCENT: 0.54321,
+        Portfolio.STAT_DIP_PERCENT: 0.67890,
+        Portfolio.STAT_STDDEV: 0.23456,
+        Portfolio.STAT_CAGR_PERCENT: 0.34567,
+        Portfolio.STAT_VARIANCE: 0.45678,
+        Portfolio.STAT_SHARPE: 0.56789,
+    }
 
     serialized = portfolio.serialize()
     deserialized = Portfolio.deserialize(serialized, assets=portfolio.assets)
@@ -63,16 +70,20 @@ def test_portfolio_serialize_batch():
             assets=['AAPL', 'MSFT', 'GOOG'],
             weights=[100 - i, i, 0],
         )
-        portfolio.stat[Portfolio.STAT_GAIN] = 0.12345 * i
-        portfolio.stat[Portfolio.STAT_POP_PERCENT] = 0.54321 * i
-        portfolio.stat[Portfolio.STAT_DIP_PERCENT] = 0.67890 * i
-        portfolio.stat[Portfolio.STAT_STDDEV] = 0.23456 * i
-        portfolio.stat[Portfolio.STAT_CAGR_PERCENT] = 0.34567 * i
-        portfolio.stat[Portfolio.STAT_VARIANCE] = 0.45678 * i
-        portfolio.stat[Portfolio.STAT_SHARPE] = 0.56789 * i
+        portfolio.stat = {
+            Portfolio.STAT_GAIN: 0.12345 * i,
+            Portfolio.STAT_POP_PERCENT: 0.54321 * i,
+            Portfolio.STAT_DIP_PERCENT: 0.67890 * i,
+            Portfolio.STAT_STDDEV: 0.23456 * i,
+            Portfolio.STAT_CAGR_PERCENT: 0.34567 * i,
+            Portfolio.STAT_VARIANCE: 0.45678 * i,
+            Portfolio.STAT_SHARPE: 0.56789 * i,
+        }
         portfolios.append(portfolio)
 
-    serialized = b''.join(p.serialize() for p in portfolios)
+    serialized = Portfolio.serialize_batch(
+        numpy.array([[p.stat[stat] for stat in Portfolio.STATS] for p in portfolios]),
+        numpy.array([p.weights for p in portfolios]))
     deserialized = list(Portfolio.deserialize_iter(serialized, assets=portfolio.assets))
     for i in range(100):
         assert portfolios[i].stat[Portfolio.STAT_GAIN] - \
@@ -92,6 +103,56 @@ def test_portfolio_serialize_batch():
         assert portfolios[i].weights == deserialized[i].weights
 
 
+def _batch_columns_round_trip(
+        stats: numpy.ndarray, weights: numpy.ndarray, step: int, weights_encoding: str, masks: numpy.ndarray):
+    '''
+    Stats and weights (columns x portfolios) of serialized batch of portfolios, checking its size and plot masks
+    '''
+    ranks = numpy.array([data_source.allocation_walk_rank(allocation, step) for allocation in weights.tolist()],
+                        dtype=numpy.uint64)
+    serialized = Portfolio.serialize_batch(stats, weights, weights_encoding, ranks, masks)
+    assets_n = weights.shape[1]
+    assert len(serialized) == len(weights) * Portfolio.serialized_size(assets_n, weights_encoding, masks is not None)
+    batch_stats, batch_weights, batch_masks = Portfolio.batch_columns(
+        serialized, assets_n, weights_encoding, masks is not None)
+    if masks is not None:
+        assert (batch_masks == masks).all()
+    else:
+        assert batch_masks is None
+    if weights_encoding == Portfolio.WEIGHTS_RANK:
+        batch_weights = data_source.allocation_walk_unrank_batch(batch_weights[0], assets_n, step).T
+    return batch_stats, batch_weights
+
+
+@pytest.mark.parametrize('plot_masks', [False, True])
+@pytest.mark.parametrize('weights_encoding', Portfolio.WEIGHTS_ENCODINGS)
+def test_portfolio_serialize_batch_encodings(weights_encoding: str, plot_masks: bool):
+    assets = ['AAPL', 'MSFT', 'GOOG', 'AMZN']
+    step = 5
+    weights = numpy.array(list(data_source.all_possible_allocations(len(assets), step)))
+    stats = numpy.arange(len(weights) * len(Portfolio.STATS), dtype=numpy.float64) \
+        .reshape(len(weights), len(Portfolio.STATS)) / 7
+    masks = numpy.arange(len(weights), dtype=numpy.uint64) * numpy.uint64(0x0123456789) if plot_masks else None
+    batch_stats, batch_weights = _batch_columns_round_trip(stats, weights, step, weights_encoding, masks)
+    for portfolio, allocation, allocation_stats in zip(
+            Portfolio.batch_portfolios(batch_stats, batch_weights, assets), weights.tolist(), stats):
+        expected = Portfolio(assets=assets, weights=allocation)
+        expected.stat = dict(zip(Portfolio.STATS, allocation_stats.tolist()))
+        deserialized = Portfolio.deserialize(portfolio.serialize(), assets=assets)
+        assert deserialized.weights == allocation
+        assert deserialized.serialize() == expected.serialize()
+
+
+def test_portfolio_stat_read_only():
+    portfolio = Portfolio(assets=['AAPL', 'MSFT'], weights=[30, 70], stats=tuple(range(len(Portfolio.STATS))))
+    # stats are kept as tuple, item assignment would change only a copy of them
+    with pytest.raises(TypeError):
+        portfolio.stat[Portfolio.STAT_CAGR_PERCENT] = 10.0
+    portfolio.stat = {**portfolio.stat, Portfolio.STAT_CAGR_PERCENT: 10.0}
+    assert portfolio.stat[Portfolio.STAT_CAGR_PERCENT] == 10.0
+    assert portfolio.stats[Portfolio.STATS.index(Portfolio.STAT_GAIN)] == 0
+
+
 # values marked with "manually verified" are verified by LibreOffice spreadsheet
 @pytest.mark.parametrize(
     'year_selector_func,expected_stats',
@@ -194,6 +255,66 @@ def test_portfolio_simulate(year_selector_func, expected_stats):
         2014: [1.01, 1.02, 0.97, 1.09],
         2015: [1.08, 1.08, 1.02, 1.22],
     }
-    portfolio.simulate(year_selector_func, asset_gain_per_year)
+    portfolio.simulate(YearRangePlan(year_selector_func, asset_gain_per_year))
     for stat, expected_stat in expected_stats.items():
         assert stat and abs(portfolio.stat[stat] - expected_stat) < epsilon
+
+
+def test_static_portfolio():
+    asset_gain_per_year = {
+        2000: [1.03, 1.04],
+        2001: [0.99, 1.09],
+        2002: [1.02, 0.97],
+    }
+    plan = YearRangePlan(data_filter.years_all_to_all, asset_gain_per_year)
+    portfolio = StaticPortfolio.static_portfolio({'MSFT': 60, 'AAPL': 40}).aligned_to_market(['AAPL', 'MSFT'])
+    assert portfolio.plot_always and portfolio.plot_marker == 'X'
+    assert portfolio.simulated(plan).stats == Portfolio(assets=['AAPL', 'MSFT'], weights=[40, 60]).simulated(plan).stats
+    autoallocation = StaticPortfolio.autoallocation_portfolio(allocation_func=max, label='Maximum gain')
+    assert autoallocation.simulated(plan).stats == tuple(plan.simulate_allocation_func(max)[0].tolist())
+    assert not Portfolio(assets=[], weights=[]).plot_always
+
+
+class _DictPortfolio:
+    '''
+    Layout of simulated portfolio before it got slots and stats tuple
+    '''
+    # pylint: disable=too-many-instance-attributes
+    # pylint: disable=too-few-public-methods
+    def __init__(self, weights: list[int], assets: list[str], stat: dict[str, float]):
+        self.plot_marker = 'o'
+        self.plot_always = False
+        self.assets = assets
+        self.weights = weights
+        self.stat = stat
+        self._number_of_assets = None
+        self._allocation_func = None
+        self._base_color = None
+        self._label = ''
+
+
+def _retained_bytes_per_portfolio(portfolio_factory, portfolios_n: int = 10000):
+    assets = ['AAPL', 'MSFT', 'GOOG', 'AMZN']
+    records = [([1, 2, 3, 94], [float(i + stat_idx) for stat_idx in range(len(Portfolio.STATS))])
+               for i in range(portfolios_n)]
+    tracemalloc.start()
+    snapshot_before = tracemalloc.take_snapshot()
+    portfolios = [portfolio_factory(assets, weights, stats) for weights, stats in records]
+    snapshot_after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    retained = sum(stat.size_diff for stat in snapshot_after.compare_to(snapshot_before, 'filename'))
+    assert len(portfolios) == portfolios_n
+    return retained / portfolios_n
+
+
+def test_portfolio_memory_benchmark():
+    '''
+    Bytes retained per simulated portfolio (weights list shared by both layouts):
+    slots layout retains less than half of dict one
+    '''
+    dict_bytes = _retained_bytes_per_portfolio(
+        lambda assets, weights, stats: _DictPortfolio(weights, assets, dict(zip(Portfolio.STATS, stats))))
+    slots_bytes = _retained_bytes_per_portfolio(
+        lambda assets, weights, stats: Portfolio(weights, assets, tuple(stats)))
+    assert not hasattr(Portfolio(weights=[], assets=[]), '__dict__')
+    assert slots_bytes < dict_bytes / 2
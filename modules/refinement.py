@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+# Investment Portfolio Optimizer
+# Copyright (C) 2024  Vladimir Looze
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+from collections.abc import Callable
+from typing import NamedTuple
+import numpy
+from modules import data_source
+from modules.portfolio import Portfolio
+from modules.batch_simulation import YearRangePlan
+from modules.allocation_constraints import AllocationConstraints
+
+
+def refinement_steps(percentage_step: int):
+    '''
+    Finer steps to refine allocations of given step at, down to 1%:
+    every step is the largest divisor of the previous one, so grids are nested, e.g. 10 -> 5 -> 1
+    '''
+    steps = []
+    while percentage_step > 1:
+        percentage_step = max(
+            divisor for divisor in range(1, percentage_step) if percentage_step % divisor == 0)
+        steps.append(percentage_step)
+    return steps
+
+
+def neighbour_allocations(allocations: numpy.ndarray, step: int, radius: int):
+    '''
+    Unique allocations reached from rows of allocations matrix by moving up to radius percent,
+    in multiples of step, from one asset to another, as allocation_walk moves do
+    '''
+    assets_n = allocations.shape[1]
+    moves = []
+    for from_idx in range(assets_n):
+        for to_idx in range(assets_n):
+            if from_idx == to_idx:
+                continue
+            for move_size in range(step, radius + 1, step):
+                move = numpy.zeros(assets_n, dtype=numpy.int32)
+                move[from_idx] -= move_size
+                move[to_idx] += move_size
+                moves.append(move)
+    if len(moves) == 0 or len(allocations) == 0:
+        return numpy.empty((0, assets_n), dtype=numpy.int32)
+    neighbours = (allocations[:, numpy.newaxis, :] + numpy.array(moves)[numpy.newaxis]).reshape(-1, assets_n)
+    return numpy.unique(neighbours[(neighbours >= 0).all(axis=1)], axis=0)
+
+
+class _Frontier(NamedTuple):
+    '''
+    Portfolios passing plot masks filter on some plot among all portfolios added so far,
+    each tagged with refinement round it was found in
+    '''
+    weights: numpy.ndarray
+    stats: numpy.ndarray
+    tags: numpy.ndarray
+
+
+def _frontier_added(
+        frontier: _Frontier, plot_masks_func: Callable, weights: numpy.ndarray, stats: numpy.ndarray, tag: int):
+    '''
+    Frontier with block of portfolios merged, and weights, stats and plot masks of its portfolios that passed
+    '''
+    # filter on values as plotters will see them after serialization
+    merged_stats = numpy.concatenate((frontier.stats, stats.astype(numpy.float32)))
+    merged_weights = numpy.concatenate((frontier.weights, weights.astype(numpy.int32)))
+    merged_tags = numpy.concatenate((frontier.tags, numpy.full(len(weights), tag)))
+    plot_masks = plot_masks_func(merged_stats, numpy.count_nonzero(merged_weights, axis=1))
+    passed = numpy.flatnonzero(plot_masks)
+    added = passed[passed >= len(merged_stats) - len(weights)]
+    return (
+        _Frontier(merged_weights[passed], merged_stats[passed], merged_tags[passed]),
+        (merged_weights[added], merged_stats[added], plot_masks[added]))
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-positional-arguments
+# pylint: disable=too-many-locals
+def refined_blocks(
+        plan: YearRangePlan, assets_n: int, percentage_step: int,
+        chunk_size: int, plot_masks_func: Callable, constraints: AllocationConstraints = None):
+    '''
+    Yield (weights, stats, plot masks) blocks of portfolios passing plot masks filter on some plot
+    (see data_filter.plot_masks), among all allocations of percentage_step and then among
+    neighbourhoods of frontier at finer steps down to 1% (see refinement_steps):
+    allocations within previous step of every portfolio on frontier are simulated at next step,
+    then neighbours of portfolios that joined frontier are simulated in rounds until none joins it.
+    Later blocks may push portfolios of earlier ones off frontier, plotters filter them out.
+    With constraints only allocations satisfying them are simulated.
+    '''
+    frontier = _Frontier(
+        numpy.empty((0, assets_n), dtype=numpy.int32),
+        numpy.empty((0, len(Portfolio.STATS)), dtype=numpy.float32),
+        numpy.empty(0, dtype=numpy.int64))
+    if constraints is not None:
+        simulated_n = constraints.allocations_count(percentage_step)
+    else:
+        simulated_n = data_source.allocations_count(assets_n, percentage_step)
+    for weights, stats, _, _ in data_source.simulated_allocation_blocks(
+            plan, 0, simulated_n, assets_n, percentage_step, chunk_size, constraints=constraints, ranked=False):
+        frontier, added = _frontier_added(frontier, plot_masks_func, weights, stats, 0)
+        yield added
+    logging.info('refine: %d portfolios at %d%%, %d on frontier', simulated_n, percentage_step, len(frontier.tags))
+    visited = set()
+    previous_step = percentage_step
+    refine_round = 0
+    for step in refinement_steps(percentage_step):
+        survivors = frontier.weights
+        radius = previous_step - step
+        step_simulated_n = 0
+        while len(survivors) > 0:
+            refine_round += 1
+            candidates = neighbour_allocations(survivors, step, radius)
+            # all allocations of first step are simulated already
+            candidates = candidates[(candidates % percentage_step != 0).any(axis=1)]
+            if constraints is not None:
+                candidates = candidates[constraints.satisfied(candidates)]
+            fresh = [
+                candidate_idx for candidate_idx, candidate in enumerate(map(bytes, candidates))
+                if candidate not in visited]
+            candidates = candidates[fresh]
+            visited.update(map(bytes, candidates))
+            for block_start in range(0, len(candidates), chunk_size):
+                weights = candidates[block_start:block_start + chunk_size]
+                frontier, added = _frontier_added(
+                    frontier, plot_masks_func, weights, plan.simulate_weights(weights), refine_round)
+                yield added
+            step_simulated_n += len(candidates)
+            survivors = frontier.weights[frontier.tags == refine_round]
+            radius = step
+        logging.info('refine: %d portfolios at %d%%, %d on frontier', step_simulated_n, step, len(frontier.tags))
+        simulated_n += step_simulated_n
+        previous_step = step
+    if constraints is not None:
+        allocations_n = constraints.allocations_count(previous_step)
+    else:
+        allocations_n = data_source.allocations_count(assets_n, previous_step)
+    logging.info('refine: simulated %d of %d allocations at %d%%', simulated_n, allocations_n, previous_step)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+# Investment Portfolio Optimizer
+# Copyright (C) 2024  Vladimir Looze
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import functools
+import numpy
+import pytest
+from modules import data_filter
+from modules import data_source
+from modules import refinement
+from modules.portfolio import Portfolio
+from modules.ring_buffer import RingBuffer
+from modules.batch_simulation import YearRangePlan
+from modules.allocation_constraints import AllocationConstraints
+from modules.simulator import refine_process_func
+from modules.simulation_testing import ASSET_GAIN_PER_YEAR
+from modules.simulation_testing import ASSETS
+COORD_PAIRS = [
+    (Portfolio.STAT_CAGR_PERCENT, Portfolio.STAT_STDDEV),
+    (Portfolio.STAT_SHARPE, Portfolio.STAT_DIP_PERCENT),
+]
+
+
+@pytest.mark.parametrize('percentage_step, expected_steps', [
+    (1, []),
+    (2, [1]),
+    (5, [1]),
+    (10, [5, 1]),
+    (20, [10, 5, 1]),
+    (25, [5, 1]),
+    (50, [25, 5, 1]),
+])
+def test_refinement_steps(percentage_step: int, expected_steps: list[int]):
+    assert refinement.refinement_steps(percentage_step) == expected_steps
+
+
+@pytest.mark.parametrize('step, radius', [(5, 5), (1, 4), (1, 1)])
+def test_neighbour_allocations(step: int, radius: int):
+    allocations = numpy.array([[100, 0, 0], [50, 30, 20]])
+    neighbours = refinement.neighbour_allocations(allocations, step, radius)
+    expected = set()
+    for allocation in allocations.tolist():
+        for from_idx in range(3):
+            for to_idx in range(3):
+                for move_size in range(step, radius + 1, step):
+                    neighbour = list(allocation)
+                    neighbour[from_idx] -= move_size
+                    neighbour[to_idx] += move_size
+                    if from_idx != to_idx and neighbour[from_idx] >= 0:
+                        expected.add(tuple(neighbour))
+    assert sorted(map(tuple, neighbours.tolist())) == sorted(expected)
+    assert refinement.neighbour_allocations(allocations[:0], step, radius).shape == (0, 3)
+
+
+def _frontier(weights: numpy.ndarray, stats: numpy.ndarray, plot_masks_func):
+    plot_masks = plot_masks_func(stats.astype(numpy.float32), numpy.count_nonzero(weights, axis=1))
+    return sorted(map(tuple, weights[plot_masks != 0].tolist()))
+
+
+@pytest.mark.parametrize('points_filter, min_found_share', [
+    (functools.partial(data_filter.hull_points_filter, hull_layers=1, edge_layers=0), 0.9),
+    (functools.partial(data_filter.pareto_points_filter, pareto_layers=1, edge_layers=0), 1.0),
+])
+@pytest.mark.parametrize('percentage_step', [10, 20])
+def test_refined_blocks(points_filter, min_found_share: float, percentage_step: int):
+    plan = YearRangePlan(data_filter.years_all_to_all, ASSET_GAIN_PER_YEAR)
+    plot_masks_func = functools.partial(data_filter.plot_masks, coord_pairs=COORD_PAIRS, points_filter=points_filter)
+    blocks = list(refinement.refined_blocks(plan, 4, percentage_step, 100, plot_masks_func))
+    weights = numpy.concatenate([block[0] for block in blocks])
+    stats = numpy.concatenate([block[1] for block in blocks])
+    assert len(weights) == len(set(map(tuple, weights.tolist())))
+    portfolios_n = data_source.allocations_count(4, 1)
+    [(all_weights, all_stats, _, _)] = data_source.simulated_allocation_blocks(
+        plan, 0, portfolios_n, 4, 1, portfolios_n)
+    # frontier of 1% allocations is approximated: most of its portfolios are found
+    frontier = set(_frontier(all_weights, all_stats, plot_masks_func))
+    refined_frontier = set(_frontier(weights, stats, plot_masks_func))
+    assert len(frontier & refined_frontier) >= min_found_share * len(frontier)
+
+
+def test_refined_blocks_constraints():
+    plan = YearRangePlan(data_filter.years_all_to_all, ASSET_GAIN_PER_YEAR)
+    plot_masks_func = functools.partial(
+        data_filter.plot_masks, coord_pairs=COORD_PAIRS,
+        points_filter=functools.partial(data_filter.pareto_points_filter, pareto_layers=1, edge_layers=0))
+    constraints = AllocationConstraints(4, min_weights=[20, 0, 0, 0], max_weights=[100, 30, 100, 100], max_assets_n=3)
+    blocks = list(refinement.refined_blocks(plan, 4, 10, 100, plot_masks_func, constraints))
+    weights = numpy.concatenate([block[0] for block in blocks])
+    assert len(weights) > 0
+    assert constraints.satisfied(weights).all()
+
+
+def test_refine_process_func():
+    plan = YearRangePlan(data_filter.years_all_to_all, ASSET_GAIN_PER_YEAR)
+    plot_masks_func = functools.partial(
+        data_filter.plot_masks, coord_pairs=COORD_PAIRS,
+        points_filter=functools.partial(data_filter.hull_points_filter, hull_layers=1, edge_layers=0))
+    sink = RingBuffer(consumers_n=1, slots_n=10000, slot_size=100 * Portfolio.serialized_size(4, plot_masks=True))
+    refine_process_func(
+        assets=ASSETS, percentage_step=10, plan=plan, sink=sink,
+        chunk_size=100, plot_masks_func=plot_masks_func)
+    batches = [
+        Portfolio.batch_columns(bytes(block), 4, plot_masks=True) for block in sink.consume(0)]
+    sink.close(unlink=True)
+    weights = numpy.concatenate([batch[1] for batch in batches], axis=1).T
+    stats = numpy.concatenate([batch[0] for batch in batches], axis=1).T
+    assert all((batch[2] != 0).all() for batch in batches)
+    blocks = list(refinement.refined_blocks(plan, 4, 10, 100, plot_masks_func))
+    assert numpy.array_equal(weights, numpy.concatenate([block[0] for block in blocks]))
+    assert numpy.array_equal(stats, numpy.concatenate([block[1] for block in blocks]))
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+# Investment Portfolio Optimizer
+# Copyright (C) 2024  Vladimir Looze
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import json
+import hashlib
+import logging
+import numpy
+
+# bump when record layout or simulation changes, old entries are then never hit again and get evicted
+CACHE_VERSION = 2
+_RECORDS_SUFFIX = '.bin'
+_PARTIALS_SUFFIX = '.partials'
+_META_SUFFIX = '.json'
+_TEMPORARY_SUFFIX = '.tmp'
+
+
+def record_dtype(assets_n: int):
+    '''
+    Packed record of one simulated portfolio: float32 stats as plotters see them,
+    weights in percent and allocation_walk rank
+    '''
+    return numpy.dtype([
+        ('stats', '<f4', (7,)),
+        ('weights', 'u1', (assets_n,)),
+        ('rank', '<u8'),
+    ])
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-positional-arguments
+def cache_key(
+        returns_path: str, assets: list[str], percentage_step: int, years: str,
+        max_assets_n: int = None, constraints: dict = None):
+    '''
+    Content address of simulation results: hash of returns data and of every option that changes them
+    '''
+    digest = hashlib.sha256()
+    with open(returns_path, 'rb') as returns_file:
+        digest.update(returns_file.read())
+    options = {
+        'version': CACHE_VERSION,
+        'assets': assets,
+        'precision': percentage_step,
+        'years': years,
+        'max_assets_n': max_assets_n,
+    }
+    if constraints is not None:
+        # runs without constraints keep their keys
+        options['constraints'] = constraints
+    digest.update(json.dumps(options).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class CacheEntry:
+    '''
+    Simulated records of one run in memory-mapped file, record number is simulation order,
+    with float64 partials of every record (see YearRangePlan.simulate_appended_year) in another one
+    and JSON meta describing the run. Workers fill new entry in place by ranges,
+    entry becomes visible only after commit.
+    '''
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-positional-arguments
+    def __init__(self, directory: str, key: str, assets_n: int, portfolios_n: int, partials_n: int = 0):
+        self.directory = directory
+        self.key = key
+        self.assets_n = assets_n
+        self.portfolios_n = portfolios_n
+        self.partials_n = partials_n
+        self.meta = {}
+        # temporary files belong to process that creates entry, workers filling it see same names
+        self._creator_pid = os.getpid()
+
+    def _path(self, suffix: str, temporary: bool = False):
+        path = os.path.join(self.directory, self.key + suffix)
+        return f'{path}.{self._creator_pid}{_TEMPORARY_SUFFIX}' if temporary else path
+
+    @property
+    def path(self):
+        return self._path(_RECORDS_SUFFIX)
+
+    @property
+    def records_size(self):
+        return self.portfolios_n * record_dtype(self.assets_n).itemsize
+
+    @property
+    def partials_size(self):
+        return self.portfolios_n * self.partials_n * numpy.dtype(numpy.float64).itemsize
+
+    @property
+    def size(self):
+        return self.records_size + self.partials_size
+
+    def exists(self):
+        return all(
+            os.path.isfile(self._path(suffix)) and os.path.getsize(self._path(suffix)) == size
+            for suffix, size in ((_RECORDS_SUFFIX, self.records_size), (_PARTIALS_SUFFIX, self.partials_size)))
+
+    def touch(self):
+        os.utime(self.path)
+
+    def create(self):
+        for suffix, size in ((_RECORDS_SUFFIX, self.records_size), (_PARTIALS_SUFFIX, self.partials_size)):
+            with open(self._path(suffix, temporary=True), 'wb') as temporary_file:
+                temporary_file.truncate(size)
+
+    def commit(self, meta: dict):
+        '''
+        Make filled entry visible, records file is moved last as it marks complete entry
+        '''
+        self.meta = meta
+        with open(self._path(_META_SUFFIX), 'w', encoding='utf-8') as meta_file:
+            json.dump({
+                'assets_n': self.assets_n,
+                'portfolios_n': self.portfolios_n,
+                'partials_n': self.partials_n,
+                **meta,
+            }, meta_file)
+        os.replace(self._path(_PARTIALS_SUFFIX, temporary=True), self._path(_PARTIALS_SUFFIX))
+        os.replace(self._path(_RECORDS_SUFFIX, temporary=True), self._path(_RECORDS_SUFFIX))
+
+    def discard(self):
+        for suffix in (_RECORDS_SUFFIX, _PARTIALS_SUFFIX):
+            if os.path.exists(self._path(suffix, temporary=True)):
+                os.remove(self._path(suffix, temporary=True))
+
+    def _memmap(self, suffix: str, dtype, shape: tuple, writable: bool):
+        if self.portfolios_n == 0 or 0 in shape:
+            return numpy.empty(shape, dtype=dtype)
+        return numpy.memmap(
+            self._path(suffix, temporary=writable), dtype=dtype, mode='r+' if writable else 'r', shape=shape)
+
+    def _records(self, writable: bool):
+        return self._memmap(_RECORDS_SUFFIX, record_dtype(self.assets_n), (self.portfolios_n,), writable)
+
+    def _partials(self, writable: bool):
+        return self._memmap(_PARTIALS_SUFFIX, numpy.float64, (self.portfolios_n, self.partials_n), writable)
+
+    def recorded_blocks(self, blocks, start: int):
+        '''
+        Pass (weights, stats, ranks, partials) blocks through,
+        writing them to new entry from record number start
+        '''
+        records = self._records(writable=True)
+        partials = self._partials(writable=True)
+        position = start
+        for weights, stats, ranks, block_partials in blocks:
+            block_records = records[position:position + len(weights)]
+            block_records['stats'] = stats
+            block_records['weights'] = weights
+            block_records['rank'] = ranks
+            partials[position:position + len(weights)] = block_partials
+            position += len(weights)
+            yield weights, stats, ranks, block_partials
+        for mapped in (records, partials):
+            if isinstance(mapped, numpy.memmap):
+                mapped.flush()
+
+    def blocks(self, start: int, stop: int, block_size: int, partials: bool = False):
+        '''
+        Yield (weights, stats, ranks, partials) blocks of records number start..stop-1,
+        partials are None unless asked for
+        '''
+        records = self._records(writable=False)
+        all_partials = self._partials(writable=False) if partials else None
+        for block_start in range(start, stop, block_size):
+            block_stop = min(block_start + block_size, stop)
+            block_records = numpy.array(records[block_start:block_stop])
+            yield (
+                block_records['weights'].astype(numpy.int32),
+                block_records['stats'],
+                block_records['rank'],
+                numpy.array(all_partials[block_start:block_stop]) if partials else None)
+
+
+class ResultCache:
+    '''
+    Directory of content-addressed cache entries, least recently used ones are evicted
+    when total size exceeds max_bytes
+    '''
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def entry(self, key: str, assets_n: int, portfolios_n: int, partials_n: int = 0):
+        return CacheEntry(self.directory, key, assets_n, portfolios_n, partials_n)
+
+    def entries(self):
+        '''
+        Complete entries with their meta, most recently used first
+        '''
+        entries = []
+        for _, _, key in reversed(self._keys_by_last_use()):
+            try:
+                with open(os.path.join(self.directory, key + _META_SUFFIX), 'r', encoding='utf-8') as meta_file:
+                    meta = json.load(meta_file)
+            except (OSError, ValueError):
+                continue
+            entry = self.entry(key, meta.pop('assets_n'), meta.pop('portfolios_n'), meta.pop('partials_n'))
+            entry.meta = meta
+            if entry.exists():
+                entries.append(entry)
+        return entries
+
+    def _keys_by_last_use(self):
+        keys = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith(_RECORDS_SUFFIX):
+                key = filename[:-len(_RECORDS_SUFFIX)]
+                size = sum(
+                    os.path.getsize(os.path.join(self.directory, key + suffix))
+                    for suffix in (_RECORDS_SUFFIX, _PARTIALS_SUFFIX, _META_SUFFIX)
+                    if os.path.isfile(os.path.join(self.directory, key + suffix)))
+                keys.append((os.path.getmtime(os.path.join(self.directory, filename)), size, key))
+        return sorted(keys)
+
+    def evict(self, keep: CacheEntry = None):
+        '''
+        Remove least recently used entries until cache fits into max_bytes
+        '''
+        keys = self._keys_by_last_use()
+        total_bytes = sum(size for _, size, _ in keys)
+        for _, size, key in keys:
+            if total_bytes <= self.max_bytes:
+                break
+            if keep is not None and key == keep.key:
+                continue
+            # records file first: entry without it is incomplete and never read
+            for suffix in (_RECORDS_SUFFIX, _PARTIALS_SUFFIX, _META_SUFFIX):
+                if os.path.isfile(os.path.join(self.directory, key + suffix)):
+                    os.remove(os.path.join(self.directory, key + suffix))
+            total_bytes -= size
+            logging.info('cache: evicted %s, %.1f MiB', key, size / 2**20)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+# Investment Portfolio Optimizer
+# Copyright (C) 2024  Vladimir Looze
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import logging
+import functools
+import numpy
+import pytest
+from modules import data_filter
+from modules import data_source
+from modules.portfolio import Portfolio
+from modules.batch_simulation import YearRangePlan
+from modules.result_cache import ResultCache
+from modules.result_cache import CacheEntry
+from modules.result_cache import cache_key
+from modules.simulation_testing import ASSET_GAIN_PER_YEAR
+from modules.simulation_testing import ASSETS
+from modules.simulation_testing import simulated_batches
+
+
+def test_cache_key(tmp_path):
+    returns_path = tmp_path / 'returns.csv'
+    returns_path.write_text('year,A,B\n2000,1%,2%\n', encoding='utf-8')
+    key = cache_key(returns_path, ['A', 'B'], 10, 'first-to-last')
+    assert key == cache_key(returns_path, ['A', 'B'], 10, 'first-to-last')
+    assert key != cache_key(returns_path, ['B', 'A'], 10, 'first-to-last')
+    assert key != cache_key(returns_path, ['A', 'B'], 5, 'first-to-last')
+    assert key != cache_key(returns_path, ['A', 'B'], 10, 'all-to-all')
+    assert key != cache_key(returns_path, ['A', 'B'], 10, 'first-to-last', max_assets_n=1)
+    returns_path.write_text('year,A,B\n2000,1%,3%\n', encoding='utf-8')
+    assert key != cache_key(returns_path, ['A', 'B'], 10, 'first-to-last')
+
+
+def test_cache_entry_blocks(tmp_path):
+    plan = YearRangePlan(data_filter.years_all_to_all, ASSET_GAIN_PER_YEAR)
+    portfolios_n = data_source.allocations_count(4, 10)
+    cache = ResultCache(tmp_path, 2**20)
+    entry = cache.entry('key', 4, portfolios_n, plan.partials_columns)
+    assert not entry.exists()
+    entry.create()
+    expected = []
+    for start, stop in [(0, 100), (100, portfolios_n)]:
+        blocks = data_source.simulated_allocation_blocks(plan, start, stop, 4, 10, 7, partials=True)
+        expected.extend(entry.recorded_blocks(blocks, start))
+    assert not entry.exists()
+    entry.commit({'layout': plan.partials_layout()})
+    assert entry.exists()
+    weights, stats, ranks, partials = next(entry.blocks(0, portfolios_n, portfolios_n, partials=True))
+    assert numpy.array_equal(weights, numpy.concatenate([block[0] for block in expected]))
+    assert numpy.array_equal(stats, numpy.concatenate([block[1] for block in expected]).astype(numpy.float32))
+    assert numpy.array_equal(ranks, numpy.arange(portfolios_n))
+    assert numpy.array_equal(partials, numpy.concatenate([block[3] for block in expected]))
+    assert [len(block[0]) for block in entry.blocks(10, 35, 10)] == [10, 10, 5]
+    assert next(entry.blocks(0, 1, 1))[3] is None
+    assert len(cache.entries()) == 1
+    cached_entry = cache.entries()[0]
+    assert (cached_entry.key, cached_entry.partials_n) == ('key', plan.partials_columns)
+    assert cached_entry.meta == {'layout': plan.partials_layout()}
+
+
+def test_cache_evict(tmp_path):
+    cache = ResultCache(tmp_path, 3 * 1000 + 3 * len('{"assets_n": 1, "portfolios_n": 27, "partials_n": 0}'))
+    entries = [cache.entry(f'key{idx}', 1, 1000 // 37) for idx in range(4)]
+    for idx, entry in enumerate(entries):
+        entry.create()
+        entry.commit({})
+        os.utime(entry.path, (idx, idx))
+    entries[0].touch()
+    cache.evict()
+    assert [entry.exists() for entry in entries] == [True, False, True, True]
+    cache.max_bytes = 0
+    cache.evict(keep=entries[2])
+    assert [entry.exists() for entry in entries] == [False, False, True, False]
+
+
+@pytest.mark.parametrize('weights_encoding', Portfolio.WEIGHTS_ENCODINGS)
+@pytest.mark.parametrize('prefiltered', [False, True])
+def test_simulator_cache(tmp_path, weights_encoding: str, prefiltered: bool):
+    plan = YearRangePlan(data_filter.years_all_to_all, ASSET_GAIN_PER_YEAR)
+    plot_masks_func = None
+    if prefiltered:
+        plot_masks_func = functools.partial(
+            data_filter.plot_masks,
+            coord_pairs=[(Portfolio.STAT_CAGR_PERCENT, Portfolio.STAT_STDDEV)],
+            points_filter=functools.partial(data_filter.hull_points_filter, hull_layers=1, edge_layers=0))
+    cache = ResultCache(tmp_path, 2**20)
+    simulated = simulated_batches(
+        plan, weights_encoding=weights_encoding, plot_masks_func=plot_masks_func, cache=cache, cache_key='key')
+    assert len(cache.entries()) == 1
+    cached = simulated_batches(
+        plan, weights_encoding=weights_encoding, plot_masks_func=plot_masks_func, cache=cache, cache_key='key')
+    assert sorted(cached) == sorted(simulated)
+
+
+@pytest.mark.parametrize('year_selector_func', [
+    data_filter.years_first_to_last,
+    functools.partial(data_filter.years_sliding_window, window_size=2),
+    data_filter.years_all_to_all,
+])
+def test_simulator_cache_appended_year(tmp_path, caplog, year_selector_func):
+    caplog.set_level(logging.INFO)
+    years = list(ASSET_GAIN_PER_YEAR.keys())
+    previous_plan = YearRangePlan(
+        year_selector_func, {year: ASSET_GAIN_PER_YEAR[year] for year in years[:-1]})
+    plan = YearRangePlan(year_selector_func, ASSET_GAIN_PER_YEAR)
+    cache = ResultCache(tmp_path / 'extended', 2**20)
+    simulated_batches(previous_plan, cache=cache, cache_key='previous')
+    simulated_batches(plan, cache=cache, cache_key='extended')
+    assert 'cache: extending' in caplog.text
+    cold_cache = ResultCache(tmp_path / 'cold', 2**20)
+    simulated_batches(plan, cache=cold_cache, cache_key='extended')
+    portfolios_n = data_source.allocations_count(4, 10)
+    extended = {entry.key: entry for entry in cache.entries()}['extended']
+    cold = cold_cache.entries()[0]
+    for extended_block, cold_block in zip(
+            extended.blocks(0, portfolios_n, 100, partials=True), cold.blocks(0, portfolios_n, 100, partials=True)):
+        assert numpy.array_equal(extended_block[0], cold_block[0])
+        assert numpy.allclose(extended_block[1], cold_block[1], rtol=1e-6, atol=1e-6)
+        assert numpy.array_equal(extended_block[2], cold_block[2])
+        assert numpy.allclose(extended_block[3], cold_block[3], rtol=1e-9, atol=1e-12)
+
+
+def _entry_records_by_rank(entry: CacheEntry):
+    weights, stats, ranks, partials = next(entry.blocks(0, entry.portfolios_n, entry.portfolios_n, partials=True))
+    order = numpy.argsort(ranks)
+    return weights[order], stats[order], ranks[order], partials[order]
+
+
+@pytest.mark.parametrize('asset_idx', [0, 2, 3])
+def test_simulator_cache_added_asset(tmp_path, caplog, asset_idx: int):
+    caplog.set_level(logging.INFO)
+    previous_plan = YearRangePlan(data_filter.years_all_to_all, {
+        year: gains[:asset_idx] + gains[asset_idx + 1:] for year, gains in ASSET_GAIN_PER_YEAR.items()})
+    plan = YearRangePlan(data_filter.years_all_to_all, ASSET_GAIN_PER_YEAR)
+    cache = ResultCache(tmp_path / 'added', 2**20)
+    simulated_batches(
+        previous_plan, ASSETS[:asset_idx] + ASSETS[asset_idx + 1:], cache=cache, cache_key='previous')
+    simulated_batches(plan, cache=cache, cache_key='added')
+    assert 'cache: reusing' in caplog.text
+    cold_cache = ResultCache(tmp_path / 'cold', 2**20)
+    simulated_batches(plan, cache=cold_cache, cache_key='added')
+    added = {entry.key: entry for entry in cache.entries()}['added']
+    cold = cold_cache.entries()[0]
+    added_records = _entry_records_by_rank(added)
+    cold_records = _entry_records_by_rank(cold)
+    assert numpy.array_equal(added_records[2], numpy.arange(data_source.allocations_count(4, 10)))
+    assert numpy.array_equal(added_records[0], cold_records[0])
+    assert numpy.allclose(added_records[1], cold_records[1], rtol=1e-6, atol=1e-6)
+    assert numpy.allclose(added_records[3], cold_records[3], rtol=1e-9, atol=1e-12)
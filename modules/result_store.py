@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+# Investment Portfolio Optimizer
+# Copyright (C) 2024  Vladimir Looze
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import re
+import json
+import struct
+import operator
+import numpy
+from modules.portfolio import Portfolio
+
+_MAGIC = b'IPOSTORE'
+_HEADER_LENGTH = struct.Struct('<Q')
+# columns start at multiples of this, so that every column can be mapped as aligned array
+_COLUMN_ALIGNMENT = 64
+_RANK_COLUMN = 'rank'
+
+_PREDICATE_OPERATORS = {
+    '<=': operator.le,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '>': operator.gt,
+}
+_PREDICATE_PATTERN = re.compile(r'^\s*(.+?)\s*(<=|>=|==|!=|<|>)\s*([-+]?[0-9.]+(?:[eE][-+]?[0-9]+)?)\s*$')
+
+
+def parse_predicate(text: str):
+    '''
+    Parse predicate like "CAGR(%) > 9" into (column, operator function, value)
+    '''
+    match = _PREDICATE_PATTERN.match(text)
+    if match is None:
+        raise ValueError(f'cannot parse predicate "{text}", expected COLUMN OP VALUE with OP one of '
+                         f'{" ".join(_PREDICATE_OPERATORS)}')
+    column, operator_text, value = match.groups()
+    return column, _PREDICATE_OPERATORS[operator_text], float(value)
+
+
+def check_asset_names(assets: list[str]):
+    '''
+    Raise ValueError if weight column of some asset would share its name with stat or rank column
+    '''
+    reserved = [asset for asset in assets if asset in Portfolio.STATS or asset == _RANK_COLUMN]
+    if reserved:
+        raise ValueError(
+            f'result store cannot keep assets named like its stat or rank columns: {", ".join(reserved)}')
+
+
+class ResultStore:
+    '''
+    Fixed-width columnar file of simulated portfolios: magic, JSON header describing run and columns,
+    then every column as contiguous array: float32 stats, uint8 weight of every asset, uint64 allocation rank.
+    Workers fill new store in place by ranges of portfolios, store appears at its path only after commit.
+    '''
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-positional-arguments
+    def __init__(self, path: str, assets: list[str], precision: int, years: str, portfolios_n: int):
+        check_asset_names(assets)
+        self.path = path
+        self.assets = list(assets)
+        self.precision = precision
+        self.years = years
+        self.portfolios_n = portfolios_n
+        columns = [(stat, '<f4') for stat in Portfolio.STATS] + \
+            [(asset, 'u1') for asset in self.assets] + [(_RANK_COLUMN, '<u8')]
+        # offsets are part of header, reserve room for the longest ones
+        offset = self._aligned(len(self._header_bytes(columns, [2**64 - 1] * len(columns))))
+        # memmap layout: dtype and file offset of every column
+        self._layout = {}
+        for name, dtype in columns:
+            self._layout[name] = (dtype, offset)
+            offset = self._aligned(offset + numpy.dtype(dtype).itemsize * portfolios_n)
+        self._temporary_path = f'{path}.{os.getpid()}.tmp'
+
+    @staticmethod
+    def _aligned(offset: int):
+        return -(-offset // _COLUMN_ALIGNMENT) * _COLUMN_ALIGNMENT
+
+    def _header_bytes(self, columns: list, offsets: list):
+        header = json.dumps({
+            'assets': self.assets,
+            'precision': self.precision,
+            'years': self.years,
+            'portfolios': self.portfolios_n,
+            'columns': [[name, dtype, offset] for (name, dtype), offset in zip(columns, offsets)],
+        }).encode('utf-8')
+        return _MAGIC + _HEADER_LENGTH.pack(len(header)) + header
+
+    @property
+    def columns(self):
+        return list(self._layout.keys())
+
+    @property
+    def size(self):
+        '''
+        Size of store file in bytes
+        '''
+        return max(
+            self._aligned(offset + numpy.dtype(dtype).itemsize * self.portfolios_n)
+            for dtype, offset in self._layout.values())
+
+    @property
+    def row_columns(self):
+        '''
+        Columns of rows, see rows
+        '''
+        return [name for name in self.columns if name != _RANK_COLUMN]
+
+    @classmethod
+    def open(cls, path: str):
+        '''
+        Read header of existing store
+        '''
+        with open(path, 'rb') as store_file:
+            magic = store_file.read(len(_MAGIC))
+            if magic != _MAGIC:
+                raise ValueError(f'{path} is not a result store')
+            header_length = _HEADER_LENGTH.unpack(store_file.read(_HEADER_LENGTH.size))[0]
+            header = json.loads(store_file.read(header_length))
+        store = cls(path, header['assets'], header['precision'], header['years'], header['portfolios'])
+        store._layout = {name: (dtype, offset) for name, dtype, offset in header['columns']}
+        return store
+
+    def create(self):
+        with open(self._temporary_path, 'wb') as store_file:
+            store_file.write(self._header_bytes(
+                [(name, dtype) for name, (dtype, _) in self._layout.items()],
+                [offset for _, offset in self._layout.values()]))
+            store_file.truncate(self.size)
+
+    def commit(self):
+        os.replace(self._temporary_path, self.path)
+
+    def discard(self):
+        if os.path.exists(self._temporary_path):
+            os.remove(self._temporary_path)
+
+    def column(self, name: str, writable: bool = False):
+        '''
+        Memory-mapped column of every portfolio
+        '''
+        dtype, offset = self._layout[name]
+        if self.portfolios_n == 0:
+            return numpy.empty(0, dtype=dtype)
+        return numpy.memmap(
+            self._temporary_path if writable else self.path, dtype=dtype,
+            mode='r+' if writable else 'r', offset=offset, shape=(self.portfolios_n,))
+
+    def recorded_blocks(self, blocks, start: int):
+        '''
+        Pass (weights, stats, ranks, partials) blocks through, writing them to new store
+        from portfolio number start
+        '''
+        columns = {name: self.column(name, writable=True) for name in self.columns}
+        position = start
+        for weights, stats, ranks, partials in blocks:
+            block = slice(position, position + len(weights))
+            for stat_idx, stat in enumerate(Portfolio.STATS):
+                columns[stat][block] = stats[:, stat_idx]
+            for asset_idx, asset in enumerate(self.assets):
+                columns[asset][block] = weights[:, asset_idx]
+            columns[_RANK_COLUMN][block] = ranks
+            position += len(weights)
+            yield weights, stats, ranks, partials
+        for column in columns.values():
+            if isinstance(column, numpy.memmap):
+                column.flush()
+
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-positional-arguments
+    def query(
+            self, predicates: list[tuple] = (), sort_column: str = None, descending: bool = False,
+            limit: int = None, chunk_size: int = 2**20):
+        '''
+        Indices of portfolios matching all predicates (see parse_predicate),
+        sorted by column if given, first limit of them if given. Store is scanned in chunks,
+        with sort and limit only best limit matches are kept between chunks.
+        '''
+        for column, _, _ in predicates:
+            self._check_column(column)
+        if sort_column is not None:
+            self._check_column(sort_column)
+        matches = numpy.empty(0, dtype=numpy.int64)
+        for chunk_start in range(0, self.portfolios_n, chunk_size):
+            chunk = slice(chunk_start, min(chunk_start + chunk_size, self.portfolios_n))
+            passed = numpy.ones(chunk.stop - chunk.start, dtype=bool)
+            for column, predicate_func, value in predicates:
+                passed &= predicate_func(self.column(column)[chunk], value)
+            matches = numpy.concatenate([matches, chunk_start + numpy.flatnonzero(passed)])
+            if sort_column is None:
+                if limit is not None and len(matches) >= limit:
+                    return matches[:limit]
+            elif limit is not None and len(matches) > limit:
+                matches = self._sorted(matches, sort_column, descending)[:limit]
+        if sort_column is not None:
+            matches = self._sorted(matches, sort_column, descending)
+        return matches[:limit]
+
+    def _check_column(self, name: str):
+        if name not in self._layout:
+            raise ValueError(f'unknown column "{name}", store has columns: {", ".join(self.columns)}')
+
+    def _sorted(self, indices: numpy.ndarray, sort_column: str, descending: bool):
+        values = self.column(sort_column)[indices].astype(numpy.float64)
+        order = numpy.argsort(-values if descending else values, kind='stable')
+        return indices[order]
+
+    def rows(self, indices: numpy.ndarray):
+        '''
+        Stats and weights of portfolios with given indices, as list of dicts.
+        Stats are shortest decimals that read back as the same float32.
+        '''
+        columns = self.row_columns
+        values = [
+            [float(str(value)) for value in self.column(name)[indices]] if name in Portfolio.STATS
+            else self.column(name)[indices].tolist()
+            for name in columns]
+        return [dict(zip(columns, row)) for row in zip(*values)]
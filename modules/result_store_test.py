@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+# Investment Portfolio Optimizer
+# Copyright (C) 2024  Vladimir Looze
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import operator
+import numpy
+import pytest
+from modules import data_filter
+from modules import data_source
+from modules.portfolio import Portfolio
+from modules.batch_simulation import YearRangePlan
+from modules.result_cache import ResultCache
+from modules.result_store import ResultStore
+from modules.result_store import parse_predicate
+from modules.simulation_testing import ASSET_GAIN_PER_YEAR
+from modules.simulation_testing import ASSETS
+from modules.simulation_testing import simulated_batches
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('CAGR(%)>9', ('CAGR(%)', operator.gt, 9.0)),
+    (' Dip(%) >= -20.5 ', ('Dip(%)', operator.ge, -20.5)),
+    ('Stddev<1e-2', ('Stddev', operator.lt, 0.01)),
+    ('A == 50', ('A', operator.eq, 50.0)),
+    ('A!=0', ('A', operator.ne, 0.0)),
+    ('Gain(x)<=2', ('Gain(x)', operator.le, 2.0)),
+])
+def test_parse_predicate(text: str, expected: tuple):
+    assert parse_predicate(text) == expected
+
+
+@pytest.mark.parametrize('text', ['CAGR(%)', 'CAGR(%) > high', '> 9', 'CAGR(%) > 9%'])
+def test_parse_predicate_invalid(text: str):
+    with pytest.raises(ValueError):
+        parse_predicate(text)
+
+
+def _store_simulated(path, plan: YearRangePlan):
+    portfolios_n = data_source.allocations_count(len(ASSETS), 10)
+    store = ResultStore(path, ASSETS, 10, 'all-to-all', portfolios_n)
+    store.create()
+    expected = []
+    for start, stop in [(100, portfolios_n), (0, 100)]:
+        blocks = data_source.simulated_allocation_blocks(plan, start, stop, len(ASSETS), 10, 64)
+        expected[0:0] = store.recorded_blocks(blocks, start)
+    store.commit()
+    weights = numpy.concatenate([block[0] for block in expected])
+    stats = numpy.concatenate([block[1] for block in expected]).astype(numpy.float32)
+    return weights, stats
+
+
+def test_result_store(tmp_path):
+    plan = YearRangePlan(data_filter.years_all_to_all, ASSET_GAIN_PER_YEAR)
+    weights, stats = _store_simulated(tmp_path / 'store', plan)
+    store = ResultStore.open(tmp_path / 'store')
+    assert (store.assets, store.precision, store.years, store.portfolios_n) == (ASSETS, 10, 'all-to-all', len(weights))
+    assert store.row_columns == list(Portfolio.STATS) + ASSETS
+    for stat_idx, stat in enumerate(Portfolio.STATS):
+        assert numpy.array_equal(store.column(stat), stats[:, stat_idx])
+    for asset_idx, asset in enumerate(ASSETS):
+        assert numpy.array_equal(store.column(asset), weights[:, asset_idx])
+    assert numpy.array_equal(store.column('rank'), numpy.arange(len(weights)))
+    [row] = store.rows(numpy.array([5]))
+    assert [row[asset] for asset in ASSETS] == weights[5].tolist()
+    assert numpy.array_equal(numpy.float32([row[stat] for stat in Portfolio.STATS]), stats[5])
+
+
+def _expected_query(columns: dict, predicates: list, sort_column: str, descending: bool, limit: int):
+    '''
+    Query result found by filtering and sorting whole columns
+    '''
+    passed = numpy.ones(len(columns[Portfolio.STATS[0]]), dtype=bool)
+    for column, predicate_func, value in predicates:
+        passed &= predicate_func(columns[column], value)
+    expected = numpy.flatnonzero(passed)
+    if sort_column is not None:
+        values = columns[sort_column][expected].astype(numpy.float64)
+        expected = expected[numpy.argsort(-values if descending else values, kind='stable')]
+    return expected[:limit]
+
+
+@pytest.mark.parametrize('predicates, sort_column, descending, limit', [
+    ([], None, False, None),
+    ([], None, False, 7),
+    ([('CAGR(%)', operator.gt, 2.0)], None, False, None),
+    ([('CAGR(%)', operator.gt, 2.0), ('A', operator.ge, 20)], 'Stddev', False, None),
+    ([('Dip(%)', operator.ge, -5.0)], 'CAGR(%)', True, 10),
+    ([('B', operator.eq, 0)], 'Sharpe', False, 1),
+    ([('CAGR(%)', operator.gt, 100.0)], 'Sharpe', True, 3),
+])
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-positional-arguments
+def test_result_store_query(tmp_path, predicates: list, sort_column: str, descending: bool, limit: int):
+    plan = YearRangePlan(data_filter.years_all_to_all, ASSET_GAIN_PER_YEAR)
+    _store_simulated(tmp_path / 'store', plan)
+    store = ResultStore.open(tmp_path / 'store')
+    columns = {name: numpy.array(store.column(name)) for name in store.columns}
+    expected = _expected_query(columns, predicates, sort_column, descending, limit)
+    for chunk_size in (13, 2**20):
+        result = store.query(predicates, sort_column, descending, limit, chunk_size=chunk_size)
+        if sort_column is None:
+            assert numpy.array_equal(result, expected)
+        else:
+            # equal values may come in any order across chunks
+            assert numpy.array_equal(columns[sort_column][result], columns[sort_column][expected])
+
+
+def test_result_store_query_unknown_column(tmp_path):
+    plan = YearRangePlan(data_filter.years_all_to_all, ASSET_GAIN_PER_YEAR)
+    _store_simulated(tmp_path / 'store', plan)
+    store = ResultStore.open(tmp_path / 'store')
+    with pytest.raises(ValueError):
+        store.query([('E', operator.gt, 0.0)])
+    with pytest.raises(ValueError):
+        store.query(sort_column='E')
+
+
+@pytest.mark.parametrize('assets', [
+    ['A', 'rank', 'C'],
+    ['A', Portfolio.STAT_SHARPE, 'C'],
+    [Portfolio.STAT_CAGR_PERCENT, 'B'],
+])
+def test_result_store_asset_named_like_column(tmp_path, assets: list):
+    # weight column of such asset would overwrite stat or rank column
+    with pytest.raises(ValueError):
+        ResultStore(tmp_path / 'store', assets, 10, 'all-to-all', 66)
+
+
+def _run_store(tmp_path, plan: YearRangePlan, cache: ResultCache):
+    portfolios_n = data_source.allocations_count(len(ASSETS), 10)
+    store = ResultStore(tmp_path / 'store', ASSETS, 10, 'all-to-all', portfolios_n)
+    simulated_batches(plan, cache=cache, cache_key='key', store=store)
+    return ResultStore.open(tmp_path / 'store')
+
+
+def test_simulator_store(tmp_path):
+    plan = YearRangePlan(data_filter.years_all_to_all, ASSET_GAIN_PER_YEAR)
+    cache = ResultCache(tmp_path / 'cache', 2**20)
+    simulated = _run_store(tmp_path, plan, cache)
+    ranks = numpy.array(simulated.column('rank'))
+    assert numpy.array_equal(numpy.sort(ranks), numpy.arange(simulated.portfolios_n))
+    weights = numpy.stack([simulated.column(asset) for asset in ASSETS], axis=1)
+    assert numpy.array_equal(weights, data_source.allocation_walk_unrank_batch(ranks, len(ASSETS), 10))
+    simulated_columns = {name: numpy.array(simulated.column(name)) for name in simulated.columns}
+    # second run replays cache, store is the same
+    replayed = _run_store(tmp_path, plan, cache)
+    for name in replayed.columns:
+        assert numpy.array_equal(replayed.column(name), simulated_columns[name])
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+# Investment Portfolio Optimizer
+# Copyright (C) 2024  Vladimir Looze
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import struct
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+
+# header: write sequence number, finished flag, then read sequence number of every consumer
+_HEADER_FIELD = struct.Struct('Q')
+_SLOT_LENGTH = struct.Struct('Q')
+
+
+class RingBuffer:
+    '''
+    Ring of fixed-size slots in shared memory, connecting any number of producer processes
+    to fixed number of consumer processes. Producers write every block of data once,
+    each consumer reads every block in order through memoryview with its own read cursor.
+    Producers wait while the slowest consumer is whole ring behind.
+    '''
+    def __init__(self, consumers_n: int, slots_n: int, slot_size: int):
+        self._consumers_n = consumers_n
+        self._slots_n = slots_n
+        self._slot_size = slot_size
+        self._header_size = _HEADER_FIELD.size * (2 + consumers_n)
+        self._shared_memory = SharedMemory(
+            create=True,
+            size=self._header_size + slots_n * (_SLOT_LENGTH.size + slot_size))
+        self._shared_memory.buf[:self._header_size] = bytes(self._header_size)
+        self._condition = multiprocessing.Condition()
+
+    def __getstate__(self):
+        # only used when processes are spawned instead of forked
+        state = self.__dict__.copy()
+        state['_shared_memory'] = self._shared_memory.name
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shared_memory = SharedMemory(name=state['_shared_memory'])
+
+    @property
+    def slot_size(self):
+        return self._slot_size
+
+    def _header_get(self, field_idx: int):
+        return _HEADER_FIELD.unpack_from(self._shared_memory.buf, field_idx * _HEADER_FIELD.size)[0]
+
+    def _header_set(self, field_idx: int, value: int):
+        _HEADER_FIELD.pack_into(self._shared_memory.buf, field_idx * _HEADER_FIELD.size, value)
+
+    def _write_seq(self):
+        return self._header_get(0)
+
+    def _finished(self):
+        return self._header_get(1) != 0
+
+    def _read_seq(self, consumer_idx: int):
+        return self._header_get(2 + consumer_idx)
+
+    def _slot_offset(self, seq: int):
+        return self._header_size + (seq % self._slots_n) * (_SLOT_LENGTH.size + self._slot_size)
+
+    def _has_free_slot(self):
+        return self._write_seq() - min(map(self._read_seq, range(self._consumers_n))) < self._slots_n
+
+    def write(self, data):
+        '''
+        Copy block of data into next slot, waiting for the slowest consumer to free it
+        '''
+        data = memoryview(data).cast('B')
+        if len(data) > self._slot_size:
+            raise ValueError(f'block of {len(data)} bytes does not fit into slot of {self._slot_size} bytes')
+        with self._condition:
+            self._condition.wait_for(self._has_free_slot)
+            write_seq = self._write_seq()
+            slot_offset = self._slot_offset(write_seq)
+            _SLOT_LENGTH.pack_into(self._shared_memory.buf, slot_offset, len(data))
+            payload_offset = slot_offset + _SLOT_LENGTH.size
+            self._shared_memory.buf[payload_offset:payload_offset + len(data)] = data
+            self._header_set(0, write_seq + 1)
+            self._condition.notify_all()
+
+    def finish(self):
+        '''
+        Tell consumers that no more blocks will be written
+        '''
+        with self._condition:
+            self._header_set(1, 1)
+            self._condition.notify_all()
+
+    def consume(self, consumer_idx: int):
+        '''
+        Yield memoryview of every written block until ring is finished.
+        View is valid only until the next block is requested.
+        '''
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._read_seq(consumer_idx) < self._write_seq() or self._finished())
+                read_seq = self._read_seq(consumer_idx)
+                if read_seq >= self._write_seq():
+                    return
+            slot_offset = self._slot_offset(read_seq)
+            length = _SLOT_LENGTH.unpack_from(self._shared_memory.buf, slot_offset)[0]
+            payload_offset = slot_offset + _SLOT_LENGTH.size
+            with self._shared_memory.buf[payload_offset:payload_offset + length] as block:
+                yield block
+            with self._condition:
+                self._header_set(2 + consumer_idx, read_seq + 1)
+                self._condition.notify_all()
+
+    def close(self, unlink: bool = False):
+        self._shared_memory.close()
+        if unlink:
+            self._shared_memory.unlink()
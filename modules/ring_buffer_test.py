@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# Investment Portfolio Optimizer
+# Copyright (C) 2024  Vladimir Looze
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import multiprocessing
+import pytest
+from modules.ring_buffer import RingBuffer
+
+
+def _produce(ring: RingBuffer, producer_idx: int, blocks_n: int):
+    for block_idx in range(blocks_n):
+        ring.write(bytes([producer_idx]) + block_idx.to_bytes(4, 'little'))
+
+
+def _consume(ring: RingBuffer, consumer_idx: int, result_queue: multiprocessing.Queue):
+    result_queue.put((consumer_idx, [bytes(block) for block in ring.consume(consumer_idx)]))
+
+
+@pytest.mark.parametrize('producers_n, consumers_n, slots_n, blocks_n', [
+    (1, 1, 1, 50),
+    (1, 3, 2, 200),
+    (4, 2, 3, 100),
+    (4, 20, 8, 100),
+])
+def test_ring_buffer_processes(producers_n: int, consumers_n: int, slots_n: int, blocks_n: int):
+    ring = RingBuffer(consumers_n=consumers_n, slots_n=slots_n, slot_size=8)
+    result_queue = multiprocessing.Queue()
+    consumers = [
+        multiprocessing.Process(target=_consume, args=(ring, consumer_idx, result_queue))
+        for consumer_idx in range(consumers_n)]
+    producers = [
+        multiprocessing.Process(target=_produce, args=(ring, producer_idx, blocks_n))
+        for producer_idx in range(producers_n)]
+    for process in consumers + producers:
+        process.start()
+    for process in producers:
+        process.join()
+    ring.finish()
+    results = dict(result_queue.get() for _ in consumers)
+    for process in consumers:
+        process.join()
+    ring.close(unlink=True)
+
+    assert sorted(results.keys()) == list(range(consumers_n))
+    # every consumer sees the same blocks, each producer's blocks in its own order
+    expected_blocks = results[0]
+    assert len(expected_blocks) == producers_n * blocks_n
+    for consumer_idx in range(consumers_n):
+        assert results[consumer_idx] == expected_blocks
+    for producer_idx in range(producers_n):
+        producer_blocks = [block for block in expected_blocks if block[0] == producer_idx]
+        assert producer_blocks == [
+            bytes([producer_idx]) + block_idx.to_bytes(4, 'little') for block_idx in range(blocks_n)]
+
+
+def test_ring_buffer_variable_length():
+    ring = RingBuffer(consumers_n=1, slots_n=4, slot_size=10)
+    for length in (0, 3, 10):
+        ring.write(bytes(range(length)))
+    ring.finish()
+    assert [bytes(block) for block in ring.consume(0)] == [bytes(range(length)) for length in (0, 3, 10)]
+    with pytest.raises(ValueError):
+        ring.write(bytes(11))
+    ring.close(unlink=True)
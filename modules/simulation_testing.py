@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+# Investment Portfolio Optimizer
+# Copyright (C) 2024  Vladimir Looze
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import warnings
+import contextlib
+from modules import data_source
+from modules.ring_buffer import RingBuffer
+from modules.batch_simulation import YearRangePlan
+from modules.simulator import simulator_process_func
+
+ASSET_GAIN_PER_YEAR = {
+    '2000': [1.03, 1.04, 1.05, 0.96],
+    '2001': [1.01, 0.91, 1.09, 1.10],
+    '2002': [0.99, 1.09, 0.91, 1.01],
+    '2003': [1.02, 1.02, 1.08, 1.12],
+    '2004': [0.98, 1.18, 0.92, 1.03],
+}
+ASSETS = ['A', 'B', 'C', 'D']
+
+
+@contextlib.contextmanager
+def simulated_sink(plan: YearRangePlan, assets: list = None, **kwargs):
+    '''
+    Yield ring buffer filled by simulator_process_func with 10% step on two workers,
+    kwargs are passed to it as is
+    '''
+    assets = list(assets or ASSETS)
+    sink = RingBuffer(consumers_n=1, slots_n=data_source.allocations_count(len(assets), 10), slot_size=1000 * 64)
+    try:
+        # workers are forked from test process, which already has pool management threads of previous tests,
+        # python warns about it, but workers never touch those threads
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            simulator_process_func(
+                assets=assets, percentage_step=10, plan=plan, sink=sink, chunk_size=50, workers=2, **kwargs)
+        yield sink
+    finally:
+        sink.close(unlink=True)
+
+
+def simulated_batches(plan: YearRangePlan, assets: list = None, **kwargs) -> list[bytes]:
+    '''
+    Serialized batches of simulated_sink
+    '''
+    with simulated_sink(plan, assets, **kwargs) as sink:
+        return [bytes(block) for block in sink.consume(0)]
@@ -20,38 +20,341 @@ import os
 import time
 import logging
 from functools import partial
-import multiprocessing.connection
-from concurrent.futures import ProcessPoolExecutor
 from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
 from modules import data_source
+from modules import refinement
+from modules.portfolio import Portfolio
+from modules.batch_simulation import YearRangePlan
+from modules.ring_buffer import RingBuffer
+from modules.result_cache import ResultCache
+from modules.result_cache import CacheEntry
+from modules.result_store import ResultStore
+from modules.allocation_constraints import AllocationConstraints
+
+
+def portfolios_count(
+        assets_n: int, percentage_step: int, max_assets_n: int = None, constraints: AllocationConstraints = None):
+    '''
+    Number of allocations simulator goes through, all of them, ones having up to max_assets_n assets
+    or ones satisfying constraints
+    '''
+    if constraints is not None:
+        return constraints.allocations_count(percentage_step)
+    if max_assets_n is None:
+        return data_source.allocations_count(assets_n, percentage_step)
+    return data_source.sparse_allocations_count(assets_n, percentage_step, max_assets_n)
+
+
+def _simulated_seconds(blocks, weights_encoding: str):
+    '''
+    Time to simulate and serialize (weights, stats, ranks, partials) blocks
+    '''
+    time_start = time.perf_counter()
+    for weights, stats, ranks, _ in blocks:
+        Portfolio.serialize_batch(stats, weights, weights_encoding, ranks)
+    return time.perf_counter() - time_start
+
+
+# pylint: disable=too-many-arguments
+def simulation_estimate(
+        assets: list[str],
+        percentage_step: int,
+        plan: YearRangePlan,
+        consumers_n: int,
+        *,
+        workers: int = None,
+        sample_size: int = 2**14,
+        weights_encoding: str = Portfolio.WEIGHTS_INT32,
+        max_assets_n: int = None,
+        constraints: AllocationConstraints = None):
+    '''
+    Number of portfolios, volume of data and time needed for simulation.
+    Time is extrapolated from a sample block simulated in this process.
+    '''
+    portfolios_n = portfolios_count(len(assets), percentage_step, max_assets_n, constraints)
+    sample_n = min(portfolios_n, sample_size)
+    sample_seconds = _simulated_seconds(
+        data_source.simulated_allocation_blocks(
+            plan, 0, sample_n, len(assets), percentage_step, sample_n, max_assets_n, constraints=constraints,
+            ranked=weights_encoding == Portfolio.WEIGHTS_RANK),
+        weights_encoding)
+    simulated_bytes = portfolios_n * Portfolio.serialized_size(len(assets), weights_encoding)
+    return {
+        'portfolios': portfolios_n,
+        'year_ranges': len(plan.starts),
+        'simulated_bytes': simulated_bytes,
+        'transferred_bytes': simulated_bytes * (1 + consumers_n),
+        'seconds': sample_seconds / max(sample_n, 1) * portfolios_n / (workers or os.cpu_count()),
+    }
+
+
+# rank space is cut into this many tasks per worker, idle workers pull next task from the queue
+TASKS_PER_WORKER = 16
+
+
+def _task_ranges(portfolios_n: int, chunk_size: int, workers: int):
+    task_size = max(chunk_size, -(-portfolios_n // (workers * TASKS_PER_WORKER)))
+    return [
+        (task_start, min(task_start + task_size, portfolios_n))
+        for task_start in range(0, portfolios_n, task_size)
+    ]
 
 
 # pylint: disable=too-many-arguments
 # pylint: disable=too-many-positional-arguments
+# pylint: disable=too-many-locals
 def simulator_process_func(
         assets: list = None,
         percentage_step: int = None,
-        year_range_selector_func: Callable = None,
-        asset_gain_per_year: dict[str, dict[str, float]] = None,
-        sink: multiprocessing.connection.Connection = None,
-        chunk_size: int = 1):
-    possible_allocations_gen = data_source.all_possible_allocations(len(assets), percentage_step)
-    possible_allocations = sum(1 for _ in possible_allocations_gen)
-    logging.info('Will simulate %d portfolios', possible_allocations)
+        plan: YearRangePlan = None,
+        sink: RingBuffer = None,
+        chunk_size: int = 1,
+        workers: int = None,
+        weights_encoding: str = Portfolio.WEIGHTS_INT32,
+        plot_masks_func: Callable = None,
+        max_assets_n: int = None,
+        cache: ResultCache = None,
+        cache_key: str = None,
+        store: ResultStore = None,
+        top_filter_func: Callable = None,
+        constraints: AllocationConstraints = None):
+    '''
+    Simulate all allocations (or only ones having up to max_assets_n assets, or only ones
+    satisfying constraints) on pool of workers,
+    feeding serialized batches to sink. plot_masks_func and top_filter_func are passed to workers,
+    see data_source.init_simulation_worker.
+    With cache, results stored under cache_key are streamed to sink instead of simulating them,
+    otherwise simulated results are stored there. Results of related run are reused if cache has them,
+    see _cache_reuse_tasks.
+    With store, every portfolio is also written to it, see ResultStore.
+    '''
+    possible_allocations = portfolios_count(len(assets), percentage_step, max_assets_n, constraints)
+    workers = workers or os.cpu_count()
+    cache_entry = None
+    tasks = None
+    cache_meta = {
+        'assets': assets,
+        'precision': percentage_step,
+        'max_assets_n': max_assets_n,
+        'constraints': constraints.config() if constraints is not None else None,
+        'layout': plan.partials_layout(),
+    }
+    if cache is not None:
+        cache_entry = cache.entry(cache_key, len(assets), possible_allocations, plan.partials_columns)
+        if cache_entry.exists():
+            cache_entry.touch()
+            logging.info('cache: reading %d portfolios from %s', possible_allocations, cache_entry.path)
+            _cache_process_func(
+                cache_entry, sink, chunk_size, workers, weights_encoding, plot_masks_func, store, top_filter_func)
+            return
+        if cache_entry.size > cache.max_bytes:
+            logging.info('cache: %.1f MiB of results do not fit into cache, not storing them',
+                         cache_entry.size / 2**20)
+            cache_entry = None
+        else:
+            cache_entry.create()
+            tasks = _cache_reuse_tasks(cache, cache_entry, cache_meta, plan, chunk_size, workers)
+    if tasks is None:
+        task_func = partial(
+            data_source.allocation_range_simulate_and_feed_to_sink,
+            assets=assets, percentage_step=percentage_step, max_assets_n=max_assets_n, cache_entry=cache_entry,
+            constraints=constraints)
+        tasks = [
+            (task_func, task_start, task_stop)
+            for task_start, task_stop in _task_ranges(possible_allocations, chunk_size, workers)]
+    logging.info('Will simulate %d portfolios in %d tasks on %d workers',
+                 possible_allocations, len(tasks), workers)
     time_start = time.time()
-    with ProcessPoolExecutor() as process_pool:
-        allocations_per_core = possible_allocations // os.cpu_count() + 1
-        slice_sender = partial(
-            data_source.allocation_slice_simulate_and_feed_to_sink,
-            slice_size=allocations_per_core,
-            assets=assets,
-            percentage_step=percentage_step,
-            year_range_selector_func=year_range_selector_func,
-            asset_gain_per_year=asset_gain_per_year,
-            sink=sink,
-            chunk_size=chunk_size)
-        portfolios_sent_per_core = process_pool.map(slice_sender, range(0, os.cpu_count()))
+    if store is not None:
+        store.create()
+    with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=data_source.init_simulation_worker,
+            initargs=(plan, sink, plot_masks_func, store, top_filter_func)) as process_pool:
+        task_futures = {
+            process_pool.submit(
+                task_func,
+                start=task_start, stop=task_stop,
+                chunk_size=chunk_size,
+                weights_encoding=weights_encoding): (task_start, task_stop)
+            for task_func, task_start, task_stop in tasks
+        }
+        try:
+            portfolios_sent = _tasks_wait(task_futures)
+        except BaseException:
+            if cache_entry is not None:
+                cache_entry.discard()
+            if store is not None:
+                store.discard()
+            raise
     time_end = time.time()
-    logging.info('Simulated %d portfolios, rate: %dk/s',
-                 sum(portfolios_sent_per_core), possible_allocations // (int(time_end - time_start) + 1) // 1000)
-    sink.send(data_source.DataStreamFinished())
+    logging.info('Simulated %d portfolios, rate: %dk/s, sent %d (%.2f%%) to plotters',
+                 possible_allocations, possible_allocations // (int(time_end - time_start) + 1) // 1000,
+                 portfolios_sent, portfolios_sent / max(possible_allocations, 1) * 100)
+    if cache_entry is not None:
+        cache_entry.commit(cache_meta)
+        cache.evict(keep=cache_entry)
+        logging.info('cache: stored %.1f MiB of results in %s', cache_entry.size / 2**20, cache_entry.path)
+    _store_commit(store)
+    sink.finish()
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-positional-arguments
+def _cache_reuse_tasks(
+        cache: ResultCache, cache_entry: CacheEntry, cache_meta: dict,
+        plan: YearRangePlan, chunk_size: int, workers: int):
+    '''
+    Tasks filling cache entry from results of related run, None if cache has none:
+    results on data without last year are extended by that year,
+    results without one of assets are reused for allocations not holding it.
+    '''
+    base_entry = _appended_year_base_entry(cache, cache_meta, plan)
+    if base_entry is not None:
+        logging.info('cache: extending %d portfolios from %s by year %s',
+                     base_entry.portfolios_n, base_entry.path, plan.years[-1])
+        base_entry.touch()
+        task_func = partial(
+            data_source.cached_range_extend_and_feed_to_sink, base_entry=base_entry, cache_entry=cache_entry)
+        return [
+            (task_func, task_start, task_stop)
+            for task_start, task_stop in _task_ranges(cache_entry.portfolios_n, chunk_size, workers)]
+    base_entry, asset_idx = _added_asset_base_entry(cache, cache_meta, plan)
+    if base_entry is not None:
+        held_n = cache_entry.portfolios_n - base_entry.portfolios_n
+        logging.info('cache: reusing %d portfolios from %s, simulating %d holding %s',
+                     base_entry.portfolios_n, base_entry.path, held_n, cache_meta['assets'][asset_idx])
+        base_entry.touch()
+        simulate_func = partial(
+            data_source.held_asset_range_simulate_and_feed_to_sink,
+            asset_idx=asset_idx, assets_n=cache_entry.assets_n, percentage_step=cache_meta['precision'],
+            cache_entry=cache_entry)
+        reuse_func = partial(
+            data_source.cached_range_add_asset_and_feed_to_sink,
+            base_entry=base_entry, cache_entry=cache_entry, asset_idx=asset_idx, base_offset=held_n,
+            percentage_step=cache_meta['precision'])
+        return [
+            (simulate_func, task_start, task_stop)
+            for task_start, task_stop in _task_ranges(held_n, chunk_size, workers)] + [
+            (reuse_func, held_n + task_start, held_n + task_stop)
+            for task_start, task_stop in _task_ranges(base_entry.portfolios_n, chunk_size, workers)]
+    return None
+
+
+def _appended_year_base_entry(cache: ResultCache, cache_meta: dict, plan: YearRangePlan):
+    '''
+    Cached entry of same run on data without last year, if any
+    '''
+    for entry in cache.entries():
+        if all(entry.meta.get(field) == cache_meta[field]
+               for field in ('assets', 'precision', 'max_assets_n', 'constraints')) \
+                and plan.appends_year_to(entry.meta['layout']):
+            return entry
+    return None
+
+
+def _added_asset_base_entry(cache: ResultCache, cache_meta: dict, plan: YearRangePlan):
+    '''
+    Cached entry of same run without one of assets and index of that asset, if any
+    '''
+    assets = cache_meta['assets']
+    if cache_meta['max_assets_n'] is not None or cache_meta['constraints'] is not None:
+        return None, None
+    for entry in cache.entries():
+        if entry.meta.get('precision') != cache_meta['precision'] or entry.meta.get('max_assets_n') is not None \
+                or entry.meta.get('constraints') is not None:
+            continue
+        for asset_idx in range(len(assets)):
+            if assets[:asset_idx] + assets[asset_idx + 1:] == entry.meta.get('assets') \
+                    and plan.adds_asset_to(entry.meta['layout'], asset_idx):
+                return entry, asset_idx
+    return None, None
+
+
+def _tasks_wait(task_futures: dict):
+    '''
+    Log every task as it completes, return total number of portfolios sent
+    '''
+    portfolios_sent = 0
+    for task_idx, task_future in enumerate(as_completed(task_futures)):
+        task_start, task_stop = task_futures[task_future]
+        task_portfolios, task_portfolios_sent, task_seconds, task_pid = task_future.result()
+        portfolios_sent += task_portfolios_sent
+        logging.info('task %d/%d [%d:%d) done by worker %d in %.2fs, rate: %dk/s',
+                     task_idx + 1, len(task_futures), task_start, task_stop, task_pid,
+                     task_seconds, task_portfolios / max(task_seconds, 1e-6) / 1000)
+    return portfolios_sent
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-positional-arguments
+def _cache_process_func(
+        cache_entry, sink, chunk_size, workers, weights_encoding, plot_masks_func, store=None, top_filter_func=None):
+    '''
+    Stream cached records to sink on pool of workers, prefiltering and storing them as simulated ones
+    '''
+    workers = workers or os.cpu_count()
+    task_ranges = _task_ranges(cache_entry.portfolios_n, chunk_size, workers)
+    time_start = time.time()
+    if store is not None:
+        store.create()
+    with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=data_source.init_simulation_worker,
+            initargs=(None, sink, plot_masks_func, store, top_filter_func)) as process_pool:
+        task_futures = {
+            process_pool.submit(
+                data_source.cached_range_feed_to_sink,
+                start=task_start, stop=task_stop,
+                cache_entry=cache_entry,
+                chunk_size=chunk_size,
+                weights_encoding=weights_encoding): (task_start, task_stop)
+            for task_start, task_stop in task_ranges
+        }
+        try:
+            portfolios_sent = _tasks_wait(task_futures)
+        except BaseException:
+            if store is not None:
+                store.discard()
+            raise
+    logging.info('Read %d cached portfolios in %.2fs, sent %d (%.2f%%) to plotters',
+                 cache_entry.portfolios_n, time.time() - time_start,
+                 portfolios_sent, portfolios_sent / max(cache_entry.portfolios_n, 1) * 100)
+    _store_commit(store)
+    sink.finish()
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-positional-arguments
+def refine_process_func(
+        assets: list = None,
+        percentage_step: int = None,
+        plan: YearRangePlan = None,
+        sink: RingBuffer = None,
+        chunk_size: int = 1,
+        weights_encoding: str = Portfolio.WEIGHTS_INT32,
+        plot_masks_func: Callable = None,
+        constraints: AllocationConstraints = None):
+    '''
+    Simulate allocations of percentage_step, then refine frontier found by plot_masks_func
+    at finer steps down to 1% (see refinement.refined_blocks), feeding portfolios that pass it to sink.
+    With constraints only allocations satisfying them are simulated.
+    Frontier depends on every portfolio simulated before, so this runs in one process.
+    '''
+    time_start = time.time()
+    portfolios_sent = 0
+    for weights, stats, plot_masks in refinement.refined_blocks(
+            plan, len(assets), percentage_step, chunk_size, plot_masks_func, constraints):
+        if len(weights) > 0:
+            sink.write(Portfolio.serialize_batch(stats, weights, weights_encoding, plot_masks=plot_masks))
+            portfolios_sent += len(weights)
+    logging.info('Refined frontier in %.2fs, sent %d portfolios to plotters', time.time() - time_start, portfolios_sent)
+    sink.finish()
+
+
+def _store_commit(store: ResultStore):
+    if store is not None:
+        store.commit()
+        logging.info('store: wrote %d portfolios, %.1f MiB to %s', store.portfolios_n, store.size / 2**20, store.path)
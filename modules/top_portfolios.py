@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+# Investment Portfolio Optimizer
+# Copyright (C) 2024  Vladimir Looze
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import sys
+from collections.abc import Callable
+import numpy
+from modules import data_source
+from modules.portfolio import Portfolio
+from modules.ring_buffer import RingBuffer
+
+
+def top_table(portfolios: list[Portfolio]):
+    '''
+    Text table of portfolios: place, every stat and allocation without zero weights
+    '''
+    widths = [max(len(stat), 9) for stat in Portfolio.STATS]
+    lines = ['  #  ' + ' '.join(f'{stat:>{width}s}' for stat, width in zip(Portfolio.STATS, widths)) + '  Allocation']
+    for place, portfolio in enumerate(portfolios, start=1):
+        allocation = ' - '.join(
+            f'{asset}: {weight}%' for asset, weight in zip(portfolio.assets, portfolio.weights) if weight != 0)
+        lines.append(
+            f'{place:>3d}  ' + ' '.join(f'{value:>{width}.3f}' for value, width in zip(portfolio.stats, widths)) +
+            f'  {allocation}')
+    return '\n'.join(lines)
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-positional-arguments
+def top_process_func(
+        assets: list[str],
+        source: RingBuffer = None,
+        consumer_idx: int = 0,
+        percentage_step: int = None,
+        weights_encoding: str = Portfolio.WEIGHTS_INT32,
+        top_filter_func: Callable = None,
+        output=None):
+    '''
+    Single consumer replacing plotters: every batch of source is best portfolios of one simulation task
+    (see data_source.init_simulation_worker), they are merged by top filter from top_filter_func()
+    and printed as table when source is finished
+    '''
+    top_filter = top_filter_func()
+    for block in source.consume(consumer_idx):
+        stats, weights, _ = Portfolio.batch_columns(block, len(assets), weights_encoding)
+        if weights_encoding == Portfolio.WEIGHTS_RANK:
+            weights = data_source.allocation_walk_unrank_batch(weights[0], len(assets), percentage_step).T
+        top_filter.add(numpy.array(stats.T), numpy.array(weights.T))
+    top_portfolios = top_filter.result()
+    portfolios = []
+    if top_portfolios is not None:
+        portfolios = list(Portfolio.batch_portfolios(top_portfolios[0].T, top_portfolios[1].T, assets))
+    print(top_table(portfolios), file=output or sys.stdout, flush=True)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+# Investment Portfolio Optimizer
+# Copyright (C) 2024  Vladimir Looze
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import operator
+import functools
+import numpy
+import pytest
+from modules import data_filter
+from modules import data_source
+from modules.portfolio import Portfolio
+from modules.batch_simulation import YearRangePlan
+from modules.top_portfolios import top_process_func
+from modules.top_portfolios import top_table
+from modules.simulation_testing import ASSET_GAIN_PER_YEAR
+from modules.simulation_testing import ASSETS
+from modules.simulation_testing import simulated_sink
+
+
+def test_top_table():
+    table = top_table([
+        Portfolio(assets=ASSETS, weights=[50, 0, 50, 0], stats=(1.5, 10, -5, 4.2, 0.01, 0.1, 0.8)),
+        Portfolio(assets=ASSETS, weights=[0, 100, 0, 0], stats=(1.2, 5, -1, 2.1, 0.02, 0.14, 0.3)),
+    ])
+    lines = table.split('\n')
+    assert len(lines) == 3
+    assert lines[0].split() == ['#'] + list(Portfolio.STATS) + ['Allocation']
+    assert lines[1].split()[:3] == ['1', '1.500', '10.000']
+    assert lines[1].endswith('A: 50% - C: 50%')
+    assert lines[2].endswith('B: 100%')
+
+
+@pytest.mark.parametrize('weights_encoding', Portfolio.WEIGHTS_ENCODINGS)
+@pytest.mark.parametrize('stat, k', [(Portfolio.STAT_SHARPE, 5), (Portfolio.STAT_STDDEV, 1)])
+def test_top_process_func(weights_encoding: str, stat: str, k: int):
+    plan = YearRangePlan(data_filter.years_all_to_all, ASSET_GAIN_PER_YEAR)
+    predicates = [(Portfolio.STAT_DIP_PERCENT, operator.gt, -5.0), ('A', operator.le, 50)]
+    top_filter_func = functools.partial(data_filter.TopFilter, stat=stat, k=k, predicates=predicates, assets=ASSETS)
+    output = io.StringIO()
+    with simulated_sink(plan, weights_encoding=weights_encoding, top_filter_func=top_filter_func) as sink:
+        top_process_func(
+            assets=ASSETS, source=sink, percentage_step=10, weights_encoding=weights_encoding,
+            top_filter_func=top_filter_func, output=output)
+
+    portfolios_n = data_source.allocations_count(4, 10)
+    [(weights, stats, _, _)] = data_source.simulated_allocation_blocks(plan, 0, portfolios_n, 4, 10, portfolios_n)
+    stats = stats.astype(numpy.float32)
+    passed = numpy.flatnonzero(
+        (stats[:, Portfolio.STATS.index(Portfolio.STAT_DIP_PERCENT)] > -5.0) & (weights[:, 0] <= 50))
+    keys = -Portfolio.STAT_OBJECTIVES[stat] * stats[passed, Portfolio.STATS.index(stat)]
+    expected_idxs = passed[numpy.argsort(keys, kind='stable')][:k]
+    expected_table = top_table(list(
+        Portfolio.batch_portfolios(stats[expected_idxs].T, weights[expected_idxs].T, ASSETS)))
+    assert output.getvalue() == expected_table + '\n'
@@ -16,21 +16,41 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import os
 import sys
 import time
+import csv
 import json
 import logging
 import argparse
 from collections import deque
+from collections.abc import Callable
 from functools import partial, update_wrapper
 from multiprocessing import Process
-from multiprocessing import Pipe
+from typing import NamedTuple
 from modules import data_output
 from modules import data_source
 from modules import data_filter
 from modules.portfolio import Portfolio
+from modules.portfolio import StaticPortfolio
+from modules.ring_buffer import RingBuffer
+from modules.result_cache import ResultCache
+from modules.result_cache import cache_key
+from modules.result_store import ResultStore
+from modules.result_store import parse_predicate
+from modules.result_store import check_asset_names
+from modules.allocation_constraints import AllocationConstraints
+from modules.batch_simulation import YearRangePlan
 from modules.plotter import plotter_process_func
+from modules.top_portfolios import top_process_func
+from modules.top_portfolios import top_table
+from modules.bound_search import BOUNDED_STATS
+from modules.bound_search import best_allocations
+from modules.frontier_solver import frontier_allocations
 from modules.simulator import simulator_process_func
+from modules.simulator import refine_process_func
+from modules.simulator import simulation_estimate
+from modules.simulator import portfolios_count
 from modules.colors import ticker_color
 
 
@@ -41,7 +61,7 @@ logging.basicConfig(
 )
 
 
-def _parse_args(argv=None):
+def _year_selectors():
     year_selectors = {
         'first-to-last': data_filter.years_first_to_last,
         'first-to-all': data_filter.years_first_to_all,
@@ -56,6 +76,10 @@ def _parse_args(argv=None):
     update_wrapper(year_selectors['window-5'], data_filter.years_sliding_window)
     update_wrapper(year_selectors['window-10'], data_filter.years_sliding_window)
     update_wrapper(year_selectors['window-20'], data_filter.years_sliding_window)
+    return year_selectors
+
+
+def _argument_parser(year_selectors: dict, argv=None):
     parser = argparse.ArgumentParser(
         argv,
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -71,6 +95,12 @@ def _parse_args(argv=None):
         '--hull', type=int, default=0,
         help='filter portfolios: use hull algorithm to plot only given ConvexHull layers '
              'of portfolios in coordinate space. Set to 0 to disable filter.')
+    parser.add_argument(
+        '--filter', type=_filter_arg, default=('hull', 0),
+        metavar='{hull,pareto,pareto=K}',
+        help='filter portfolios: hull - use --hull layers, '
+             'pareto[=K] - plot only first K (default 1) layers of portfolios not dominated '
+             'by others in both coordinates, e.g. higher CAGR and lower Stddev')
     parser.add_argument(
         '--edge', type=int, default=0,
         help='filter portfolios: show edges of portfolio space '
@@ -108,48 +138,219 @@ def _parse_args(argv=None):
     parser.add_argument(
         '--chunk', type=int, default=2**16,
         help='chunk size for data pipeline')
+    parser.add_argument(
+        '--encoding', choices=Portfolio.WEIGHTS_ENCODINGS, default=Portfolio.WEIGHTS_INT32,
+        help='encoding of portfolio weights in data pipeline: '
+             'int32 - 4 bytes per asset, '
+             'uint8 - 1 byte per asset, '
+             'rank - 8 bytes per portfolio, weights are rebuilt from allocation rank '
+             'for plotted portfolios only')
+    parser.add_argument(
+        '--workers', type=int, default=os.cpu_count(),
+        help='number of simulation worker processes')
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='print estimated number of portfolios, data volume and simulation time, then exit')
+    parser.add_argument(
+        '--cache-dir', default='.cache',
+        help='path to directory to keep simulation results in, '
+             'reused by runs with same returns, precision and years')
+    parser.add_argument(
+        '--cache-size', type=int, default=4096,
+        help='maximum size of cache directory in MiB, least recently used results are removed')
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help='always simulate, do not read or store cached results')
+    parser.add_argument(
+        '--store', metavar='PATH',
+        help='also write stats and weights of every simulated portfolio to memory-mapped columnar file, '
+             'see "query" subcommand')
+    parser.add_argument(
+        '--refine', action='store_true',
+        help='simulate allocations at --precision, then simulate neighbourhoods of portfolios '
+             'passing hull or pareto filter at finer steps down to 1%%, '
+             'approximating 1%% precision at a fraction of its cost')
+    parser.add_argument(
+        '--top', type=_top_arg, metavar='STAT:K',
+        help='do not plot, print K best portfolios by stat instead, e.g. Sharpe:50. '
+             f'Stat is one of: {", ".join(Portfolio.STATS)}'.replace('%', '%%'))
+    parser.add_argument(
+        '--where', type=_predicate_arg, action='append', default=[], metavar='PREDICATE',
+        help='with --top, consider only portfolios matching predicate like "Dip(%%)>-15", '
+             'see "query" subcommand. Can be repeated.')
+    parser.add_argument(
+        '--bound', action='store_true',
+        help='with --top, find best portfolios exactly by branch and bound instead of simulating every allocation, '
+             'skipping allocations that cannot make it to top. '
+             f'Stat is one of: {", ".join(BOUNDED_STATS)}'.replace('%', '%%'))
+    parser.add_argument(
+        '--frontier', type=int, default=0, metavar='N',
+        help='do not simulate allocations, plot N portfolios on CAGR vs Stddev frontier instead, '
+             'found by optimizing continuous weights for N Stddev targets, feasible for dozens of assets')
+    return parser
+
+
+def _parse_args(argv=None):
+    year_selectors = _year_selectors()
+    parser = _argument_parser(year_selectors, argv)
     args = parser.parse_args()
+    _validate_args(parser, args)
+    args.years_name = args.years
     args.years = year_selectors[args.years]
     return args
 
 
-# pylint: disable=too-many-locals
-def main(argv):
-    cmdline_args = _parse_args(argv)
-    coords_tuples = [
-        # Y, X
-        (Portfolio.STAT_CAGR_PERCENT, Portfolio.STAT_VARIANCE),
-        (Portfolio.STAT_CAGR_PERCENT, Portfolio.STAT_STDDEV),
-        (Portfolio.STAT_CAGR_PERCENT, Portfolio.STAT_SHARPE),
-        (Portfolio.STAT_CAGR_PERCENT, Portfolio.STAT_POP_PERCENT),
-        (Portfolio.STAT_CAGR_PERCENT, Portfolio.STAT_DIP_PERCENT),
-        (Portfolio.STAT_GAIN, Portfolio.STAT_VARIANCE),
-        (Portfolio.STAT_GAIN, Portfolio.STAT_STDDEV),
-        (Portfolio.STAT_GAIN, Portfolio.STAT_SHARPE),
-        (Portfolio.STAT_GAIN, Portfolio.STAT_POP_PERCENT),
-        (Portfolio.STAT_GAIN, Portfolio.STAT_DIP_PERCENT),
-        (Portfolio.STAT_SHARPE, Portfolio.STAT_VARIANCE),
-        (Portfolio.STAT_SHARPE, Portfolio.STAT_STDDEV),
-        (Portfolio.STAT_SHARPE, Portfolio.STAT_POP_PERCENT),
-        (Portfolio.STAT_SHARPE, Portfolio.STAT_DIP_PERCENT),
-        (Portfolio.STAT_POP_PERCENT, Portfolio.STAT_VARIANCE),
-        (Portfolio.STAT_POP_PERCENT, Portfolio.STAT_STDDEV),
-        (Portfolio.STAT_POP_PERCENT, Portfolio.STAT_SHARPE),
-        (Portfolio.STAT_DIP_PERCENT, Portfolio.STAT_VARIANCE),
-        (Portfolio.STAT_DIP_PERCENT, Portfolio.STAT_STDDEV),
-        (Portfolio.STAT_DIP_PERCENT, Portfolio.STAT_SHARPE),
-    ]
+def _validate_args(parser: argparse.ArgumentParser, args: argparse.Namespace):
+    '''
+    Exit with usage error if options do not work together
+    '''
+    if args.where and args.top is None:
+        parser.error('--where requires --top')
+    if args.bound:
+        if args.top is None or args.top[0] not in BOUNDED_STATS:
+            parser.error(f'--bound requires --top with one of: {", ".join(BOUNDED_STATS)}')
+        if args.store is not None or args.dry_run:
+            parser.error('--bound cannot be used with --store or --dry-run')
+    if args.refine:
+        if args.filter[0] == 'hull' and args.hull == 0:
+            parser.error('--refine requires --hull or --filter=pareto')
+        if args.top is not None or args.store is not None or args.encoding == Portfolio.WEIGHTS_RANK \
+                or args.dry_run:
+            parser.error('--refine cannot be used with --top, --store, --encoding=rank or --dry-run')
+    if args.frontier:
+        if args.frontier < 2:
+            parser.error('--frontier requires at least 2 portfolios')
+        if args.top is not None or args.store is not None or args.refine or args.dry_run:
+            parser.error('--frontier cannot be used with --top, --store, --refine or --dry-run')
 
-    time_start = time.time()
 
-    market_assets, market_yearly_gain = \
-        data_source.read_capitalgain_csv_data(cmdline_args.config_returns)
+def _parse_query_args(argv):
+    parser = argparse.ArgumentParser(
+        prog=f'{os.path.basename(sys.argv[0])} query',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='print portfolios from result store written with --store')
+    parser.add_argument(
+        'store',
+        help='path to result store')
+    parser.add_argument(
+        '--where', type=_predicate_arg, action='append', default=[], metavar='PREDICATE',
+        help='print only portfolios matching predicate like "CAGR(%%)>9" or "Dip(%%)>=-20", '
+             'column is stat or asset name, operator is one of < <= > >= == !=. Can be repeated.')
+    parser.add_argument(
+        '--sort', metavar='COLUMN',
+        help='sort portfolios by stat or asset name')
+    parser.add_argument(
+        '--desc', action='store_true',
+        help='sort in descending order')
+    parser.add_argument(
+        '--limit', type=int, default=20,
+        help='print at most this many portfolios, 0 for all')
+    parser.add_argument(
+        '--format', choices=['csv', 'json'], default='csv',
+        help='output format')
+    return parser.parse_args(argv)
+
+
+def _predicate_arg(value: str):
+    try:
+        return parse_predicate(value)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error)) from error
+
+
+def query_main(argv):
+    cmdline_args = _parse_query_args(argv)
+    store = ResultStore.open(cmdline_args.store)
+    logging.info('store: %d portfolios of %s, precision %d%%, years %s',
+                 store.portfolios_n, ', '.join(store.assets), store.precision, store.years)
+    try:
+        indices = store.query(
+            cmdline_args.where, cmdline_args.sort, cmdline_args.desc, cmdline_args.limit or None)
+    except ValueError as error:
+        logging.error('%s', error)
+        return
+    rows = store.rows(indices)
+    if cmdline_args.format == 'json':
+        json.dump(rows, sys.stdout, indent=1, ensure_ascii=False)
+        sys.stdout.write('\n')
+    else:
+        writer = csv.DictWriter(sys.stdout, fieldnames=store.row_columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def _top_arg(value: str):
+    stat, _, top_n = value.rpartition(':')
+    if stat in Portfolio.STATS and top_n.isdigit() and int(top_n) > 0:
+        return stat, int(top_n)
+    raise argparse.ArgumentTypeError(
+        f'expected STAT:K with K > 0 and STAT one of {", ".join(Portfolio.STATS)}, got {value}')
+
+
+def _filter_arg(value: str):
+    filter_name, _, filter_layers = value.partition('=')
+    if filter_name == 'hull' and not filter_layers:
+        return filter_name, 0
+    if filter_name == 'pareto' and (not filter_layers or filter_layers.isdigit() and int(filter_layers) > 0):
+        return filter_name, int(filter_layers or 1)
+    raise argparse.ArgumentTypeError(f'expected hull, pareto or pareto=K with K > 0, got {value}')
+
+
+# plots of every pipeline run, Y and X
+_COORDS_TUPLES = [
+    (Portfolio.STAT_CAGR_PERCENT, Portfolio.STAT_VARIANCE),
+    (Portfolio.STAT_CAGR_PERCENT, Portfolio.STAT_STDDEV),
+    (Portfolio.STAT_CAGR_PERCENT, Portfolio.STAT_SHARPE),
+    (Portfolio.STAT_CAGR_PERCENT, Portfolio.STAT_POP_PERCENT),
+    (Portfolio.STAT_CAGR_PERCENT, Portfolio.STAT_DIP_PERCENT),
+    (Portfolio.STAT_GAIN, Portfolio.STAT_VARIANCE),
+    (Portfolio.STAT_GAIN, Portfolio.STAT_STDDEV),
+    (Portfolio.STAT_GAIN, Portfolio.STAT_SHARPE),
+    (Portfolio.STAT_GAIN, Portfolio.STAT_POP_PERCENT),
+    (Portfolio.STAT_GAIN, Portfolio.STAT_DIP_PERCENT),
+    (Portfolio.STAT_SHARPE, Portfolio.STAT_VARIANCE),
+    (Portfolio.STAT_SHARPE, Portfolio.STAT_STDDEV),
+    (Portfolio.STAT_SHARPE, Portfolio.STAT_POP_PERCENT),
+    (Portfolio.STAT_SHARPE, Portfolio.STAT_DIP_PERCENT),
+    (Portfolio.STAT_POP_PERCENT, Portfolio.STAT_VARIANCE),
+    (Portfolio.STAT_POP_PERCENT, Portfolio.STAT_STDDEV),
+    (Portfolio.STAT_POP_PERCENT, Portfolio.STAT_SHARPE),
+    (Portfolio.STAT_DIP_PERCENT, Portfolio.STAT_VARIANCE),
+    (Portfolio.STAT_DIP_PERCENT, Portfolio.STAT_STDDEV),
+    (Portfolio.STAT_DIP_PERCENT, Portfolio.STAT_SHARPE),
+]
+
+
+class _Run(NamedTuple):
+    '''
+    Inputs of optimizer run read from market data and config files
+    '''
+    assets: list[str]
+    plan: YearRangePlan
+    constraints: AllocationConstraints
+    # simulate only allocations having up to this many assets, see _edge_only
+    max_assets_n: int
+    static_portfolios: list[Portfolio]
+    colored_assets: dict
+    time_start: float
+
+
+def _read_portfolios_config(cmdline_args: argparse.Namespace, market_assets: list[str]):
+    '''
+    Static portfolios, colors of assets and allocation constraints from config files, None if they are invalid
+    '''
     with open(cmdline_args.config_colors, 'r', encoding='utf-8') as json_file:
         config_colors = json.load(json_file)
     with open(cmdline_args.config_portfolios, 'r', encoding='utf-8') as json_file:
-        config_portfolios = [
-            Portfolio.static_portfolio(portfolio) for portfolio in json.load(json_file)
-        ]
+        config_portfolios_json = json.load(json_file)
+    # config is either list of portfolios or object with portfolios and allocation constraints
+    config_constraints = None
+    if isinstance(config_portfolios_json, dict):
+        config_constraints = config_portfolios_json.get('constraints')
+        config_portfolios_json = config_portfolios_json.get('portfolios', [])
+    config_portfolios = [
+        StaticPortfolio.static_portfolio(portfolio) for portfolio in config_portfolios_json
+    ]
 
     colored_assets = {}
     for ticker in market_assets:
@@ -159,73 +360,312 @@ def main(argv):
         portfolios=config_portfolios, tickers_to_test=market_assets, color_map=colored_assets)
     if num_errors > 0:
         logging.error('Found %d invalid static portfolios', num_errors)
-        return
+        return None
+    constraints = None
+    if config_constraints is not None:
+        try:
+            constraints = AllocationConstraints.from_config(config_constraints, market_assets)
+        except (ValueError, KeyError, TypeError) as error:
+            logging.error('Invalid allocation constraints: %s', error)
+            return None
 
     static_portfolios = config_portfolios
     if cmdline_args.min:
         static_portfolios.append(
-            Portfolio.autoallocation_portfolio(allocation_func=min, color=[1,0,0,1], label='Minimum gain'))
+            StaticPortfolio.autoallocation_portfolio(allocation_func=min, color=[1,0,0,1], label='Minimum gain'))
     if cmdline_args.max:
         static_portfolios.append(
-            Portfolio.autoallocation_portfolio(allocation_func=max, color=[0,1,0,1], label='Maximum gain'))
+            StaticPortfolio.autoallocation_portfolio(allocation_func=max, color=[0,1,0,1], label='Maximum gain'))
+    return static_portfolios, colored_assets, constraints
+
+
+def _frontier_portfolios(plan: YearRangePlan, market_assets: list[str], points_n: int):
+    '''
+    Simulated portfolios of continuous CAGR vs Stddev frontier, see frontier_allocations
+    '''
+    frontier_weights, frontier_stats = frontier_allocations(plan, points_n)
+    cagr_idx = Portfolio.STATS.index(Portfolio.STAT_CAGR_PERCENT)
+    stddev_idx = Portfolio.STATS.index(Portfolio.STAT_STDDEV)
+    logging.info('frontier: %d portfolios from CAGR %.2f%% at Stddev %.3f to CAGR %.2f%% at Stddev %.3f',
+                 len(frontier_weights), frontier_stats[0, cagr_idx], frontier_stats[0, stddev_idx],
+                 frontier_stats[-1, cagr_idx], frontier_stats[-1, stddev_idx])
+    return [
+        StaticPortfolio(weights=weights, assets=market_assets, plot_marker='D').simulated(plan)
+        for weights in frontier_weights.tolist()]
+
+
+def _edge_only(cmdline_args: argparse.Namespace, market_assets: list[str], constraints: AllocationConstraints):
+    '''
+    Limit of assets of simulated allocations (or constraints limiting them) and constraints
+    '''
+    # without hull or pareto filter edge portfolios are the only ones plotted:
+    # enumerate just them instead of simulating all allocations
+    max_assets_n = None
+    if cmdline_args.filter[0] == 'hull' and cmdline_args.hull == 0 and cmdline_args.edge > 0 \
+            and cmdline_args.top is None:
+        max_assets_n = cmdline_args.edge
+        if constraints is not None:
+            constraints = constraints.with_max_assets_n(max_assets_n)
+            max_assets_n = None
+        else:
+            logging.info('edge only: %d of %d allocations will be simulated',
+                         data_source.sparse_allocations_count(len(market_assets), cmdline_args.precision, max_assets_n),
+                         data_source.allocations_count(len(market_assets), cmdline_args.precision))
+    if constraints is not None:
+        logging.info('constraints: %d of %d allocations will be simulated',
+                     constraints.allocations_count(cmdline_args.precision),
+                     data_source.allocations_count(len(market_assets), cmdline_args.precision))
+    return max_assets_n, constraints
+
+
+def _prepared_run(cmdline_args: argparse.Namespace):
+    '''
+    Read market data and config files, simulate static portfolios, None if configs are invalid
+    '''
+    time_start = time.time()
+
+    market_assets, market_yearly_gain = \
+        data_source.read_capitalgain_csv_data(cmdline_args.config_returns)
+    config = _read_portfolios_config(cmdline_args, market_assets)
+    if config is None:
+        return None
+    static_portfolios, colored_assets, constraints = config
+    if cmdline_args.frontier and constraints is not None:
+        logging.error('--frontier does not support allocation constraints')
+        return None
 
+    year_range_plan = YearRangePlan(cmdline_args.years, market_yearly_gain)
     static_portfolios_aligned_to_market = list(map(
         partial(Portfolio.aligned_to_market, market_assets=market_assets),
         static_portfolios))
     static_portfolios_simulated = list(map(
-        partial(Portfolio.simulated,
-                year_range_selector_func=cmdline_args.years,
-                asset_gain_per_year=market_yearly_gain),
+        partial(Portfolio.simulated, plan=year_range_plan),
         static_portfolios_aligned_to_market))
+    if cmdline_args.frontier:
+        static_portfolios_simulated.extend(
+            _frontier_portfolios(year_range_plan, market_assets, cmdline_args.frontier))
     logging.info('%d static portfolios will be plotted on all graphs', len(static_portfolios_simulated))
+    max_assets_n, constraints = _edge_only(cmdline_args, market_assets, constraints)
+    return _Run(
+        market_assets, year_range_plan, constraints, max_assets_n,
+        static_portfolios_simulated, colored_assets, time_start)
+
+
+def _bound_main(cmdline_args: argparse.Namespace, run: _Run):
+    try:
+        top_portfolios, counters = best_allocations(
+            run.plan, run.assets, cmdline_args.precision, cmdline_args.top[0], cmdline_args.top[1],
+            cmdline_args.where, run.constraints)
+    except ValueError as error:
+        logging.error('%s', error)
+        return
+    logging.info('bound: expanded %d nodes, pruned %d nodes holding %d allocations, simulated %d of %d allocations',
+                 counters['expanded'], counters['pruned'], counters['pruned_allocations'], counters['simulated'],
+                 portfolios_count(len(run.assets), cmdline_args.precision, constraints=run.constraints))
+    print(top_table(list(Portfolio.batch_portfolios(
+        top_portfolios[0].T, top_portfolios[1].T, run.assets))), flush=True)
+    logging.info('+%.2fs :: top ready', time.time() - run.time_start)
+
+
+def _dry_run_main(cmdline_args: argparse.Namespace, run: _Run):
+    estimate = simulation_estimate(
+        assets=run.assets,
+        percentage_step=cmdline_args.precision,
+        plan=run.plan,
+        consumers_n=len(_COORDS_TUPLES),
+        workers=cmdline_args.workers,
+        weights_encoding=cmdline_args.encoding,
+        max_assets_n=run.max_assets_n,
+        constraints=run.constraints)
+    logging.info('dry run: %d portfolios over %d year ranges',
+                 estimate['portfolios'], estimate['year_ranges'])
+    logging.info('dry run: %.1f MiB of simulated data, %.1f MiB through data pipeline',
+                 estimate['simulated_bytes'] / 2**20, estimate['transferred_bytes'] / 2**20)
+    logging.info('dry run: simulation will take about %.0fs', estimate['seconds'])
+
+
+def _points_filter(cmdline_args: argparse.Namespace):
+    if cmdline_args.filter[0] == 'pareto':
+        return partial(
+            data_filter.pareto_points_filter, pareto_layers=cmdline_args.filter[1], edge_layers=cmdline_args.edge)
+    if cmdline_args.hull > 0:
+        return partial(
+            data_filter.hull_points_filter, hull_layers=cmdline_args.hull, edge_layers=cmdline_args.edge)
+    return None
 
-    process_wait_list = []
 
-    logging.info('+%.2fs :: preparing portfolio simulation data pipeline...', time.time() - time_start)
-    simulated_source, simulated_sink = Pipe(duplex=False)
-    process_wait_list.append(Process(
+def _result_cache(cmdline_args: argparse.Namespace, run: _Run):
+    if cmdline_args.no_cache:
+        return None
+    if not data_source.allocation_ranks_fit(len(run.assets), cmdline_args.precision):
+        logging.info('cache: allocation ranks do not fit into 64 bits for %d assets at %d%% precision, '
+                     'not caching results', len(run.assets), cmdline_args.precision)
+        return None
+    return ResultCache(cmdline_args.cache_dir, cmdline_args.cache_size * 2**20)
+
+
+def _producer_process(
+        cmdline_args: argparse.Namespace, run: _Run, sink: RingBuffer,
+        plot_masks_func: Callable, top_filter_func: Callable):
+    '''
+    Process feeding simulated portfolios to sink, None if there is nothing to simulate
+    '''
+    if cmdline_args.frontier:
+        # frontier portfolios are plotted along with static ones, no allocations are simulated
+        sink.finish()
+        return None
+    if cmdline_args.refine:
+        return Process(
+            target=refine_process_func,
+            kwargs={
+                'assets': run.assets,
+                'percentage_step': cmdline_args.precision,
+                'plan': run.plan,
+                'sink': sink,
+                'chunk_size': cmdline_args.chunk,
+                'weights_encoding': cmdline_args.encoding,
+                'plot_masks_func': plot_masks_func,
+                'constraints': run.constraints,
+            }
+        )
+    store = None
+    if cmdline_args.store is not None:
+        store = ResultStore(
+            cmdline_args.store, run.assets, cmdline_args.precision, cmdline_args.years_name,
+            portfolios_count(len(run.assets), cmdline_args.precision, run.max_assets_n, run.constraints))
+    return Process(
         target=simulator_process_func,
         kwargs={
-            'assets': market_assets,
+            'assets': run.assets,
             'percentage_step': cmdline_args.precision,
-            'year_range_selector_func': cmdline_args.years,
-            'asset_gain_per_year': market_yearly_gain,
-            'sink': simulated_sink,
+            'plan': run.plan,
+            'sink': sink,
             'chunk_size': cmdline_args.chunk,
+            'workers': cmdline_args.workers,
+            'weights_encoding': cmdline_args.encoding,
+            'plot_masks_func': plot_masks_func,
+            'max_assets_n': run.max_assets_n,
+            'cache': _result_cache(cmdline_args, run),
+            'cache_key': cache_key(
+                cmdline_args.config_returns, run.assets, cmdline_args.precision,
+                cmdline_args.years_name, run.max_assets_n,
+                run.constraints.config() if run.constraints is not None else None),
+            'store': store,
+            'top_filter_func': top_filter_func,
+            'constraints': run.constraints,
         }
-    ))
-    coodr_pair_pipes = {
-        coord_pair: dict(zip(('source', 'sink'), Pipe(duplex=False))) for coord_pair in coords_tuples
-    }
-    process_wait_list.append(Process(
-        target=data_filter.queue_multiplexer,
-        kwargs={
-            'source': simulated_source,
-            'sinks': list(pipe['sink'] for pipe in coodr_pair_pipes.values()),
-        }
-    ))
-    for coord_pair in coords_tuples:
-        process_wait_list.append(Process(
+    )
+
+
+def _consumer_processes(
+        cmdline_args: argparse.Namespace, run: _Run, source: RingBuffer,
+        points_filter: Callable, top_filter_func: Callable):
+    '''
+    Processes reading simulated portfolios from source: top printer in top mode, plotters otherwise
+    '''
+    if top_filter_func is not None:
+        return [Process(
+            target=top_process_func,
+            kwargs={
+                'assets': run.assets,
+                'source': source,
+                'percentage_step': cmdline_args.precision,
+                'weights_encoding': cmdline_args.encoding,
+                'top_filter_func': top_filter_func,
+            }
+        )]
+    return [
+        Process(
             target=plotter_process_func,
             kwargs={
-                'assets': market_assets,
-                'source': coodr_pair_pipes[coord_pair]['source'],
-                'persistent_portfolios': static_portfolios_simulated,
+                'assets': run.assets,
+                'source': source,
+                'consumer_idx': consumer_idx,
+                'percentage_step': cmdline_args.precision,
+                'weights_encoding': cmdline_args.encoding,
+                'points_filter': points_filter,
+                'persistent_portfolios': run.static_portfolios,
                 'coord_pair': coord_pair,
-                'hull_layers': cmdline_args.hull,
-                'edge_layers': cmdline_args.edge,
-                'color_map': colored_assets,
+                'color_map': run.colored_assets,
                 'plots_directory': cmdline_args.plot_dir,
             }
-        ))
+        ) for consumer_idx, coord_pair in enumerate(_COORDS_TUPLES)]
+
+
+def _pipeline_main(cmdline_args: argparse.Namespace, run: _Run):
+    logging.info('+%.2fs :: preparing portfolio simulation data pipeline...', time.time() - run.time_start)
+    points_filter = _points_filter(cmdline_args)
+    # with filter workers send only portfolios that pass it on some plot, each with mask of such plots
+    prefiltered = points_filter is not None
+    plot_masks_func = None
+    if prefiltered:
+        plot_masks_func = partial(data_filter.plot_masks, coord_pairs=_COORDS_TUPLES, points_filter=points_filter)
+    # top mode: workers send only best portfolios of every task to single consumer that prints them
+    top_filter_func = None
+    consumers_n = len(_COORDS_TUPLES)
+    slot_portfolios_n = cmdline_args.chunk
+    if cmdline_args.top is not None:
+        top_filter_func = partial(
+            data_filter.TopFilter, stat=cmdline_args.top[0], k=cmdline_args.top[1],
+            predicates=cmdline_args.where, assets=run.assets)
+        try:
+            top_filter_func()
+        except ValueError as error:
+            logging.error('%s', error)
+            return
+        plot_masks_func = None
+        prefiltered = False
+        consumers_n = 1
+        slot_portfolios_n = cmdline_args.top[1]
+    simulated_ring = RingBuffer(
+        consumers_n=consumers_n,
+        slots_n=2 * cmdline_args.workers + 2,
+        slot_size=slot_portfolios_n * Portfolio.serialized_size(
+            len(run.assets), cmdline_args.encoding, prefiltered))
+    process_wait_list = [
+        process for process in (
+            _producer_process(cmdline_args, run, simulated_ring, plot_masks_func, top_filter_func),
+            *_consumer_processes(cmdline_args, run, simulated_ring, points_filter, top_filter_func))
+        if process is not None]
 
-    logging.info('+%.2fs :: data pipeline prepared', time.time() - time_start)
+    logging.info('+%.2fs :: data pipeline prepared', time.time() - run.time_start)
 
     deque(map(Process.start, process_wait_list), 0)
-    logging.info('+%.2fs :: all processes started', time.time() - time_start)
+    logging.info('+%.2fs :: all processes started', time.time() - run.time_start)
 
     deque(map(Process.join, process_wait_list), 0)
-    logging.info('+%.2fs :: graphs ready', time.time() - time_start)
+    simulated_ring.close(unlink=True)
+    logging.info('+%.2fs :: %s ready', time.time() - run.time_start, 'graphs' if top_filter_func is None else 'top')
+
+
+def main(argv):
+    if len(argv) > 1 and argv[1] == 'query':
+        query_main(argv[2:])
+        return
+    cmdline_args = _parse_args(argv)
+    run = _prepared_run(cmdline_args)
+    if run is None:
+        return
+    if cmdline_args.bound:
+        _bound_main(cmdline_args, run)
+        return
+    # cache, store and rank encoding keep allocation_walk ranks, there are too many of them for wide universes
+    if not data_source.allocation_ranks_fit(len(run.assets), cmdline_args.precision) and \
+            (cmdline_args.encoding == Portfolio.WEIGHTS_RANK or cmdline_args.store is not None):
+        logging.error('--encoding=rank and --store need allocation ranks, '
+                      'which do not fit into 64 bits for %d assets at %d%% precision',
+                      len(run.assets), cmdline_args.precision)
+        return
+    if cmdline_args.store is not None:
+        try:
+            check_asset_names(run.assets)
+        except ValueError as error:
+            logging.error('%s', error)
+            return
+    if cmdline_args.dry_run:
+        _dry_run_main(cmdline_args, run)
+    else:
+        _pipeline_main(cmdline_args, run)
 
 
 if __name__ == '__main__':
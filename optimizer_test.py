@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+# Investment Portfolio Optimizer
+# Copyright (C) 2024  Vladimir Looze
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+import optimizer
+from modules.portfolio import Portfolio
+
+
+def test_format_help():
+    # help strings are %-formatted by argparse: stat names like CAGR(%) must be escaped
+    # pylint: disable=protected-access
+    text = optimizer._argument_parser(optimizer._year_selectors()).format_help()
+    for stat in Portfolio.STATS:
+        assert stat in text
+
+
+def test_query_help(capsys):
+    with pytest.raises(SystemExit) as exit_info:
+        optimizer._parse_query_args(['--help'])  # pylint: disable=protected-access
+    assert exit_info.value.code == 0
+    assert 'CAGR(%)>9' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('args, valid', [
+    ([], True),
+    (['--top', 'Sharpe:3', '--where', 'Dip(%)>-10'], True),
+    (['--where', 'Dip(%)>-10'], False),
+    (['--top', 'CAGR(%):3', '--bound'], True),
+    (['--top', 'Sharpe:3', '--bound'], False),
+    (['--hull', '3', '--refine'], True),
+    (['--refine'], False),
+    (['--hull', '1', '--refine', '--dry-run'], False),
+    (['--frontier', '8'], True),
+    (['--frontier', '8', '--dry-run'], False),
+])
+def test_validate_args(args: list, valid: bool):
+    # pylint: disable=protected-access
+    parser = optimizer._argument_parser(optimizer._year_selectors())
+    if valid:
+        optimizer._validate_args(parser, parser.parse_args(args))
+    else:
+        with pytest.raises(SystemExit):
+            optimizer._validate_args(parser, parser.parse_args(args))